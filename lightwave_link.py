@@ -24,49 +24,1066 @@ COMMAND = "!R{RoomNo}D{DeviceNo}F{FunctionType}P{Parameter}|{Line1}|{Line2}"
 
 STALE_THRESHOLD_SECONDS   = 3*60*60  # 3h
 MIN_SCAN_INTERVAL_SECONDS =   30*60  # 30m
+METRICS_REFRESH_SECONDS   =       5
+SNAPSHOT_INTERVAL_SECONDS =    5*60  # 5m
+SNAPSHOT_VERSION          =       1
+SERIES_TTL_SECONDS        = 7*24*60*60  # 7d
+SNAPSHOT_TTL_SECONDS      = 7*24*60*60  # 7d
+EXPORT_INTERVAL_SECONDS   =       5
 
 
 # =============================================================================
-class ProtectedAttribute(object):
+class Timer(object):
     """
-    Descriptor which protects all data access (get, set) with its host
-    instance's `sLock` attribute.
+    Callback scheduled on an `EventLoop` by `call_at`, `call_later` or
+    `call_soon`.
+
+    :IVariables:
+        fWhen : float
+            Unixtime at which the callback is due.
+        fnCallback : callable
+            Called with `tArgs` once `fWhen` has passed.
+        tArgs : tuple
+            Positional arguments for `fnCallback`.
+        bCancelled : bool
+            Set by `cancel`. Cancelled timers are skipped when they fall due.
+    """
+    def __init__(self, fWhen, fnCallback, tArgs):
+        self.fWhen = fWhen
+        self.fnCallback = fnCallback
+        self.tArgs = tArgs
+        self.bCancelled = False
+
+    def cancel(self):
+        self.bCancelled = True
+
+# =============================================================================
+class WallClock(object):
+    """
+    Source of time for an `EventLoop`, and the means by which it waits for
+    time to pass or descriptors to become readable.
+    """
+    @staticmethod
+    def time():
+        import time
+        return time.time()
+
+    @staticmethod
+    def wait(lFds, fTimeout):
+        """Wait for at most `fTimeout` seconds (None: indefinitely) for any
+        of `lFds` to become readable, and return those which are."""
+        import errno
+        import select
+        try:
+            lReadable, _, _ = select.select(lFds, [], [], fTimeout)
+        except select.error as sError:
+            if sError.args[0] != errno.EINTR:
+                raise
+            lReadable = []
+        return lReadable
+
+class VirtualClock(WallClock):
+    """
+    `WallClock` whose time only moves when the loop would otherwise wait:
+    instead of sleeping until the next timer it jumps straight to it. Hours
+    of timers, rate limits and timeouts thus pass in as long as the
+    callbacks take to run.
+
+    :IVariables:
+        fNow : float
+            Current unixtime, as far as this clock is concerned.
+    """
+    def __init__(self, fNow=0.0):
+        self.fNow = fNow
+
+    def time(self):
+        return self.fNow
+
+    def wait(self, lFds, fTimeout):
+        lReadable = []
+        if lFds:
+            lReadable = WallClock.wait(lFds, 0.0)
+        if lReadable:
+            return lReadable
+        if fTimeout is None:
+            if not lFds:
+                raise RuntimeError("Waiting for nothing, in virtual time")
+        else:
+            self.fNow += fTimeout
+        return lReadable
+
+# =============================================================================
+class EventLoop(object):
+    """
+    Single-threaded reactor which multiplexes socket readiness and timers
+    with `select`, so that receiving from the Lightwave Link, rate-limited
+    transmission, periodic scans and metrics collection share one thread and
+    need no locking. (Python 2.7 has no asyncio; this provides the small
+    subset we need.)
+
+    Everything on the loop takes the time from `time`, so with a
+    `VirtualClock` it runs in simulated rather than real time.
+
+    :IVariables:
+        sClock : WallClock
+            Source of time.
+        lTimers : list
+            Heap of `(fWhen, iSequence, Timer)` tuples, earliest first.
+            `iSequence` keeps callbacks due at the same time in FIFO order.
+        siSequence : int generator
+            Source of `iSequence` values.
+        dReaders : dict
+            Maps file descriptor to the callable invoked, without arguments,
+            when that descriptor is readable.
+        bRunning : bool
+            Cleared by `stop` to make `run_forever` return.
     """
-    def __get__(self, sHostInstance, clsType=None):
-        del clsType
-        with sHostInstance.sLock:
-            return self.mValue
-    def __set__(self, sHostInstance, mNewValue):
-        with sHostInstance.sLock:
-            self.mValue = mNewValue
+    def __init__(self, sClock=None):
+        import itertools
+        self.sClock = sClock or WallClock()
+        self.lTimers = []
+        self.siSequence = itertools.count()
+        self.dReaders = {}
+        self.bRunning = False
+
+    def time(self):
+        return self.sClock.time()
+
+    def call_at(self, fWhen, fnCallback, *tArgs):
+        import heapq
+        sTimer = Timer(fWhen, fnCallback, tArgs)
+        heapq.heappush(self.lTimers, (fWhen, self.siSequence.next(), sTimer))
+        return sTimer
+
+    def call_later(self, fDelay, fnCallback, *tArgs):
+        return self.call_at(self.time() + fDelay, fnCallback, *tArgs)
+
+    def call_soon(self, fnCallback, *tArgs):
+        return self.call_at(0.0, fnCallback, *tArgs)
+
+    def add_reader(self, iFd, fnCallback):
+        self.dReaders[iFd] = fnCallback
+
+    def remove_reader(self, iFd):
+        self.dReaders.pop(iFd, None)
+
+    def run_once(self, fTimeout=None):
+        """Wait for at most `fTimeout` seconds (None: indefinitely) for the
+        next timer or readable descriptor, then dispatch everything which is
+        ready."""
+        import heapq
+
+        if self.lTimers:
+            fUntilTimer = max(self.lTimers[0][0] - self.time(), 0.0)
+            if fTimeout is None or fUntilTimer < fTimeout:
+                fTimeout = fUntilTimer
+
+        lReadable = self.sClock.wait(self.dReaders.keys(), fTimeout)
+
+        for iFd in lReadable:
+            fnCallback = self.dReaders.get(iFd)
+            if fnCallback is not None:
+                self.dispatch(fnCallback, ())
+
+        fNow = self.time()
+        while self.lTimers and self.lTimers[0][0] <= fNow:
+            _, _, sTimer = heapq.heappop(self.lTimers)
+            if not sTimer.bCancelled:
+                self.dispatch(sTimer.fnCallback, sTimer.tArgs)
+
+    @staticmethod
+    def dispatch(fnCallback, tArgs):
+        # pylint: disable=broad-except
+        try:
+            fnCallback(*tArgs)
+        except Exception:
+            sLog.error("Exception from event loop callback", exc_info=True)
+
+    def run_until(self, fnDone, fTimeout=None):
+        """Run the loop until `fnDone()` returns true or `fTimeout` seconds
+        lapse. Returns the final value of `fnDone()`."""
+        fDeadline = None if fTimeout is None else self.time() + fTimeout
+        while not fnDone():
+            fRemaining = None
+            if fDeadline is not None:
+                fRemaining = fDeadline - self.time()
+                if fRemaining <= 0.0:
+                    break
+            self.run_once(fRemaining)
+        return fnDone()
+
+    def run_forever(self):
+        self.bRunning = True
+        self.run_until(lambda: not self.bRunning)
+
+    def stop(self):
+        self.bRunning = False
+
+# =============================================================================
+class ReplayLoop(EventLoop):
+    """
+    `EventLoop` on a `VirtualClock`, which can also be moved forward
+    explicitly with `advance`. Used to replay captured datagrams as fast as
+    possible while timers (rate limiting, timeouts, scans) still fire at the
+    right moments relative to the captured traffic, and to simulate days of
+    operation in seconds.
+    """
+    def __init__(self, fNow=0.0):
+        EventLoop.__init__(self, VirtualClock(fNow))
+
+    def advance(self, fWhen):
+        """Move the clock forward to `fWhen`, dispatching each timer which
+        falls due on the way at its due time."""
+        import heapq
+        sClock = self.sClock
+        while self.lTimers and self.lTimers[0][0] <= fWhen:
+            fDue, _, sTimer = heapq.heappop(self.lTimers)
+            sClock.fNow = max(sClock.fNow, fDue)
+            if not sTimer.bCancelled:
+                self.dispatch(sTimer.fnCallback, sTimer.tArgs)
+        sClock.fNow = max(sClock.fNow, fWhen)
+
+# =============================================================================
+class DuplicateFilter(object):
+    """
+    Recognises datagrams already seen within the last `fWindow` seconds. The
+    Lightwave Link sends every response twice, once unicast and once
+    broadcast, usually within milliseconds of each other.
+
+    Entries are held in insertion order, which (because the window is fixed)
+    is also expiry order, so both lookup and expiry are O(1) amortised.
+
+    :IVariables:
+        fWindow : float
+            Seconds for which a datagram suppresses identical ones.
+        iMaxSize : int
+            Maximum number of datagrams remembered. When full the oldest is
+            evicted early, even if its window has not lapsed.
+        fnTime : callable
+            Returns the current unixtime.
+        dExpiry : collections.OrderedDict
+            Maps datagram to the unixtime at which it is forgotten.
+        iHits : int
+            Number of datagrams discarded as duplicates.
+        iMisses : int
+            Number of datagrams not seen within the window.
+        iEvictions : int
+            Number of datagrams forgotten before their window lapsed, due to
+            the cache being full.
+    """
+    def __init__(self, fWindow, iMaxSize, fnTime):
+        import collections
+        self.fWindow = fWindow
+        self.iMaxSize = iMaxSize
+        self.fnTime = fnTime
+        self.dExpiry = collections.OrderedDict()
+        self.iHits = 0
+        self.iMisses = 0
+        self.iEvictions = 0
+
+    def __len__(self):
+        return len(self.dExpiry)
+
+    def is_duplicate(self, rDatagram):
+        """Return True if `rDatagram` was seen within the window, otherwise
+        remember it and return False."""
+        fNow = self.fnTime()
+        self.expire(fNow)
+
+        if rDatagram in self.dExpiry:
+            self.iHits += 1
+            return True
+
+        self.iMisses += 1
+        if len(self.dExpiry) >= self.iMaxSize:
+            self.dExpiry.popitem(last=False)
+            self.iEvictions += 1
+        self.dExpiry[rDatagram] = fNow + self.fWindow
+        return False
+
+    def expire(self, fNow):
+        dExpiry = self.dExpiry
+        while dExpiry:
+            rOldest = next(iter(dExpiry))
+            if dExpiry[rOldest] > fNow:
+                break
+            del dExpiry[rOldest]
+
+# =============================================================================
+class IngestQueue(object):
+    """
+    Bounded queue of decoded messages awaiting dispatch. Messages given the
+    same key (e.g. status messages of one kind for one device) are
+    coalesced: the newer message replaces the queued one and moves to the
+    back of the queue, so the backlog holds at most one entry per key and
+    no stale status is dispatched. Messages are never merged, so each
+    dispatched message is one the Link sent. Messages without a key keep
+    their order.
+
+    :IVariables:
+        iMaxSize : int
+            Maximum number of entries.
+        rOverflow : str
+            What to do with a message arriving when full: `DROP_OLDEST`
+            discards the entry at the head of the queue to make room,
+            `DROP_NEWEST` discards the arriving message.
+        dQueue : collections.OrderedDict
+            Maps key to `(dMessage, fQueued)`, in arrival order.
+        siSequence : int generator
+            Source of unique keys for messages given none.
+        iCoalesced : int
+            Number of queued messages replaced by a newer one.
+        iDropped : int
+            Number of messages discarded due to the queue being full.
+    """
+    DROP_OLDEST = "drop-oldest"
+    DROP_NEWEST = "drop-newest"
+    OVERFLOW_POLICIES = (DROP_OLDEST, DROP_NEWEST)
+
+    def __init__(self, iMaxSize, rOverflow=DROP_OLDEST):
+        import collections
+        import itertools
+        if rOverflow not in self.OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy: {}".format(rOverflow))
+        self.iMaxSize = iMaxSize
+        self.rOverflow = rOverflow
+        self.dQueue = collections.OrderedDict()
+        self.siSequence = itertools.count()
+        self.iCoalesced = 0
+        self.iDropped = 0
+
+    def __len__(self):
+        return len(self.dQueue)
+
+    def put(self, dMessage, mKey=None, fQueued=None):
+        """Queue `dMessage`, replacing the message queued with the same
+        (non-None) `mKey`. `fQueued` is the unixtime at which it was queued,
+        handed back by `pop`. Returns False if it was discarded."""
+        dQueue = self.dQueue
+        if mKey is not None and mKey in dQueue:
+            del dQueue[mKey]
+            dQueue[mKey] = (dict(dMessage), fQueued)
+            self.iCoalesced += 1
+            return True
+
+        if len(dQueue) >= self.iMaxSize:
+            self.iDropped += 1
+            if self.rOverflow == self.DROP_NEWEST:
+                return False
+            dQueue.popitem(last=False)
+
+        if mKey is None:
+            mKey = self.siSequence.next()
+        dQueue[mKey] = (dict(dMessage), fQueued)
+        return True
+
+    def pop(self):
+        """Remove the oldest message, and return `(dMessage, fQueued)`."""
+        return self.dQueue.popitem(last=False)[1]
+
+# =============================================================================
+class DatagramLog(object):
+    """
+    Append-only binary log of datagrams received from the Lightwave Link,
+    for replaying production traffic offline (see `replay`).
+
+    The file starts with `MAGIC`, followed by one record per datagram: a
+    header packed as `RECORD_FORMAT` (receive unixtime, source IPv4 address,
+    source port, payload length) then the payload itself. A record cut short
+    by a crash is ignored by `read`.
+
+    :IVariables:
+        sFH : file
+            Log file, opened for appending.
+    """
+    MAGIC = "LWLCAP1\n"
+    RECORD_FORMAT = "<d4sHH"
+
+    def __init__(self, rPath):
+        self.sFH = open(rPath, "ab")
+        if self.sFH.tell() == 0:
+            self.sFH.write(self.MAGIC)
+            self.sFH.flush()
+
+    def write(self, fTime, tAddress, rDatagram):
+        import socket
+        import struct
+        self.sFH.write(struct.pack(
+            self.RECORD_FORMAT,
+            fTime,
+            socket.inet_aton(tAddress[0]),
+            tAddress[1],
+            len(rDatagram)))
+        self.sFH.write(rDatagram)
+        self.sFH.flush()
+
+    def close(self):
+        self.sFH.close()
+
+    @classmethod
+    def read(cls, rPath):
+        """Generate `(fTime, tAddress, rDatagram)` for each record in the log
+        at `rPath`, reading through `mmap` rather than loading the file."""
+        import mmap
+        import socket
+        import struct
+        iHeader = struct.calcsize(cls.RECORD_FORMAT)
+        with open(rPath, "rb") as sFH:
+            sMap = mmap.mmap(sFH.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                if sMap[:len(cls.MAGIC)] != cls.MAGIC:
+                    raise ValueError("{} is not a datagram log".format(rPath))
+                iOffset = len(cls.MAGIC)
+                iSize = len(sMap)
+                while iOffset + iHeader <= iSize:
+                    fTime, rAddress, iPort, iLength = struct.unpack_from(
+                        cls.RECORD_FORMAT, sMap, iOffset)
+                    iOffset += iHeader
+                    if iOffset + iLength > iSize:
+                        break
+                    yield (
+                        fTime,
+                        (socket.inet_ntoa(rAddress), iPort),
+                        sMap[iOffset:iOffset + iLength])
+                    iOffset += iLength
+            finally:
+                sMap.close()
+
+# =============================================================================
+class EventLog(object):
+    """
+    Structured log of what the controller saw and did (device status, demand
+    transitions, switch commands), written as JSON lines by a background
+    thread so that the event loop never formats, or waits for, log output.
+    `render` produces the human-readable form on demand, see
+    `--view-events`.
+
+    `record` only queues the record. Encoding, writing and size-based
+    rotation (to `rPath`.1, `rPath`.2, ...) happen on the writer thread. If
+    it falls `QUEUE_SIZE` records behind, further records are discarded
+    rather than blocking the event loop.
+
+    :IVariables:
+        rPath : str
+            Log file, or None until `open` is called.
+        iMaxBytes : int
+            Size beyond which the log file is rotated.
+        iBackups : int
+            Number of rotated log files kept.
+        sQueue : Queue.Queue
+            `(rEvent, fTime, dFields)` records awaiting the writer thread,
+            then None to stop it.
+        sThread : threading.Thread
+            Writer thread, or None if the log is not open.
+        iRecorded : int
+            Number of records queued.
+        iDropped : int
+            Number of records discarded because the queue was full.
+    """
+    QUEUE_SIZE = 4096
+    MAX_BYTES = 10*1024*1024    # 10MiB
+    BACKUPS = 5
+
+    def __init__(self):
+        import Queue
+        self.rPath = None
+        self.iMaxBytes = self.MAX_BYTES
+        self.iBackups = self.BACKUPS
+        self.sQueue = Queue.Queue(self.QUEUE_SIZE)
+        self.sThread = None
+        self.iRecorded = 0
+        self.iDropped = 0
+
+    def open(self, rPath, iMaxBytes=MAX_BYTES, iBackups=BACKUPS):
+        import threading
+        self.rPath = rPath
+        self.iMaxBytes = iMaxBytes
+        self.iBackups = iBackups
+        self.sThread = threading.Thread(target=self.run, name="EventLog")
+        self.sThread.daemon = True
+        self.sThread.start()
+
+    def close(self):
+        """Write out every queued record, then stop the writer thread."""
+        if self.sThread is None:
+            return
+        self.sQueue.put(None)
+        self.sThread.join()
+        self.sThread = None
+
+    def record(self, rEvent, fTime, dFields):
+        """Queue event `rEvent`, which happened at unixtime `fTime`.
+        `dFields` must not be modified afterwards."""
+        import Queue
+        if self.sThread is None:
+            return
+        try:
+            self.sQueue.put_nowait((rEvent, fTime, dFields))
+        except Queue.Full:
+            self.iDropped += 1
+            return
+        self.iRecorded += 1
+
+    def run(self):
+        import json
+        sFH = open(self.rPath, "a")
+        try:
+            while True:
+                tRecord = self.sQueue.get()
+                if tRecord is None:
+                    break
+                rEvent, fTime, dFields = tRecord
+                sFH.write(json.dumps(
+                    {"event": rEvent, "at": fTime, "data": dFields},
+                    separators=(",", ":")))
+                sFH.write("\n")
+                if self.sQueue.empty():
+                    sFH.flush()
+                if sFH.tell() >= self.iMaxBytes:
+                    sFH.close()
+                    self.rotate()
+                    sFH = open(self.rPath, "a")
+        except (IOError, OSError) as sError:
+            sLog.error("Unable to write event log %s: %s", self.rPath, sError)
+        finally:
+            sFH.close()
+
+    def rotate(self):
+        import os
+        for iBackup in xrange(self.iBackups - 1, 0, -1):
+            rOld = "{}.{}".format(self.rPath, iBackup)
+            if os.path.exists(rOld):
+                os.rename(rOld, "{}.{}".format(self.rPath, iBackup + 1))
+        if self.iBackups:
+            os.rename(self.rPath, self.rPath + ".1")
+        else:
+            os.remove(self.rPath)
+
+    @classmethod
+    def read(cls, rPath):
+        """Generate each record logged to `rPath`, oldest first, including
+        those in rotated files."""
+        import json
+        import os
+        lPaths = [rPath]
+        iBackup = 1
+        while os.path.exists("{}.{}".format(rPath, iBackup)):
+            lPaths.insert(0, "{}.{}".format(rPath, iBackup))
+            iBackup += 1
+        for rFile in lPaths:
+            with open(rFile, "r") as sFH:
+                for rLine in sFH:
+                    try:
+                        yield json.loads(rLine)
+                    except ValueError:
+                        pass    # Cut short by a crash
+
+    @staticmethod
+    def render(dRecord):
+        """Return the human-readable form of a record from `read`."""
+        import json
+        import time
+        fTime = dRecord["at"]
+        rTime = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(fTime))
+        rTime += ",{:03.0f}".format((fTime % 1) * 1000)
+        dFields = dRecord["data"]
+        if dRecord["event"] == "status":
+            sDevice = TRVStatus(dFields["name"].encode("utf8"))
+            sDevice.update(dFields["status"], fTime)
+            return "{} {}".format(rTime, sDevice)
+        return "{} {:<7} {}".format(
+            rTime,
+            dRecord["event"],
+            " ".join(
+                "{}={}".format(rKey, json.dumps(mValue))
+                for rKey, mValue in sorted(dFields.iteritems())))
+
+sEventLog = EventLog()
+
+# =============================================================================
+class MessageRouter(object):
+    """
+    Table of handlers for JSON messages from the Lightwave Link, keyed by the
+    value of the message's "fn", "type" or "pkt" field (consulted in that
+    order, first match wins). Handlers are called with the decoded message.
+
+    Messages routed to `None` are ignored, which `peek` lets us establish
+    from the raw JSON with a regular expression, skipping the full decode.
+
+    :IVariables:
+        dRoutes : dict
+            Maps `(rField, rValue)` to handler callable, or None for messages
+            which should be ignored.
+        fnDefault : callable
+            Called with messages which match no route.
+    """
+    FIELDS = ("fn", "type", "pkt")
+
+    def __init__(self):
+        import re
+        self.dRoutes = {}
+        self.fnDefault = self.unhandled
+        self.sPattern = re.compile(r'"(fn|type|pkt)"\s*:\s*"([^"\\]*)"')
+
+    def register(self, fnHandler, rFn=None, rType=None, rPkt=None):
+        for rField, rValue in zip(self.FIELDS, (rFn, rType, rPkt)):
+            if rValue is not None:
+                self.dRoutes[(rField, rValue)] = fnHandler
+
+    def ignore(self, rFn=None, rType=None, rPkt=None):
+        self.register(None, rFn=rFn, rType=rType, rPkt=rPkt)
+
+    def peek(self, rJSON):
+        """Return the routing fields of undecoded JSON message `rJSON`, as
+        a dict, without decoding it."""
+        dFields = {}
+        for sMatch in self.sPattern.finditer(rJSON):
+            dFields.setdefault(sMatch.group(1), sMatch.group(2))
+        return dFields
+
+    def route(self, dMessage):
+        """Return the handler for `dMessage`, which need only contain the
+        routing fields, e.g. as returned by `peek`."""
+        for rField in self.FIELDS:
+            tKey = (rField, dMessage.get(rField))
+            if tKey in self.dRoutes:
+                return self.dRoutes[tKey]
+        return self.fnDefault
+
+    def is_ignored(self, dMessage):
+        return self.route(dMessage) is None
+
+    def dispatch(self, dMessage):
+        fnHandler = self.route(dMessage)
+        if fnHandler is not None:
+            fnHandler(dMessage)
+
+    @staticmethod
+    def unhandled(dMessage):
+        sLog.warn("Unhandled response:\n%s", dMessage)
+
+# =============================================================================
+class Histogram(object):
+    """
+    Distribution of observed values, as counts per bucket. Kept as plain
+    numbers, like the other statistics, and exported by `LightwaveCollector`
+    at scrape time.
+
+    :IVariables:
+        tBounds : tuple of float
+            Upper bound (inclusive) of each bucket, ascending. An implicit
+            final bucket holds larger values.
+        lCounts : list of int
+            Number of observations in each bucket (not cumulative).
+        fSum : float
+            Sum of all observations.
+    """
+    LATENCY_BOUNDS = (
+        0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+        1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+    DEPTH_BOUNDS = (0, 1, 2, 4, 8, 16, 32, 64)
+
+    def __init__(self, tBounds=LATENCY_BOUNDS):
+        self.tBounds = tuple(tBounds)
+        self.lCounts = [0] * (len(self.tBounds) + 1)
+        self.fSum = 0.0
+
+    def observe(self, fValue):
+        import bisect
+        self.lCounts[bisect.bisect_left(self.tBounds, fValue)] += 1
+        self.fSum += fValue
+
+    def buckets(self):
+        """Return `[(rBound, iCumulativeCount), ...]`, as expected by
+        `prometheus_client.core.HistogramMetricFamily`."""
+        lBuckets = []
+        iTotal = 0
+        for fBound, iCount in zip(self.tBounds, self.lCounts):
+            iTotal += iCount
+            lBuckets.append((repr(float(fBound)), iTotal))
+        lBuckets.append(("+Inf", iTotal + self.lCounts[-1]))
+        return lBuckets
+
+# =============================================================================
+class LatencyEstimator(object):
+    """
+    Running estimate of how long the Lightwave Link takes to respond, per
+    kind of response, maintained the way TCP estimates round-trip time (RFC
+    6298): a smoothed mean and mean deviation, from which the timeout is
+    mean + `K` * deviation.
+
+    :IVariables:
+        fInitial : float
+            Timeout used for kinds of response not yet sampled.
+        fMin, fMax : float
+            Bounds on the timeout.
+        dEstimates : dict
+            Maps kind to `[fMean, fDeviation]`.
+    """
+    ALPHA = 1 / 8.0     # Gain of the mean
+    BETA = 1 / 4.0      # Gain of the deviation
+    K = 4
+
+    def __init__(self, fInitial, fMin, fMax):
+        self.fInitial = fInitial
+        self.fMin = fMin
+        self.fMax = fMax
+        self.dEstimates = {}
+
+    def sample(self, rKind, fLatency):
+        lEstimate = self.dEstimates.get(rKind)
+        if lEstimate is None:
+            self.dEstimates[rKind] = [fLatency, fLatency / 2]
+            return
+        fMean, fDeviation = lEstimate
+        lEstimate[1] = ((1 - self.BETA) * fDeviation
+                        + self.BETA * abs(fMean - fLatency))
+        lEstimate[0] = (1 - self.ALPHA) * fMean + self.ALPHA * fLatency
+
+    def timeout(self, rKind):
+        lEstimate = self.dEstimates.get(rKind)
+        if lEstimate is None:
+            return self.fInitial
+        fTimeout = lEstimate[0] + self.K * lEstimate[1]
+        return min(max(fTimeout, self.fMin), self.fMax)
+
+class TokenBucket(object):
+    """
+    Rate limit for commands to the Lightwave Link: up to `fBurst` at once,
+    then `fRate` per second. The rate adapts to what the Link tolerates the
+    way TCP adapts its window (AIMD): it creeps up by `INCREASE` for each
+    command answered, and halves when one fails, at most once per failing
+    burst, as failures of commands sent before the latest decrease say
+    nothing about the rate since.
+
+    :IVariables:
+        fRate : float
+            Commands per second.
+        fMinRate, fMaxRate : float
+            Bounds on `fRate`.
+        fBurst : float
+            Capacity of the bucket.
+        fTokens : float
+            Commands which may be sent now, as of `fUpdated`.
+        fUpdated : float
+            Unixtime at which `fTokens` was last brought up to date.
+        fDecreased : float
+            Unixtime of the latest decrease in `fRate`.
+    """
+    INCREASE = 0.01     # Commands per second, per command answered
+    DECREASE = 0.5      # Factor applied to the rate per failing burst
+
+    def __init__(self, fRate, fBurst, fMinRate, fMaxRate):
+        self.fRate = fRate
+        self.fMinRate = fMinRate
+        self.fMaxRate = fMaxRate
+        self.fBurst = fBurst
+        self.fTokens = fBurst
+        self.fUpdated = 0.0
+        self.fDecreased = 0.0
+
+    def set_rate(self, fRate):
+        self.fRate = min(max(fRate, self.fMinRate), self.fMaxRate)
+
+    def tokens(self, fNow):
+        return min(
+            self.fTokens + (fNow - self.fUpdated) * self.fRate,
+            self.fBurst)
+
+    def delay(self, fNow):
+        """Return the number of seconds until a command may be sent."""
+        return max((1.0 - self.tokens(fNow)) / self.fRate, 0.0)
+
+    def take(self, fNow):
+        self.fTokens = self.tokens(fNow) - 1.0
+        self.fUpdated = fNow
+
+    def succeeded(self):
+        self.set_rate(self.fRate + self.INCREASE)
+
+    def failed(self, fSentTime, fNow):
+        """Account for a command transmitted at `fSentTime` having failed."""
+        if fSentTime < self.fDecreased:
+            return
+        # Bank tokens at the old rate, so only future refills slow down
+        self.fTokens = self.tokens(fNow)
+        self.fUpdated = fNow
+        self.set_rate(self.fRate * self.DECREASE)
+        self.fDecreased = fNow
+        sLog.info("Command rate reduced to %.2f/s", self.fRate)
+
+# =============================================================================
+class CommandFuture(object):
+    """
+    Pending response to a command sent by `LightwaveLink.send_command` (or to
+    an expectation registered with `LightwaveLink.expect`). Resolved on the
+    event loop when a correlated message arrives. If none arrives within the
+    timeout estimated by `LightwaveLink.sLatency` (see `LatencyEstimator`;
+    `LightwaveLink.COMMAND_TIMEOUT_SECONDS` until the kind of response has
+    been sampled), or the Link reports "Transmit fail", the command is
+    retransmitted after an exponential backoff, with a doubled timeout, up to
+    `iRetries` times. It then resolves with an empty dict. A retry superseded
+    by a newer command with the same coalescing key resolves with that
+    command's response instead.
+
+    :IVariables:
+        iTransactionNumber : int
+            Transaction number the command is sent with. Negative for
+            expectations registered by `LightwaveLink.expect`, which send
+            nothing. Each retransmission takes a new one, see
+            `LightwaveLink.renumber`.
+        lEarlierNumbers : list of int
+            Transaction numbers of earlier transmissions.
+        rPayload : str
+            Command string, without transaction number.
+        tExpect : tuple of str
+            Values of the "fn" field (or "type", for messages without "fn")
+            of JSON messages which answer this command. Necessary because the
+            Lightwave Link numbers its JSON messages from its own counter,
+            not ours, so only plain-text replies (e.g. "101,OK") echo our
+            transaction number. When empty, only a plain-text reply resolves
+            the future.
+        dMatch : dict
+            Additional fields which a JSON message must carry, with these
+            exact values, to answer this command. E.g. `{"slot": 3}`.
+        fSentTime : float
+            Unixtime when the command was transmitted, or None while it waits
+            for the rate limiter.
+        fResponseTime : float
+            Unixtime when `dResponse` arrived.
+        dResponse : dict
+            Correlated message, or empty dict if none (yet).
+        bDone : bool
+            Set once resolved, whether by a response or a timeout.
+        lCallbacks : list of callable
+            Called with this future once resolved.
+        sTimer : Timer
+            Retries or abandons the command on timeout. Cancelled on
+            resolution.
+        iPriority : int
+            Priority to (re)transmit the command with, see `send_command`.
+        iAttempts : int
+            Number of times the command has been transmitted.
+        bInFlight : bool
+            The latest transmission has neither been answered nor failed.
+        fQueuedTime : float
+            Unixtime the command last joined the `CommandScheduler`.
+        fOriginTime : float
+            Unixtime of the event which prompted the command, if it is to be
+            accounted for in `LightwaveLink.sHeatCallLatency`, else None.
+        iRetries : int
+            Number of times the command may be retransmitted after a timeout
+            or "Transmit fail" error.
+    """
+    def __init__(self, iTransactionNumber, rPayload, tExpect, dMatch,
+                 iPriority=None, iRetries=0):
+        self.iTransactionNumber = iTransactionNumber
+        self.lEarlierNumbers = []
+        self.rPayload = rPayload
+        self.tExpect = tuple(tExpect)
+        self.dMatch = dict(dMatch or {})
+        self.fSentTime = None
+        self.fResponseTime = None
+        self.dResponse = {}
+        self.bDone = False
+        self.lCallbacks = []
+        self.sTimer = None
+        self.iPriority = iPriority
+        self.iAttempts = 0
+        self.bInFlight = False
+        self.iRetries = iRetries
+        self.fQueuedTime = None
+        self.fOriginTime = None
+
+    def __repr__(self):
+        return "CommandFuture({!r}, {!r}, {!r})".format(
+            self.iTransactionNumber,
+            self.rPayload,
+            self.tExpect)
+
+    def matches(self, dMessage):
+        rKind = dMessage.get("fn", dMessage.get("type"))
+        if rKind not in self.tExpect:
+            return False
+        for rKey, mValue in self.dMatch.iteritems():
+            if dMessage.get(rKey) != mValue:
+                return False
+        return True
+
+    def add_done_callback(self, fnCallback):
+        if self.bDone:
+            fnCallback(self)
+        else:
+            self.lCallbacks.append(fnCallback)
+
+    def set_result(self, dResponse):
+        if self.bDone:
+            return
+        self.bDone = True
+        self.dResponse = dResponse
+        if self.sTimer is not None:
+            self.sTimer.cancel()
+        for fnCallback in self.lCallbacks:
+            fnCallback(self)
+        del self.lCallbacks[:]
+
+    def done(self):
+        return self.bDone
+
+    def kind(self):
+        """Kind of response this command is answered by, for the purposes
+        of `LatencyEstimator`."""
+        if self.tExpect:
+            return self.tExpect[0]
+        return "ack"
+
+# =============================================================================
+class CommandScheduler(object):
+    """
+    Commands waiting for the rate limiter. Released in priority order (lowest
+    number first), and in submission order within a priority.
+
+    A command with the same coalescing key (see `coalesce_key`) as one
+    already waiting is merged into it: the waiting command takes the newer
+    payload and the more urgent priority, and keeps its queue position if
+    that is earlier.
+
+    :IVariables:
+        lHeap : list
+            Heap of `[iPriority, iSequence, rKey, CommandFuture]` entries.
+            Entries superseded by a priority change remain in the heap, but
+            are skipped because `dWaiting` no longer refers to them.
+        dWaiting : dict
+            Maps coalescing key to the live `lHeap` entry for that key.
+        siSequence : int generator
+            Source of `iSequence` values.
+        iCoalesced : int
+            Number of commands merged into one already waiting.
+    """
+    def __init__(self):
+        import itertools
+        import re
+        self.lHeap = []
+        self.dWaiting = {}
+        self.siSequence = itertools.count()
+        self.iCoalesced = 0
+        self.sSetTarget = re.compile(r"^(!R\d+F\*t)P")
+
+    def __len__(self):
+        return len(self.dWaiting)
+
+    def coalesce_key(self, rPayload):
+        """Commands with equal keys are interchangeable, if they have not
+        yet been transmitted. Set-target commands for a room supersede each
+        other, so only the latest is sent. Otherwise only identical commands
+        are interchangeable."""
+        sMatch = self.sSetTarget.match(rPayload)
+        if sMatch:
+            return sMatch.group(1)
+        return rPayload
+
+    def merge(self, rKey, rPayload, iPriority):
+        """Return the waiting future for `rKey`, updated to send `rPayload`
+        at (at least) `iPriority`, or None if nothing is waiting for it."""
+        import heapq
+        lEntry = self.dWaiting.get(rKey)
+        if lEntry is None:
+            return None
+        sFuture = lEntry[3]
+        if sFuture.bDone:
+            # Answered by a late reply while awaiting retransmission
+            del self.dWaiting[rKey]
+            return None
+        sFuture.rPayload = rPayload
+        if iPriority < lEntry[0]:
+            lNewEntry = [iPriority, lEntry[1], rKey, sFuture]
+            self.dWaiting[rKey] = lNewEntry
+            heapq.heappush(self.lHeap, lNewEntry)
+        self.iCoalesced += 1
+        return sFuture
+
+    def push(self, rKey, sFuture, iPriority):
+        import heapq
+        lEntry = [iPriority, self.siSequence.next(), rKey, sFuture]
+        self.dWaiting[rKey] = lEntry
+        heapq.heappush(self.lHeap, lEntry)
+
+    def pop(self):
+        """Remove and return the most urgent waiting future, or None."""
+        import heapq
+        while self.lHeap:
+            lEntry = heapq.heappop(self.lHeap)
+            if self.dWaiting.get(lEntry[2]) is lEntry:
+                del self.dWaiting[lEntry[2]]
+                return lEntry[3]
+        return None
 
 # =============================================================================
 class LightwaveLink(object):
     """
     :IVariables:
+        sLoop : EventLoop
+            Event loop on which responses are received, commands are
+            transmitted, and futures are resolved.
         sSock : socket.socket
-            UDP/IP socket used for both transmitting commands to the Lightwave
-            Link and receiving responses. Note that responses are received on a
-            different port number than commands are sent on.
+            Non-blocking UDP/IP socket used for both transmitting commands to
+            the Lightwave Link and receiving responses. Note that responses
+            are received on a different port number than commands are sent
+            on.
         rAddress : str
             IPv4 dotted decimal representation of the Lightwave Link's IP
-            address if known. Initially set to the broadcast address,
-            `255.255.255.255`.
+            address. Defaults to `DEFAULT_ADDRESS`.
         siTransactionNumber : int generator
             Generator object which yields integers with monotonically
             increasing values. These are used to give every command transmitted
             a unique transaction number. Experiment has shown the Lightwave
             Link will not respond, at all, if the command lacks a transaction
             number.
-        sResponses : queue.Queue
-            Sequence of messages received from the Lightwave Link. Note that
-            because the Lightwave Link broadcasts all its responses, the
-            responses may not be related to any commands sent by us.
-        sLock : threading.RLock
-            Mutual exclusion (mutex) lock that guards access to attributes.
+        sRouter : MessageRouter
+            Dispatches each message received from the Lightwave Link which
+            did not answer a pending `CommandFuture`, plus all device status
+            messages (see `STATUS_FNS`). Note that because the Lightwave Link
+            broadcasts all its responses, most are unrelated to commands sent
+            by us. Messages the router ignores are not decoded, unless a
+            pending future expects them.
+        dPending : collections.OrderedDict
+            Maps transaction number to `CommandFuture` for commands still
+            awaiting a response, oldest first.
+        dExpecting : collections.Counter
+            Number of futures in `dPending` expecting each message kind (see
+            `CommandFuture.tExpect`).
+        dRenumbered : dict
+            Maps the transaction numbers of earlier transmissions of futures
+            in `dPending` to those futures, so that late replies to them are
+            still recognised.
+        sScheduler : CommandScheduler
+            Futures of commands waiting for the rate limiter.
+        dLatest : dict
+            Maps coalescing key (see `CommandScheduler.coalesce_key`) to the
+            newest unresolved future for that key, whether waiting, in
+            flight or awaiting retransmission. A failed command is only
+            retransmitted if no newer one has superseded it.
+        sSendTimer : Timer
+            Transmits the most urgent command in `sScheduler` once the rate
+            limit allows, or None if `sScheduler` is empty.
+        sDuplicates : DuplicateFilter
+            Recently received datagrams, used to discard duplicates.
+        sCapture : DatagramLog
+            If not None, every datagram received is appended to it.
+        iReceiveBuffer : int
+            Requested size of `sSock`'s kernel receive buffer (SO_RCVBUF),
+            or None for the system default.
+        sBuffer : bytearray
+            Reused for every datagram received, see `on_readable`.
+        sIngest : IngestQueue
+            Messages for `sRouter`, dispatched from the event loop once the
+            current burst has been received.
+        sDrainTimer : Timer
+            Pending `drain`, or None if `sIngest` is empty.
         fLastCommandTime : float
-            Unixtime when last command was issued. Used to implement rate
-            limiting.
+            Unixtime when last command was issued.
+        sRateLimit : TokenBucket
+            Paces commands to what the Lightwave Link tolerates.
         iLastTransactionNumber : int
             Most recently transmitted transaction number sent by
             `send_command`.
@@ -74,40 +1091,142 @@ class LightwaveLink(object):
             Most recently transmitted command string sent by `send_command`.
             Used to retransmit in response to "Transmit fail" errors from the
             Lightwave Link.
+        dResponseDelay : dict
+            Maps response "fn" to seconds between the most recent such
+            response and the command it answered.
+        dResponseCount : collections.Counter
+            Number of responses to our commands received, by "fn". At most
+            `MAX_RESPONSE_FNS` are distinguished, further ones are counted
+            as `OTHER_FN`, as are their delays and round trips.
+        dResponseTime : dict
+            Maps response "fn" to unixtime of the latest such response.
+        iFnOverflow : int
+            Number of responses counted as `OTHER_FN`.
+        sLatency : LatencyEstimator
+            Response latency by kind, from which command timeouts are
+            derived.
+        iRetransmissions : int
+            Number of commands retransmitted after a timeout or "Transmit
+            fail" error.
+        iFailures : int
+            Number of commands abandoned after exhausting their retries.
+        iTransmitFailReplies : int
+            Number of plain-text "Transmit fail" errors yet to be followed by
+            their JSON counterpart.
+        dRoundTrip : dict
+            Maps response "fn" to `Histogram` of seconds between the
+            (latest) transmission of a command and its response.
+        sRateLimitWait : Histogram
+            Seconds each transmission was held back by the rate limit.
+        sQueueWait : Histogram
+            Seconds commands spent in `sScheduler` before transmission.
+        sQueueDepth : Histogram
+            Number of commands already in `sScheduler` when another joined.
+        sProcessing : Histogram
+            Seconds spent handling each datagram received, up to queueing
+            its message in `sIngest`.
+        sIngestWait : Histogram
+            Seconds each message spent in `sIngest` before being
+            dispatched.
+        sDispatch : Histogram
+            Seconds spent dispatching each message to `sRouter`'s
+            handlers.
+        sHeatCallLatency : Histogram
+            Seconds from a change in demand (e.g. a valve's "statusPush")
+            to the boiler command it prompted being transmitted.
     """
     LIGHTWAVE_LINK_COMMAND_PORT = 9760    # Send to this address...
     LIGHTWAVE_LINK_RESPONSE_PORT = 9761   # ... and get response on this one
-    MIN_SECONDS_BETWEEN_COMMANDS = 2
-    COMMAND_TIMEOUT_SECONDS = 15
-
-    fLastCommandTime = ProtectedAttribute()
-    iLastTransactionNumber = ProtectedAttribute()
-    rLastCommand = ProtectedAttribute()
-
-    sPResponseDelay = prometheus_client.Gauge(
-        "lwl_response_delay_seconds",
-        "Time between command being issued and response being recieved",
-        ["fn",],
-        )
-    sPResponseCounter = prometheus_client.Counter(
-        "lwl_responses",
-        "Number of distinct JSON message received",
-        ["fn",],
-        )
-
-    def __init__(self):
-        import threading
-        self.sSock = self.create_socket()
-        self.rAddress = "192.168.167.114"
-        self.siTransactionNumber = self.sequence_generator()
-        self.sResponses = self.create_listener(self.sSock)
-        self.sLock = threading.RLock()
+    DEFAULT_ADDRESS = "192.168.167.114"
+    COMMAND_RATE = 0.5          # Per second, until the Link is understood
+    MIN_COMMAND_RATE = 0.1
+    MAX_COMMAND_RATE = 5.0
+    COMMAND_BURST = 2
+
+    # Command priorities for `send_command`, most urgent first
+    PRIORITY_BOILER = 0     # Switching the boiler on/off
+    PRIORITY_SETPOINT = 1   # Anything else which changes or queries the Link
+    PRIORITY_POLL = 2       # Refreshing device status
+    COMMAND_TIMEOUT_SECONDS = 15        # Until latency has been measured
+    MIN_COMMAND_TIMEOUT_SECONDS = 2
+    MAX_COMMAND_TIMEOUT_SECONDS = 60    # After backoff
+    COMMAND_RETRIES = 3
+    RETRY_BACKOFF_SECONDS = 1           # Doubled for each further attempt
+    TRANSMIT_FAIL = "Transmit fail"
+    MAX_DATAGRAMS_PER_WAKEUP = 64   # Bound time spent away from timers
+    MAX_DATAGRAM_SIZE = 2048        # Larger than any Link message seen
+    INGEST_QUEUE_SIZE = 256
+    DUPLICATE_WINDOW_SECONDS = 5.0
+    DUPLICATE_CACHE_SIZE = 1024
+    MAX_RESPONSE_FNS = 16           # Bound the cardinality of "fn" labels
+    OTHER_FN = "other"
+
+    # Messages carrying device status. Always passed to `sRouter`, even
+    # when they also answer a pending command, as they feed `TRVStatus`.
+    STATUS_FNS = ("read", "statusPush", "statusOn", "statusOff")
+
+    def __init__(self, sLoop, rAddress=DEFAULT_ADDRESS, iReceiveBuffer=None,
+                 sSock=None):
+        import collections
+        self.sLoop = sLoop
+        self.dPending = collections.OrderedDict()
+        self.dExpecting = collections.Counter()
+        self.dRenumbered = {}
+        self.siExpectationNumber = self.sequence_generator(-1, -1)
+        self.sScheduler = CommandScheduler()
+        self.dLatest = {}
+        self.sSendTimer = None
+        self.sDuplicates = DuplicateFilter(
+            self.DUPLICATE_WINDOW_SECONDS,
+            self.DUPLICATE_CACHE_SIZE,
+            sLoop.time)
         self.fLastCommandTime = 0.0
+        self.sRateLimit = TokenBucket(
+            self.COMMAND_RATE,
+            self.COMMAND_BURST,
+            self.MIN_COMMAND_RATE,
+            self.MAX_COMMAND_RATE)
         self.iLastTransactionNumber = 0
         self.rLastCommand = ""
-        self.sThead = None
+        self.dResponseDelay = {}
+        self.dResponseCount = collections.Counter()
+        self.dResponseTime = {}
+        self.iFnOverflow = 0
+        self.sLatency = LatencyEstimator(
+            self.COMMAND_TIMEOUT_SECONDS,
+            self.MIN_COMMAND_TIMEOUT_SECONDS,
+            self.COMMAND_TIMEOUT_SECONDS)
+        self.iRetransmissions = 0
+        self.iFailures = 0
+        self.iTransmitFailReplies = 0
+        self.dRoundTrip = collections.defaultdict(Histogram)
+        self.sRateLimitWait = Histogram()
+        self.sQueueWait = Histogram()
+        self.sQueueDepth = Histogram(Histogram.DEPTH_BOUNDS)
+        self.sProcessing = Histogram()
+        self.sIngestWait = Histogram()
+        self.sDispatch = Histogram()
+        self.sHeatCallLatency = Histogram()
+        self.sRouter = MessageRouter()
+        self.sCapture = None
+        self.iReceiveBuffer = iReceiveBuffer
+        self.sBuffer = bytearray(self.MAX_DATAGRAM_SIZE)
+        self.sIngest = IngestQueue(self.INGEST_QUEUE_SIZE)
+        self.sDrainTimer = None
+        self.rAddress = rAddress
+        self.siTransactionNumber = self.sequence_generator()
+        if sSock is None:
+            # Receive on our own socket, rather than via `LinkMultiplexer`
+            sSock = self.create_socket()
+            if sSock is not None:
+                self.sLoop.add_reader(sSock.fileno(), self.on_readable)
+        self.sSock = sSock
 
     def create_socket(self):
+        return self.open_socket(self.iReceiveBuffer)
+
+    @classmethod
+    def open_socket(cls, iReceiveBuffer=None):
         """Create a listening socket to receive UDP messages from the Lightwave
         Link"""
         import socket
@@ -116,45 +1235,144 @@ class LightwaveLink(object):
             socket.SOCK_DGRAM)
         tLocalAddress = (
             "0.0.0.0",
-            self.LIGHTWAVE_LINK_RESPONSE_PORT)
+            cls.LIGHTWAVE_LINK_RESPONSE_PORT)
         sSock.bind(tLocalAddress)
         sSock.setsockopt(
             socket.SOL_SOCKET, 
             socket.SO_BROADCAST,
             1)
+        if iReceiveBuffer:
+            # Room for bursts of unicast+broadcast pairs while we are busy
+            sSock.setsockopt(
+                socket.SOL_SOCKET,
+                socket.SO_RCVBUF,
+                iReceiveBuffer)
+        sSock.setblocking(False)
         return sSock
 
+    def get_receive_buffer(self):
+        """Return the size of `sSock`'s kernel receive buffer, in bytes.
+        (Linux reports double the size requested, to allow for overhead.)"""
+        import socket
+        return self.sSock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+
+    def get_receive_drops(self):
+        """Return the number of datagrams the kernel has dropped for `sSock`,
+        e.g. because its receive buffer was full, or None if unknown (only
+        Linux reports this, in /proc/net/udp)."""
+        import os
+        iInode = os.fstat(self.sSock.fileno()).st_ino
+        try:
+            with open("/proc/net/udp", "r") as sFH:
+                next(sFH)   # Header
+                for rLine in sFH:
+                    lFields = rLine.split()
+                    # ... uid timeout inode ref pointer drops
+                    if int(lFields[9]) == iInode:
+                        return int(lFields[-1])
+        except (IOError, IndexError, ValueError):
+            pass
+        return None
+
     @staticmethod
-    def sequence_generator(iInt=None):
-        import time
+    def sequence_generator(iInt=None, iStep=1):
         if not iInt:
             iInt = 100
         while True:
             yield iInt
-            iInt += 1
+            iInt += iStep
+
+    def send_command(self, rPayload, iTransactionNumber=None, tExpect=(),
+                     dMatch=None, iPriority=PRIORITY_SETPOINT,
+                     iRetries=COMMAND_RETRIES):
+        """Queue `rPayload` for transmission, subject to rate limiting and
+        `iPriority`, and return a `CommandFuture` for its response without
+        waiting. See `CommandFuture` for the meaning of `tExpect` and
+        `dMatch`. The command is retransmitted up to `iRetries` times if it
+        times out or the Link reports "Transmit fail".
+
+        If an equivalent command is already waiting (see
+        `CommandScheduler.coalesce_key`) it is updated instead, and its
+        future returned."""
+        rKey = self.sScheduler.coalesce_key(rPayload)
+        sFuture = self.sScheduler.merge(rKey, rPayload, iPriority)
+        if sFuture is not None:
+            sLog.debug("Coalesced %s into %r", rPayload, sFuture)
+            return sFuture
 
-    def send_command(self, rPayload, iTransactionNumber=None):
-        import time
+        if iTransactionNumber is None:
+            iTransactionNumber = self.siTransactionNumber.next()
+
+        sFuture = CommandFuture(
+            iTransactionNumber,
+            rPayload,
+            tExpect,
+            dMatch,
+            iPriority,
+            iRetries)
+        self.add_pending(sFuture)
+        self.dLatest[rKey] = sFuture
+        sFuture.add_done_callback(lambda x: self.forget_latest(rKey, x))
+        self.enqueue(rKey, sFuture)
+        return sFuture
+
+    def forget_latest(self, rKey, sFuture):
+        if self.dLatest.get(rKey) is sFuture:
+            del self.dLatest[rKey]
+
+    def enqueue(self, rKey, sFuture):
+        self.sQueueDepth.observe(len(self.sScheduler))
+        sFuture.fQueuedTime = self.sLoop.time()
+        self.sScheduler.push(rKey, sFuture, sFuture.iPriority)
+        self.schedule_transmit()
+
+    def schedule_transmit(self):
+        if self.sSendTimer is not None or not self.sScheduler:
+            return
 
-        # Rate-limit
-        fNow = time.time()
-        fNext = self.fLastCommandTime + self.MIN_SECONDS_BETWEEN_COMMANDS
-        fWait = fNext - fNow
+        fWait = self.sRateLimit.delay(self.sLoop.time())
         if fWait > 0.0:
             sLog.log(5, "Rate limit send_command(): %s", fWait)
-            time.sleep(fWait)
-
-        if iTransactionNumber is None:
-            iTransactionNumber = self.siTransactionNumber.next()
+        self.sRateLimitWait.observe(fWait)
+        self.sSendTimer = self.sLoop.call_later(fWait, self.transmit)
+
+    def transmit(self):
+        self.sSendTimer = None
+        sFuture = self.sScheduler.pop()
+        while sFuture is not None and sFuture.bDone:
+            # Answered by a late reply while awaiting retransmission
+            sFuture = self.sScheduler.pop()
+        if sFuture is None:
+            return
 
-        with self.sLock:
-            self.iLastTransactionNumber = iTransactionNumber
-            self.fLastCommandTime = time.time()
-            self.rLastCommand = rPayload
+        if sFuture.iAttempts:
+            self.renumber(sFuture)
+        self.iLastTransactionNumber = sFuture.iTransactionNumber
+        self.fLastCommandTime = self.sLoop.time()
+        self.sRateLimit.take(self.fLastCommandTime)
+        self.rLastCommand = sFuture.rPayload
+        sFuture.fSentTime = self.fLastCommandTime
+        sFuture.iAttempts += 1
+        sFuture.bInFlight = True
+        self.sQueueWait.observe(self.fLastCommandTime - sFuture.fQueuedTime)
+        if sFuture.fOriginTime is not None and sFuture.iAttempts == 1:
+            self.sHeatCallLatency.observe(
+                self.fLastCommandTime - sFuture.fOriginTime)
+
+        # Exponential backoff of the timeout for retransmissions
+        fTimeout = min(
+            self.sLatency.timeout(sFuture.kind())
+            * 2 ** (sFuture.iAttempts - 1),
+            self.MAX_COMMAND_TIMEOUT_SECONDS)
+        sFuture.sTimer = self.sLoop.call_later(
+            fTimeout,
+            self.fail,
+            sFuture,
+            "timeout")
 
         rCommand = "{},{}".format(
-            iTransactionNumber,
-            rPayload)
+            sFuture.iTransactionNumber,
+            sFuture.rPayload)
         tDestinationAddress = (
             self.rAddress,
             self.LIGHTWAVE_LINK_COMMAND_PORT)
@@ -162,91 +1380,303 @@ class LightwaveLink(object):
             "send_command(%s, %s)",
             rCommand,
             tDestinationAddress)
+        try:
+            self.send_datagram(rCommand, tDestinationAddress)
+        finally:
+            self.schedule_transmit()
+
+    def send_datagram(self, rCommand, tDestinationAddress):
         self.sSock.sendto(
             rCommand, 
             tDestinationAddress)
 
-    def get_response(self):
-        import time
-        try:
-            fTimeout = (
-                        self.COMMAND_TIMEOUT_SECONDS
-                        + time.time() 
-                        - self.fLastCommandTime 
-                        )
-            dResponse = self.sResponses.get(True, fTimeout)
-            fDelay = time.time() - self.fLastCommandTime
-            rFn = dResponse.get("fn", "")
-            self.sPResponseDelay.labels(rFn).set(fDelay)
-            self.sPResponseCounter.labels(rFn).inc()
-            return dResponse
-        except self.sResponses.Empty:
-            return {}
-
-    def create_listener(self, sSock):
-        import threading
-        import Queue as queue
-        sQueue = queue.Queue()
-        sQueue.Empty = queue.Empty
-        def run():
-            """Responses are send twice, once unicast and another broadcast.
-            This makes duplicate messages very common."""
-            import json
-            import collections
-            # nonlocal sSock
-            # nonlocal sQueue
-            iTransactionNumber = 0
-            lPreviousMessages = collections.deque(maxlen=10)
-            while True:
-                rMessage = sSock.recv(1024)
-                if rMessage in lPreviousMessages:
-                    sLog.log(1, "Ignoring duplicate JSON message")
-                    continue
-                lPreviousMessages.appendleft(rMessage)
-                sLog.log(2, "RAW response: %s", rMessage)
-                if rMessage.startswith("*!{"):
-                    rJSON = rMessage[len("*!"):]
-                    dMessage = json.loads(rJSON)
-                    iResponseTrans = int(dMessage.get("trans", 0))
-                    #if iResponseTrans > iTransactionNumber:
-                    if True:
-                        iTransactionNumber = iResponseTrans
-                        sQueue.put(dMessage)
-                    else:
-                        sLog.log(
-                            1, 
-                            "Discarding duplicate trans: %s", 
-                            iResponseTrans)
-                elif rMessage.strip().endswith(",OK"):
-                    sLog.log(1, "Ignoring acknowledgement")
-                else:
-                    sLog.warning(
-                        "Discarding non-JSON response: %s",
-                        rMessage)
-        def runner():
-            # nonlocal run
-            # nonlocal sLog
-            while True:
-                # pylint: disable=bare-except
-                try:
-                    run()
-                except:
-                    sLog.error(
-                        "Exception from Lightwave Listener thread",
-                        exc_info=True)
-
-        self.sThread = threading.Thread(
-            target=runner,
-            name="LightwaveLink Listener"
-            )
-        self.sThread.daemon = True   # Do not prevent process exit()
-        self.sThread.start()
-        return sQueue
+    def add_pending(self, sFuture):
+        self.dPending[sFuture.iTransactionNumber] = sFuture
+        self.dExpecting.update(sFuture.tExpect)
+
+    def remove_pending(self, sFuture):
+        if self.dPending.pop(sFuture.iTransactionNumber, None) is not None:
+            self.dExpecting.subtract(sFuture.tExpect)
+        for iTrans in sFuture.lEarlierNumbers:
+            self.dRenumbered.pop(iTrans, None)
+
+    def renumber(self, sFuture):
+        """Give `sFuture` a new transaction number to be retransmitted with.
+        Otherwise a second "Transmit fail" would repeat the first, byte for
+        byte, and be discarded by `sDuplicates`."""
+        iTrans = sFuture.iTransactionNumber
+        if self.dPending.pop(iTrans, None) is None:
+            return
+        sFuture.lEarlierNumbers.append(iTrans)
+        self.dRenumbered[iTrans] = sFuture
+        sFuture.iTransactionNumber = self.siTransactionNumber.next()
+        self.dPending[sFuture.iTransactionNumber] = sFuture
+
+    def abandon(self, sFuture):
+        self.remove_pending(sFuture)
+        sLog.debug("No response to %r", sFuture)
+        sFuture.set_result({})
+
+    def fail(self, sFuture, rReason):
+        """Retransmit `sFuture`'s command after a backoff, if its retries are
+        not exhausted, otherwise abandon it."""
+        if sFuture.bDone or not sFuture.bInFlight:
+            return  # e.g. the JSON copy of a text "Transmit fail" error
+        sFuture.bInFlight = False
+        sFuture.sTimer.cancel()
+        self.sRateLimit.failed(sFuture.fSentTime, self.sLoop.time())
+        if sFuture.iAttempts > sFuture.iRetries:
+            sLog.warn(
+                "Giving up on %r after %s attempts (%s)",
+                sFuture,
+                sFuture.iAttempts,
+                rReason)
+            self.iFailures += 1
+            self.abandon(sFuture)
+            return
+
+        fBackoff = self.RETRY_BACKOFF_SECONDS * 2 ** (sFuture.iAttempts - 1)
+        sLog.info(
+            "Retrying %r in %ss (%s)",
+            sFuture,
+            fBackoff,
+            rReason)
+        self.iRetransmissions += 1
+        sFuture.sTimer = self.sLoop.call_later(
+            fBackoff,
+            self.retransmit,
+            sFuture)
+
+    def retransmit(self, sFuture):
+        if sFuture.bDone:
+            return
+        rKey = self.sScheduler.coalesce_key(sFuture.rPayload)
+        sNewest = self.dLatest.get(rKey, sFuture)
+        if sNewest is sFuture:
+            self.enqueue(rKey, sFuture)
+            return
 
-    def test_connectivity(self):
+        # An equivalent (or, for set-target, newer) command has been sent or
+        # is waiting since, so let its response stand for ours rather than
+        # resending what may now be a stale setting
+        def chain(sNewer):
+            self.remove_pending(sFuture)
+            sFuture.fResponseTime = sNewer.fResponseTime
+            sFuture.set_result(sNewer.dResponse)
+        sNewest.add_done_callback(chain)
+
+    def expect(self, tExpect, dMatch=None, fTimeout=None):
+        """Return a `CommandFuture` resolved by the next message matching
+        `tExpect` and `dMatch`, without sending a command. Used for messages
+        the Lightwave Link sends of its own accord, e.g. pairing success."""
+        if fTimeout is None:
+            fTimeout = self.COMMAND_TIMEOUT_SECONDS
+        iKey = self.siExpectationNumber.next()
+        sFuture = CommandFuture(iKey, "", tExpect, dMatch)
+        sFuture.fSentTime = self.sLoop.time()
+        sFuture.sTimer = self.sLoop.call_later(fTimeout, self.abandon, sFuture)
+        self.add_pending(sFuture)
+        return sFuture
+
+    def complete(self, sFuture, dResponse):
+        """Resolve `sFuture` with `dResponse`, which has just arrived."""
+        self.remove_pending(sFuture)
+        sFuture.fResponseTime = self.sLoop.time()
+        fDelay = sFuture.fResponseTime - sFuture.fSentTime
+        if sFuture.iAttempts == 1:
+            # Only unambiguous samples: a response to a retransmitted command
+            # may be to any of its transmissions (Karn's algorithm)
+            self.sLatency.sample(sFuture.kind(), fDelay)
+        rFn = dResponse.get("fn", "")
+        if rFn == "error":
+            self.sRateLimit.failed(sFuture.fSentTime, sFuture.fResponseTime)
+        else:
+            self.sRateLimit.succeeded()
+        if (rFn not in self.dResponseCount
+                and len(self.dResponseCount) >= self.MAX_RESPONSE_FNS):
+            rFn = self.OTHER_FN
+            self.iFnOverflow += 1
+        self.dResponseTime[rFn] = sFuture.fResponseTime
+        self.dResponseDelay[rFn] = fDelay
+        self.dResponseCount[rFn] += 1
+        self.dRoundTrip[rFn].observe(fDelay)
+        sFuture.set_result(dResponse)
+
+    def get_response(self, sFuture):
+        """Run the event loop until `sFuture` resolves and return its
+        response, or an empty dict on timeout."""
+        self.sLoop.run_until(sFuture.done)
+        return sFuture.dResponse
+
+    def request(self, rPayload, tExpect=(), dMatch=None):
+        """Send `rPayload` and wait for its response. See `get_response`."""
+        return self.get_response(
+            self.send_command(rPayload, tExpect=tExpect, dMatch=dMatch))
+
+    def resolve(self, dMessage):
+        """Pass `dMessage` to the oldest pending `CommandFuture` it answers.
+        Prefers a future whose transaction number equals the message's, in
+        case the Link echoed ours. Returns True if a future was resolved."""
+        iTrans = dMessage.get("trans")
+        sFound = None
+        for iKey, sFuture in self.dPending.iteritems():
+            if sFuture.fSentTime is None:
+                continue    # Not yet transmitted, cannot be answered
+            if sFuture.matches(dMessage) and (
+                    sFound is None or iKey == iTrans):
+                sFound = sFuture
+        if sFound is None:
+            return False
+        self.complete(sFound, dMessage)
+        return True
+
+    def resolve_reply(self, rMessage):
+        """Resolve the pending future, if any, for a plain-text reply such as
+        "101,OK" or "0,ERR,2,..." which echoes our transaction number. Only
+        futures not expecting a JSON message are resolved this way."""
+        rTrans, _, rRest = rMessage.strip().partition(",")
+        try:
+            iTrans = int(rTrans)
+        except ValueError:
+            return False
+        sFuture = self.dPending.get(iTrans) or self.dRenumbered.get(iTrans)
+        if sFuture is None or sFuture.fSentTime is None:
+            return False
+        if self.TRANSMIT_FAIL in rRest:
+            # The Link did not get the command through to the device. A late
+            # failure of an earlier transmission says nothing of the latest
+            self.iTransmitFailReplies += 1
+            if iTrans == sFuture.iTransactionNumber:
+                self.fail(sFuture, rRest)
+            return True
+        if sFuture.tExpect:
+            return False
+        if rRest.startswith("ERR"):
+            dReply = {"trans": iTrans, "fn": "error", "payload": rRest}
+        else:
+            dReply = {"trans": iTrans, "fn": "ack", "payload": rRest}
+        self.complete(sFuture, dReply)
+        return True
+
+    def resolve_transmit_fail(self, dMessage):
+        """JSON "Transmit fail" errors carry the Link's own transaction
+        number rather than ours. They normally follow a plain-text error
+        naming our transaction, which has already been handled, otherwise
+        they are attributed to the last command sent."""
+        if (dMessage.get("pkt") != "error"
+                or self.TRANSMIT_FAIL not in dMessage.get("payload", "")):
+            return False
+        if self.iTransmitFailReplies:
+            self.iTransmitFailReplies -= 1
+            return True
+        sFuture = self.dPending.get(self.iLastTransactionNumber)
+        if sFuture is not None:
+            self.fail(sFuture, dMessage["payload"])
+        return True
+
+    def on_readable(self):
+        """Drain datagrams waiting on `sSock` into `sBuffer`, then handle
+        them as a batch. Draining several per wakeup means handlers can
+        defer work (e.g. `call_for_heat`) with `EventLoop.call_soon` until a
+        burst has been processed."""
+        self.handle_batch(self.receive(self.sSock, self.sBuffer))
+
+    @classmethod
+    def receive(cls, sSock, sBuffer):
+        """Return `[(rMessage, tAddress), ...]` for the datagrams waiting on
+        non-blocking `sSock`, up to `MAX_DATAGRAMS_PER_WAKEUP`, each read
+        into `sBuffer`."""
+        import errno
+        import socket
+        sView = memoryview(sBuffer)
+        lBatch = []
+        for _ in xrange(cls.MAX_DATAGRAMS_PER_WAKEUP):
+            try:
+                iBytes, tAddress = sSock.recvfrom_into(sBuffer)
+            except socket.error as sError:
+                if sError.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            lBatch.append((sView[:iBytes].tobytes(), tAddress))
+        return lBatch
+
+    def handle_batch(self, lBatch):
+        """Handle `[(rMessage, tAddress), ...]` received together."""
+        for rMessage, tAddress in lBatch:
+            fStart = self.sLoop.time()
+            if self.sCapture is not None:
+                self.sCapture.write(fStart, tAddress, rMessage)
+            self.sLoop.dispatch(self.handle_datagram, (rMessage,))
+            self.sProcessing.observe(self.sLoop.time() - fStart)
+
+    def handle_datagram(self, rMessage):
+        """Responses are send twice, once unicast and another broadcast.
+        This makes duplicate messages very common."""
+        import json
+        if self.sDuplicates.is_duplicate(rMessage):
+            sLog.log(1, "Ignoring duplicate JSON message")
+            return
+        sLog.log(2, "RAW response: %s", rMessage)
+        if rMessage.startswith("*!{"):
+            rJSON = rMessage[len("*!"):]
+            dFields = self.sRouter.peek(rJSON)
+            if (self.sRouter.is_ignored(dFields)
+                    and not self.dExpecting[
+                        dFields.get("fn", dFields.get("type"))] > 0):
+                sLog.log(1, "Ignoring message without decoding: %s", dFields)
+                return
+            dMessage = json.loads(rJSON)
+            if self.resolve_transmit_fail(dMessage):
+                sLog.log(1, "Transmit fail: %s", dMessage)
+                return
+            bResolved = self.resolve(dMessage)
+            if (not bResolved
+                    or dMessage.get("fn") in self.STATUS_FNS):
+                self.ingest(dMessage)
+        elif self.resolve_reply(rMessage):
+            sLog.log(1, "Reply to pending command: %s", rMessage)
+        elif rMessage.strip().endswith(",OK"):
+            sLog.log(1, "Ignoring acknowledgement")
+        else:
+            sLog.warning(
+                "Discarding non-JSON response: %s",
+                rMessage)
+
+    def ingest(self, dMessage):
+        """Queue `dMessage` for `sRouter`. Status messages of the same kind
+        (e.g. "statusPush") for a device still queued are coalesced, so only
+        its latest is dispatched. Kinds are kept apart, as e.g.
+        `StaleDeviceScheduler` learns from pushes alone."""
+        mKey = None
+        if dMessage.get("fn") in self.STATUS_FNS and "serial" in dMessage:
+            mKey = ("serial", dMessage["serial"], dMessage["fn"])
+        if not self.sIngest.put(dMessage, mKey, self.sLoop.time()):
+            sLog.warn("Ingest queue full, discarding: %s", dMessage)
+        if self.sDrainTimer is None and self.sIngest:
+            self.sDrainTimer = self.sLoop.call_soon(self.drain)
+
+    def drain(self):
+        self.sDrainTimer = None
+        sIngest = self.sIngest
+        while sIngest:
+            dMessage, fQueued = sIngest.pop()
+            fStart = self.sLoop.time()
+            self.sIngestWait.observe(fStart - fQueued)
+            self.sLoop.dispatch(self.sRouter.dispatch, (dMessage,))
+            self.sDispatch.observe(self.sLoop.time() - fStart)
+
+    def hub_call(self):
+        """Send a hub call, without waiting. See `test_connectivity`."""
+        return self.send_command("@H", tExpect=("hubCall", "nonRegistered"))
+
+    def test_connectivity(self, sHubCall=None):
+        """Check that we are registered with the Link, registering if not.
+        `sHubCall` is the future of a hub call already sent by `hub_call`,
+        e.g. to several Links at once, else one is sent now."""
         sLog.info("Checking if this host is registered with Lightwave Link...")
-        self.send_command("@H") # Hub call
-        dResponse = self.get_response()
+        if sHubCall is None:
+            sHubCall = self.hub_call()
+        dResponse = self.get_response(sHubCall)
 
         # Sample successful response from hub-call:
         # TODO: Account for non-zero timeZone, which offsets the timestamps by
@@ -310,11 +1740,11 @@ class LightwaveLink(object):
             "prod":"lwl", "pairType":"local", "msg":"success", "class":"",
             "serial":""}
         """
-        import time
         try:
             while True:
-                self.send_command("!F*p")
-                dResponse = self.get_response()
+                dResponse = self.request(
+                    "!F*p",
+                    tExpect=("nonRegistered", "link"))
                 if dResponse.get("fn") == "nonRegistered":
                     sLog.info(
                         "Pairing request sent. Please push button with "
@@ -328,34 +1758,97 @@ class LightwaveLink(object):
                         "To fix this you will need to use a device already "
                         "registered with the Link to de-authorise all devices "
                         "and individually re-authorise them.")
-                    time.sleep(3)
-                elif dResponse.get("msg") == "success":
+                    # Success is announced whenever the button is pushed,
+                    # not in reply to a command
+                    dResponse = self.get_response(
+                        self.expect(("link",), fTimeout=3))
+                if dResponse.get("msg") == "success":
                     sLog.info("Successfully paired!")
                     return True
         except KeyboardInterrupt:
             sLog.warn("Aborting registration process due to SIGINT")
             return False
 
-    def scan_devices(self):
+    def query_devices(self, sSummary=None):
+        """Ask every room the Link lists to describe itself and report its
+        status, without waiting for them. `sSummary` is the future of a
+        summary already requested by `request_summary`, e.g. from several
+        Links at once, else one is requested now. Returns a list of
+        `(iRoom, future of its description)`."""
         sLog.info("Query LightwaveLink for list of known devices...")
         while True:
             try:
-                lRooms = self.enumerate_devices()
+                lRooms = self.enumerate_devices(sSummary)
                 break
             except KeyError:
                 # Indicates the response was not understood
-                pass
+                sSummary = None
         sLog.info("%s devices", len(lRooms))
-        for i, iDevice in enumerate(lRooms):
-            sLog.info("Asking room #%s to provide status update...", iDevice)
-            # Get device info (serial + room in same JSON response!)
-            self.send_command("@?R{}".format(iDevice))
-            # Request status report from device
-            self.send_command("!R{}F*r".format(iDevice))
-
-    def enumerate_devices(self):
-        self.send_command("@R")
-        dResponse = self.get_response()
+        return [(iDevice, self.query_device(iDevice)) for iDevice in lRooms]
+
+    def scan_devices(self, lQueries=None):
+        """Wait for every room to describe itself. `lQueries` is as returned
+        by `query_devices`, which is called now if None."""
+        if lQueries is None:
+            lQueries = self.query_devices()
+        for iDevice, sFuture in lQueries:
+            if not self.get_response(sFuture):
+                sLog.warn("Room #%s did not describe itself", iDevice)
+
+    def discover_devices(self, iKnownRooms):
+        """Like `scan_devices`, but without waiting, and only querying rooms
+        not in `iKnownRooms`. Used when device state was restored from a
+        snapshot. Returns the future of the Link's list of rooms."""
+        sKnownRooms = set(iKnownRooms)
+
+        def on_summary(sFuture):
+            try:
+                lRooms = self.parse_summary(sFuture.dResponse)
+            except KeyError:
+                sLog.warn("Lightwave Link did not list its devices")
+                return
+            lNewRooms = [x for x in lRooms if x not in sKnownRooms]
+            sLog.info(
+                "%s devices, %s not yet known",
+                len(lRooms),
+                len(lNewRooms))
+            for iDevice in lNewRooms:
+                self.query_device(iDevice)
+
+        sFuture = self.send_command(
+            "@R",
+            tExpect=("summary",),
+            iPriority=self.PRIORITY_POLL)
+        sFuture.add_done_callback(on_summary)
+        return sFuture
+
+    def query_device(self, iDevice):
+        """Ask room `iDevice` to describe itself and report its status.
+        Returns the future for the description."""
+        sLog.info("Asking room #%s to provide status update...", iDevice)
+        # Get device info (serial + room in same JSON response!)
+        sFuture = self.send_command(
+            "@?R{}".format(iDevice),
+            tExpect=("read",),
+            dMatch={"slot": iDevice},
+            iPriority=self.PRIORITY_POLL)
+        # Request status report from device
+        self.send_command(
+            "!R{}F*r".format(iDevice),
+            iPriority=self.PRIORITY_POLL)
+        return sFuture
+
+    def request_summary(self):
+        """Ask the Link which rooms it has, without waiting."""
+        return self.send_command("@R", tExpect=("summary",))
+
+    def enumerate_devices(self, sSummary=None):
+        if sSummary is None:
+            sSummary = self.request_summary()
+        return self.parse_summary(self.get_response(sSummary))
+
+    @staticmethod
+    def parse_summary(dResponse):
         """ Sample response:
         {u'fn': u'summary',
          u'mac': u'20:3B:85',
@@ -384,6 +1877,113 @@ class LightwaveLink(object):
         sLog.debug("Rooms known to hub: %s", lRooms)
         return lRooms
 
+class ReplayLink(LightwaveLink):
+    """
+    Stand-in for `LightwaveLink` which has no socket: datagrams are fed to
+    `handle_datagram` by `replay`, and commands are recorded rather than
+    transmitted.
+
+    Captured plain-text replies, and "Transmit fail" errors, answer the
+    captured session's commands, whose transaction numbers ours coincide
+    with, so they are ignored rather than resolving or failing ours.
+
+    :IVariables:
+        lSent : list
+            `(fTime, rCommand)` for each command "transmitted".
+    """
+    def __init__(self, sLoop):
+        self.lSent = []
+        LightwaveLink.__init__(self, sLoop)
+
+    def create_socket(self):
+        return None
+
+    def send_datagram(self, rCommand, tDestinationAddress):
+        del tDestinationAddress
+        sLog.info("Replay: command %s", rCommand)
+        self.lSent.append((self.sLoop.time(), rCommand))
+
+    def resolve_reply(self, rMessage):
+        sLog.log(1, "Replay: ignoring captured reply %s", rMessage)
+        return True
+
+    def resolve_transmit_fail(self, dMessage):
+        return (dMessage.get("pkt") == "error"
+                and self.TRANSMIT_FAIL in dMessage.get("payload", ""))
+
+class LinkMultiplexer(object):
+    """
+    One receive socket shared by several `LightwaveLink`s (e.g. one per
+    heating zone), each of which has its own rate limiter, pending commands
+    and so on. Each datagram is handed to the Link which sent it, by source
+    address or, failing that (e.g. the Link's address has changed), by the
+    "mac" of JSON messages. MAC addresses are learnt from messages whose
+    source address is known.
+
+    :IVariables:
+        sLoop : EventLoop
+            Loop on which `sSock` is read.
+        sSock : socket.socket
+            Non-blocking socket bound to the response port, also used by
+            every Link to transmit.
+        sBuffer : bytearray
+            Reused for every datagram received.
+        dByAddress : dict
+            Maps IPv4 address to `LightwaveLink`.
+        dByMac : dict
+            Maps MAC address, as given in messages, to `LightwaveLink`.
+        sMac : re.RegexObject
+            Extracts the MAC address from a JSON message without decoding it.
+        iUnrouted : int
+            Number of datagrams from no known Link, which are discarded.
+    """
+    def __init__(self, sLoop, iReceiveBuffer=None):
+        import re
+        self.sLoop = sLoop
+        self.sSock = LightwaveLink.open_socket(iReceiveBuffer)
+        self.sBuffer = bytearray(LightwaveLink.MAX_DATAGRAM_SIZE)
+        self.dByAddress = {}
+        self.dByMac = {}
+        self.sMac = re.compile(r'"mac":\s*"([^"]*)"')
+        self.iUnrouted = 0
+        sLoop.add_reader(self.sSock.fileno(), self.on_readable)
+
+    def add(self, rAddress):
+        """Return a new `LightwaveLink` for the Link at `rAddress`, receiving
+        via this multiplexer."""
+        sLink = LightwaveLink(self.sLoop, rAddress, sSock=self.sSock)
+        self.dByAddress[rAddress] = sLink
+        return sLink
+
+    def route(self, rMessage, tAddress):
+        """Return the `LightwaveLink` which sent `rMessage`, or None."""
+        sLink = self.dByAddress.get(tAddress[0])
+        sMatch = self.sMac.search(rMessage)
+        if sMatch is None:
+            return sLink
+        rMac = sMatch.group(1)
+        if sLink is None:
+            return self.dByMac.get(rMac)
+        if rMac not in self.dByMac:
+            sLog.info("Lightwave Link %s has MAC %s", sLink.rAddress, rMac)
+            self.dByMac[rMac] = sLink
+        return sLink
+
+    def on_readable(self):
+        import collections
+        dBatches = collections.OrderedDict()
+        for rMessage, tAddress in LightwaveLink.receive(
+                self.sSock, self.sBuffer):
+            sLink = self.route(rMessage, tAddress)
+            if sLink is None:
+                self.iUnrouted += 1
+                sLog.debug("Datagram from unknown Link %s: %s",
+                    tAddress, rMessage)
+                continue
+            dBatches.setdefault(sLink, []).append((rMessage, tAddress))
+        for sLink, lBatch in dBatches.iteritems():
+            sLink.handle_batch(lBatch)
+
 class TRVStatus(object):
     """
     Sample status from 868R Thermostatic Radiator Valve (TRV)::
@@ -417,44 +2017,33 @@ class TRVStatus(object):
         "serial":"DCC302",
         "prod":"valve"}
 
+    Instances have a fixed set of attributes (`__slots__`), those listed in
+    `FIELDS` plus our own. Any other fields the Lightwave Link sends are kept
+    in `dExtra`, so that an unexpected key cannot grow every instance.
     """
     # pylint: disable=too-many-instance-attributes
 
-    sPbatt = prometheus_client.Gauge(
-        "lwl_battery_volts",
-        "Battery voltage, in range 0.0-4.0 (inc.). 2.4V is considered "
-        "'low', 3.0V+ is considered full'",
-        ['serial', 'name', 'product'],
-        )
-    sPcTargC = prometheus_client.Gauge(
-        "lwl_target_celsius",
-        "0.0-40.0 current target temperature",
-        ['serial', 'name', 'product'],
-        )
-    sPcTargR = prometheus_client.Gauge(
-        "lwl_target_ratio",
-        "0.0-1.0 current target valve output",
-        ['serial', 'name', 'product'],
-        )
-    sPcTemp = prometheus_client.Gauge(
-        "lwl_current_celsius",
-        "0.0-60.0 current temperature",
-        ['serial', 'name', 'product'],
-        )
-    sPoutput = prometheus_client.Gauge(
-        "lwl_output_ratio",
-        "0.0-1.0 where 0=valve fully closed, 1=valve fully open",
-        ['serial', 'name', 'product'],
-        )
-    sPtime = prometheus_client.Gauge(
-        "lwl_time",
-        "Unixtime of most recently received status update",
-        ['serial', 'name', 'product'],
+    # Fields of statusPush and read messages stored as attributes
+    FIELDS = (
+        "batt", "cTarg", "cTemp", "fn", "mac", "nSlot", "nTarg", "output",
+        "pkt", "prod", "prof", "serial", "state", "time", "trans", "type",
+        "ver", "slot",
         )
+    FIELD_SET = frozenset(FIELDS)
+
+    __slots__ = FIELDS + (
+        "rName", "fSeen", "rDemand", "rDemandReason", "dExtra")
+
+    # Values of `rDemand`
+    DEMAND_NONE = "n/a"         # Not a valve
+    DEMAND_CALLING = "calling"
+    DEMAND_IDLE = "idle"
+    DEMAND_STALE = "stale"
 
     def __init__(self, rName):
         # Local data
         self.rName = rName
+        self.fSeen = None   # Unixtime of the last message from the device
 
         # Data from Lightwave Link statusPush messages
         self.batt = None
@@ -478,30 +2067,74 @@ class TRVStatus(object):
         # Data unique to room messages (query device info from hub)
         self.slot = None
 
-    def update(self, dStatus):
+        # Derived data, see `get_demand`
+        self.rDemand = None
+        self.rDemandReason = None
+
+        # Data from Lightwave Link messages not listed in FIELDS
+        self.dExtra = {}
+
+    def as_dict(self):
+        """Return the fields received from the Lightwave Link, such that
+        passing them to `update` of a new instance recreates this one."""
+        dStatus = dict(self.dExtra)
+        for rKey in self.FIELDS:
+            mValue = getattr(self, rKey)
+            if mValue is not None:
+                dStatus[rKey] = mValue
+        return dStatus
+
+    def update(self, dStatus, fNow):
+        """Apply message `dStatus`, received at unixtime `fNow`. Returns
+        `(rOldDemand, rNewDemand)` if this changed the device's demand for
+        heat, otherwise None."""
         for rKey, mValue in dStatus.iteritems():
-            setattr(self, rKey, mValue)
-
-        if dStatus["fn"] == "read":
-            # Do not update prometheus metrics - not a status update
-            return
-
-        tLabels = (self.serial, self.rName, self.prod)
-        self.sPbatt.labels(*tLabels).set(self.batt)
-        self.sPcTemp.labels(*tLabels).set(self.cTemp)
-        self.sPoutput.labels(*tLabels).set(self.output / 100.0)
-
-        # We treat target temperature and target output as different metrics
-        # because their units are different.
-        if self.cTarg < 50.0:
-            self.sPcTargC.labels(*tLabels).set(self.cTarg)
-            self.sPcTargR.labels(*tLabels).set(float("NaN"))
-        else:
-            fRatio = (self.cTarg - 50) / (60-50)
-            self.sPcTargC.labels(*tLabels).set(float("NaN"))
-            self.sPcTargR.labels(*tLabels).set(fRatio)
-
-        self.sPtime.labels(*tLabels).set(self.time)
+            if rKey in self.FIELD_SET:
+                setattr(self, rKey, mValue)
+            else:
+                self.dExtra[rKey] = mValue
+        self.fSeen = fNow
+
+        return self.reevaluate(fNow)
+
+    def reevaluate(self, fNow):
+        """Recompute `rDemand` as of unixtime `fNow`. Returns
+        `(rOldDemand, rNewDemand)` if it changed, otherwise None."""
+        rOldDemand = self.rDemand
+        self.rDemand, self.rDemandReason = self.get_demand(fNow)
+        if self.rDemand == rOldDemand:
+            return None
+        return (rOldDemand, self.rDemand)
+
+    def get_demand(self, fNow):
+        """Return `(rDemand, rReason)`, where `rDemand` is one of the
+        `DEMAND_*` constants, and `rReason` explains it."""
+        fStaleThreshold = fNow - STALE_THRESHOLD_SECONDS
+
+        # Special values for current target temperature:
+        #   50.0-60.0: 0-100% valve
+
+        if self.prod != "valve":
+            return self.DEMAND_NONE, "n/a (not a valve)"
+        elif 50 <= self.output:
+            return self.DEMAND_CALLING, "calling for heat, valve open >= 50%"
+        elif 0 == self.output:
+            return self.DEMAND_IDLE, "ignored, valve closed"
+        elif 0 < self.output < 50:
+            return (
+                self.DEMAND_IDLE,
+                "ignored, valve open, but less than 50%")
+        elif self.time < fStaleThreshold:
+            return self.DEMAND_STALE, "ignored, stale status"
+        elif self.cTarg == 50.0:
+            return self.DEMAND_IDLE, "ignored, target OFF (50.0)"
+        elif self.cTarg > 50.0:
+            return (
+                self.DEMAND_CALLING,
+                "calling for heat, explicit non-zero valve opening (>50.0)")
+        #elif self.cTarg < 50.0 and self.cTarg > self.cTemp:
+        #    return self.DEMAND_CALLING, "ambient temp below target"
+        return self.DEMAND_IDLE, "(default)"
 
     def get_battery_level_str(self):
         fBatt = self.batt
@@ -588,11 +2221,327 @@ class TRVStatus(object):
                 **dLocals
                 ))
 
+class LightwaveCollector(object):
+    """
+    Prometheus collector which builds every `lwl_*` metric family from device
+    and Lightwave Link state when scraped, so that receiving a message
+    involves no metrics work at all.
+
+    When serving several Links (see `add`), link-level metrics are labelled
+    with the Link's address. With one, they keep the label sets they have
+    always had.
+
+    Label sets not updated within `fTTL` seconds, e.g. of a device which has
+    been removed or replaced, or a response "fn" no longer seen, are no
+    longer exported, so that they do not accumulate in the TSDB.
+
+    :IVariables:
+        lSources : list
+            `(dStatus, sLink)` for each Link, where `dStatus` maps serial to
+            `TRVStatus`, as maintained by `HeatingController`, and `sLink`
+            is the source of link-level statistics.
+        fTTL : float
+            Seconds after its last update for which a label set is
+            exported, or 0 to export them indefinitely.
+        sEvicted : set
+            Label sets currently not exported because of `fTTL`.
+        iEvictions : int
+            Number of times a label set has been evicted.
+    """
+    DEVICE_LABELS = ["serial", "name", "product"]
+
+    def __init__(self, dStatus, sLink, fTTL=SERIES_TTL_SECONDS):
+        self.lSources = [(dStatus, sLink)]
+        self.fTTL = fTTL
+        self.sEvicted = set()
+        self.iEvictions = 0
+
+    def add(self, dStatus, sLink):
+        self.lSources.append((dStatus, sLink))
+
+    def is_live(self, tLabels, fUpdated, fNow):
+        """Return whether to export label set `tLabels`, last updated at
+        unixtime `fUpdated` (None if not known)."""
+        if not self.fTTL or fUpdated is None or fNow - fUpdated <= self.fTTL:
+            self.sEvicted.discard(tLabels)
+            return True
+        if tLabels not in self.sEvicted:
+            self.sEvicted.add(tLabels)
+            self.iEvictions += 1
+        return False
+
+    def collect(self):
+        # pylint: disable=too-many-locals
+        from prometheus_client.core import (
+            GaugeMetricFamily,
+            CounterMetricFamily,
+            )
+
+        sBatt = GaugeMetricFamily(
+            "lwl_battery_volts",
+            "Battery voltage, in range 0.0-4.0 (inc.). 2.4V is considered "
+            "'low', 3.0V+ is considered full'",
+            labels=self.DEVICE_LABELS)
+        sTargC = GaugeMetricFamily(
+            "lwl_target_celsius",
+            "0.0-40.0 current target temperature",
+            labels=self.DEVICE_LABELS)
+        sTargR = GaugeMetricFamily(
+            "lwl_target_ratio",
+            "0.0-1.0 current target valve output",
+            labels=self.DEVICE_LABELS)
+        sTemp = GaugeMetricFamily(
+            "lwl_current_celsius",
+            "0.0-60.0 current temperature",
+            labels=self.DEVICE_LABELS)
+        sOutput = GaugeMetricFamily(
+            "lwl_output_ratio",
+            "0.0-1.0 where 0=valve fully closed, 1=valve fully open",
+            labels=self.DEVICE_LABELS)
+        sTime = GaugeMetricFamily(
+            "lwl_time",
+            "Unixtime of most recently received status update",
+            labels=self.DEVICE_LABELS)
+
+        lDevices = []
+        for dStatus, sLink in self.lSources:
+            fNow = sLink.sLoop.time()
+            lDevices.extend((x, fNow) for x in dStatus.itervalues())
+        for sDevice, fNow in lDevices:
+            if (sDevice.batt is None
+                    and sDevice.cTemp is None
+                    and sDevice.output is None):
+                continue    # No status update received yet, only a "read"
+
+            lLabels = [
+                unicode(sDevice.serial),
+                unicode(sDevice.rName),
+                unicode(sDevice.prod),
+                ]
+            if not self.is_live(tuple(lLabels), sDevice.time, fNow):
+                continue
+            if sDevice.batt is not None:
+                sBatt.add_metric(lLabels, sDevice.batt)
+            if sDevice.cTemp is not None:
+                sTemp.add_metric(lLabels, sDevice.cTemp)
+            if sDevice.output is not None:
+                sOutput.add_metric(lLabels, sDevice.output / 100.0)
+
+            # We treat target temperature and target output as different
+            # metrics because their units are different.
+            if sDevice.cTarg is None:
+                pass
+            elif sDevice.cTarg < 50.0:
+                sTargC.add_metric(lLabels, sDevice.cTarg)
+                sTargR.add_metric(lLabels, float("NaN"))
+            else:
+                fRatio = (sDevice.cTarg - 50) / (60-50)
+                sTargC.add_metric(lLabels, float("NaN"))
+                sTargR.add_metric(lLabels, fRatio)
+
+            if sDevice.time is not None:
+                sTime.add_metric(lLabels, sDevice.time)
+
+        for sFamily in (sBatt, sTargC, sTargR, sTemp, sOutput, sTime):
+            yield sFamily
+
+        for sFamily in self.collect_links():
+            yield sFamily
+
+        yield CounterMetricFamily(
+            "lwl_metric_evictions",
+            "Number of times a label set stopped being exported because it "
+            "had not been updated within the TTL",
+            value=self.iEvictions)
+
+        yield CounterMetricFamily(
+            "lwl_event_log_records",
+            "Number of records queued for the event log",
+            value=sEventLog.iRecorded)
+        yield CounterMetricFamily(
+            "lwl_event_log_dropped",
+            "Number of records discarded because the event log's writer "
+            "thread had fallen behind",
+            value=sEventLog.iDropped)
+
+    def collect_links(self):
+        from prometheus_client.core import (
+            GaugeMetricFamily,
+            CounterMetricFamily,
+            HistogramMetricFamily,
+            )
+        if len(self.lSources) > 1:
+            lLinkLabels = ["link"]
+            lLinks = [([unicode(x.rAddress)], x) for _, x in self.lSources]
+        else:
+            lLinkLabels = []
+            lLinks = [([], x) for _, x in self.lSources]
+
+        sDelay = GaugeMetricFamily(
+            "lwl_response_delay_seconds",
+            "Time between command being issued and response being recieved",
+            labels=lLinkLabels + ["fn"])
+        sResponses = CounterMetricFamily(
+            "lwl_responses",
+            "Number of distinct JSON message received",
+            labels=lLinkLabels + ["fn"])
+        sSmoothed = GaugeMetricFamily(
+            "lwl_response_latency_smoothed_seconds",
+            "Smoothed response latency, by kind of response",
+            labels=lLinkLabels + ["fn"])
+        sTimeout = GaugeMetricFamily(
+            "lwl_command_timeout_seconds",
+            "Current timeout before retransmitting a command, by kind of "
+            "response",
+            labels=lLinkLabels + ["fn"])
+        sRoundTrip = HistogramMetricFamily(
+            "lwl_command_round_trip_seconds",
+            "Time between a command being transmitted and its response "
+            "being received",
+            labels=lLinkLabels + ["fn"])
+        for lLink, sLink in lLinks:
+            fNow = sLink.sLoop.time()
+            for rFn, iCount in sLink.dResponseCount.iteritems():
+                lLabels = lLink + [rFn]
+                if not self.is_live(
+                        tuple(lLabels), sLink.dResponseTime.get(rFn), fNow):
+                    continue
+                sResponses.add_metric(lLabels, iCount)
+                sDelay.add_metric(lLabels, sLink.dResponseDelay[rFn])
+                sHistogram = sLink.dRoundTrip[rFn]
+                sRoundTrip.add_metric(
+                    lLabels,
+                    sHistogram.buckets(),
+                    sHistogram.fSum)
+            sLatency = sLink.sLatency
+            for rKind, lEstimate in sLatency.dEstimates.iteritems():
+                sSmoothed.add_metric(lLink + [rKind], lEstimate[0])
+                sTimeout.add_metric(
+                    lLink + [rKind],
+                    sLatency.timeout(rKind))
+        for sFamily in (sDelay, sResponses, sSmoothed, sTimeout, sRoundTrip):
+            yield sFamily
+
+        for cFamily, rName, rHelp, fnValue in (
+                (CounterMetricFamily, "lwl_dedupe_hits",
+                 "Number of datagrams discarded as duplicates",
+                 lambda sLink: sLink.sDuplicates.iHits),
+                (CounterMetricFamily, "lwl_dedupe_misses",
+                 "Number of datagrams not seen within the duplicate window",
+                 lambda sLink: sLink.sDuplicates.iMisses),
+                (CounterMetricFamily, "lwl_dedupe_evictions",
+                 "Number of datagrams forgotten before their duplicate "
+                 "window lapsed, due to the duplicate cache being full",
+                 lambda sLink: sLink.sDuplicates.iEvictions),
+                (CounterMetricFamily, "lwl_commands_coalesced",
+                 "Number of commands merged into an equivalent command "
+                 "already waiting to be transmitted",
+                 lambda sLink: sLink.sScheduler.iCoalesced),
+                (GaugeMetricFamily, "lwl_ingest_queue_length",
+                 "Number of messages received but not yet dispatched",
+                 lambda sLink: len(sLink.sIngest)),
+                (CounterMetricFamily, "lwl_ingest_coalesced",
+                 "Number of status messages merged into a newer one for the "
+                 "same device before dispatch",
+                 lambda sLink: sLink.sIngest.iCoalesced),
+                (CounterMetricFamily, "lwl_ingest_dropped",
+                 "Number of messages discarded due to the ingest queue being "
+                 "full",
+                 lambda sLink: sLink.sIngest.iDropped),
+                (CounterMetricFamily, "lwl_commands_retransmitted",
+                 "Number of commands retransmitted after a timeout or "
+                 "\"Transmit fail\" error",
+                 lambda sLink: sLink.iRetransmissions),
+                (CounterMetricFamily, "lwl_commands_failed",
+                 "Number of commands abandoned after exhausting their "
+                 "retries",
+                 lambda sLink: sLink.iFailures),
+                (GaugeMetricFamily, "lwl_command_queue_length",
+                 "Number of commands waiting to be transmitted",
+                 lambda sLink: len(sLink.sScheduler)),
+                (CounterMetricFamily, "lwl_response_fn_overflow",
+                 "Number of responses counted as fn=\"other\", once the "
+                 "limit on distinct fns had been reached",
+                 lambda sLink: sLink.iFnOverflow),
+                (GaugeMetricFamily, "lwl_command_rate",
+                 "Commands per second the rate limiter currently allows, "
+                 "adapted to failures and responses",
+                 lambda sLink: sLink.sRateLimit.fRate),
+                (GaugeMetricFamily, "lwl_command_tokens",
+                 "Commands the rate limiter would allow to be sent at once",
+                 lambda sLink: sLink.sRateLimit.tokens(sLink.sLoop.time())),
+                ):
+            sFamily = cFamily(rName, rHelp, labels=lLinkLabels)
+            for lLink, sLink in lLinks:
+                sFamily.add_metric(lLink, fnValue(sLink))
+            yield sFamily
+
+        for rName, rHelp, rAttribute in (
+                ("lwl_rate_limit_wait_seconds",
+                 "Time each transmission was held back by the rate limit",
+                 "sRateLimitWait"),
+                ("lwl_command_queue_wait_seconds",
+                 "Time commands spent queued before transmission",
+                 "sQueueWait"),
+                ("lwl_command_queue_depth",
+                 "Number of commands already queued when another joined",
+                 "sQueueDepth"),
+                ("lwl_datagram_processing_seconds",
+                 "Time spent handling each datagram received, up to queueing "
+                 "it for dispatch",
+                 "sProcessing"),
+                ("lwl_ingest_wait_seconds",
+                 "Time each message waited in the ingest queue before "
+                 "dispatch",
+                 "sIngestWait"),
+                ("lwl_dispatch_seconds",
+                 "Time spent dispatching each message to its handlers",
+                 "sDispatch"),
+                ("lwl_heat_call_latency_seconds",
+                 "Time from a change in demand to the boiler command it "
+                 "prompted being transmitted",
+                 "sHeatCallLatency"),
+                ):
+            sFamily = HistogramMetricFamily(rName, rHelp, labels=lLinkLabels)
+            for lLink, sLink in lLinks:
+                sHistogram = getattr(sLink, rAttribute)
+                sFamily.add_metric(
+                    lLink,
+                    sHistogram.buckets(),
+                    sHistogram.fSum)
+            yield sFamily
+
+        # Only one socket is ever used to receive, even if shared by several
+        # Links (see `LinkMultiplexer`)
+        lReceivers = [x for _, x in lLinks if x.sSock is not None]
+        if lReceivers:
+            sLink = lReceivers[0]
+            yield GaugeMetricFamily(
+                "lwl_socket_receive_buffer_bytes",
+                "Size of the kernel receive buffer for datagrams from the "
+                "Lightwave Link",
+                value=sLink.get_receive_buffer())
+            iDrops = sLink.get_receive_drops()
+            if iDrops is not None:
+                yield CounterMetricFamily(
+                    "lwl_socket_receive_drops",
+                    "Number of datagrams from the Lightwave Link dropped by "
+                    "the kernel, e.g. due to a full receive buffer",
+                    value=iDrops)
+
 def load_config():
+    """Read config.yml, returning `(dConfig, lZones)`: `dConfig` maps serial
+    to device name, and `lZones` lists the heating zones for `HeatingZones`
+    (see `parse_zones`), or is None for files which only name devices."""
     import yaml
     with file("config.yml", "r") as sFH:
         dConfig = yaml.load(sFH)
 
+    dZones = None
+    if "devices" in dConfig or "zones" in dConfig:
+        dZones = dConfig.get("zones") or {}
+        dConfig = dConfig.get("devices") or {}
+
     numeric_serials=[key for key in dConfig.keys() if key != str(key)]
     if numeric_serials:
         sLog.info(
@@ -609,173 +2558,1533 @@ def load_config():
         sLog.info("* Ensure serial strings are all 6 characters long")
         sLog.info("* Enclose serial strings starting with a 0 in quotes")
 
-    return dConfig
+    lZones = None
+    if dZones:
+        lZones = parse_zones(dZones, dConfig)
+    return dConfig, lZones
 
-def call_for_heat(sLink, dStatus):
-    lCalling = are_calling_for_heat(dStatus)
+def parse_zones(dZones, dConfig):
+    """
+    Validate the "zones" section of config.yml, which maps zone name to:
+
+        switch: Serial (or name) of the device switching the zone's boiler
+            or zone valve. One zone may omit this, and use the device named
+            `HeatDemandTracker.BOILER_NAME`.
+        valves: Serials (or names) of the zone's valves. One zone may omit
+            this, and take every valve not in another zone.
+        threshold: Number of valves which must call for heat to turn the
+            switch on (default: 1).
+        min_on, min_off: Minimum number of seconds for which the switch is
+            left on/off before we switch it again (default: 0).
+        link: IPv4 address of the Lightwave Link the zone's devices are
+            paired with, when controlling several (see `assign_zones`).
+
+    Returns a list of keyword arguments for `HeatDemandTracker`, each with
+    an extra "lValves" (None for the catch-all zone) and "rLink" (None if
+    not given).
+    """
+    dSerials = {rName: rSerial for rSerial, rName in dConfig.iteritems()}
+    def resolve(mDevice):
+        rDevice = str(mDevice)
+        return dSerials.get(rDevice, rDevice)
+
+    lZones = []
+    dValves = {}    # Serial to zone name
+    lCatchAll = []
+    lNamedSwitch = []
+    for rName, dZone in sorted(dZones.iteritems()):
+        rName = str(rName)
+        dZone = dict(dZone or {})
+        lUnknown = set(dZone) - set(
+            ["switch", "valves", "threshold", "min_on", "min_off", "link"])
+        if lUnknown:
+            raise ValueError("Zone '{}' has unknown keys {}".format(
+                rName, ", ".join(sorted(lUnknown))))
+
+        rSwitch = None
+        if dZone.get("switch") is not None:
+            rSwitch = resolve(dZone["switch"])
+        else:
+            lNamedSwitch.append(rName)
+
+        lValves = None
+        if dZone.get("valves") is not None:
+            lValves = [resolve(x) for x in dZone["valves"]]
+            for rSerial in lValves:
+                if rSerial in dValves:
+                    raise ValueError(
+                        "Valve {} is in zones '{}' and '{}'".format(
+                            rSerial, dValves[rSerial], rName))
+                dValves[rSerial] = rName
+        else:
+            lCatchAll.append(rName)
+
+        iThreshold = int(dZone.get("threshold", 1))
+        fMinOn = float(dZone.get("min_on", 0))
+        fMinOff = float(dZone.get("min_off", 0))
+        if iThreshold < 1 or fMinOn < 0 or fMinOff < 0:
+            raise ValueError(
+                "Zone '{}' needs threshold >= 1 and min_on, min_off "
+                ">= 0".format(rName))
+
+        lZones.append({
+            "rName": rName,
+            "rSwitch": rSwitch,
+            "lValves": lValves,
+            "rLink": None if dZone.get("link") is None else str(dZone["link"]),
+            "iThreshold": iThreshold,
+            "fMinOn": fMinOn,
+            "fMinOff": fMinOff,
+            })
+
+    if len(lCatchAll) > 1:
+        raise ValueError("Only one zone may omit 'valves', not {}".format(
+            ", ".join(lCatchAll)))
+    if len(lNamedSwitch) > 1:
+        raise ValueError("Only one zone may omit 'switch', not {}".format(
+            ", ".join(lNamedSwitch)))
+    return lZones
+
+def assign_zones(lZones, lAddresses):
+    """Return a dict mapping each address in `lAddresses` (given by
+    `--link-address`, or `[None]`) to the zones of `lZones` (see
+    `parse_zones`) which that Link controls, so that no Link tries to
+    switch another's devices. A single Link controls every zone. Several
+    Links each control the zones which name them with "link", and those
+    without any zone only report their devices. If `lZones` is None, every
+    Link has the single zone of config files which only name devices."""
+    if lZones is None:
+        return {x: None for x in lAddresses}
+    dZones = {x: [] for x in lAddresses}
+    for dZone in lZones:
+        rLink = dZone["rLink"]
+        if len(lAddresses) == 1 and (lAddresses[0] is None or rLink is None):
+            dZones[lAddresses[0]].append(dZone)
+        elif rLink in dZones:
+            dZones[rLink].append(dZone)
+        elif rLink is None:
+            raise ValueError(
+                "Zone '{}' needs 'link', the address of one of the Lightwave "
+                "Links given by --link-address".format(dZone["rName"]))
+        else:
+            raise ValueError(
+                "Zone '{}' is on Lightwave Link {}, which is not given by "
+                "--link-address".format(dZone["rName"], rLink))
+    return dZones
+
+def check_zones(lControllers):
+    """Raise ValueError if a device configured in a zone of one
+    `HeatingController` has been found on another's Lightwave Link, as a
+    Link can only switch its own devices."""
+    for sController in lControllers:
+        sZones = sController.sZones
+        dZones = dict(sZones.dAssigned)
+        dZones.update(sZones.dSwitches)
+        for sOther in lControllers:
+            if sOther is sController:
+                continue
+            for rSerial, sZone in sorted(dZones.iteritems()):
+                if rSerial in sOther.dStatus:
+                    raise ValueError(
+                        "Zone '{}' is on Lightwave Link {}, but its device {} "
+                        "is paired with {}".format(
+                            sZone.rName,
+                            sController.sLink.rAddress,
+                            rSerial,
+                            sOther.sLink.rAddress))
+
+def save_snapshot(rPath, dStatus, sLink):
+    """Write the state of every device heard from within
+    `SNAPSHOT_TTL_SECONDS`, with when it was last heard from ("seen"), and
+    the Lightwave Link's address and learnt command rate, to `rPath` for
+    `load_snapshot`. The file is replaced atomically, so a crash mid-write
+    leaves the previous snapshot intact."""
+    import json
+    import os
+    fNow = sLink.sLoop.time()
+    dSnapshot = {
+        "version": SNAPSHOT_VERSION,
+        "time": fNow,
+        "address": sLink.rAddress,
+        "rate": sLink.sRateLimit.fRate,
+        "devices": [
+            dict(x.as_dict(), seen=x.fSeen)
+            for x in dStatus.itervalues()
+            if x.fSeen >= fNow - SNAPSHOT_TTL_SECONDS],
+        }
+    rTempPath = rPath + ".tmp"
+    with open(rTempPath, "w") as sFH:
+        json.dump(dSnapshot, sFH, indent=1, sort_keys=True)
+        sFH.flush()
+        os.fsync(sFH.fileno())
+    os.rename(rTempPath, rPath)
+    sLog.debug("Saved %s devices to %s", len(dSnapshot["devices"]), rPath)
+
+def load_snapshot(rPath):
+    """Return the snapshot written by `save_snapshot`, or None if there is
+    no usable one."""
+    import errno
+    import json
+    try:
+        with open(rPath, "r") as sFH:
+            dSnapshot = json.load(sFH)
+    except IOError as sError:
+        if sError.errno != errno.ENOENT:
+            sLog.warn("Unable to read snapshot %s: %s", rPath, sError)
+        return None
+    except ValueError as sError:
+        sLog.warn("Ignoring corrupt snapshot %s: %s", rPath, sError)
+        return None
+    if dSnapshot.get("version") != SNAPSHOT_VERSION:
+        sLog.warn("Ignoring snapshot %s of unknown version", rPath)
+        return None
+    return dSnapshot
+
+def save_snapshot_periodically(rPath, dStatus, sLink):
+    try:
+        save_snapshot(rPath, dStatus, sLink)
+    except (IOError, OSError) as sError:
+        sLog.warn("Unable to save snapshot %s: %s", rPath, sError)
+    sLink.sLoop.call_later(
+        SNAPSHOT_INTERVAL_SECONDS,
+        save_snapshot_periodically,
+        rPath,
+        dStatus,
+        sLink)
+
+class HeatDemandTracker(object):
+    """
+    Heating zone: incrementally maintained set of the zone's valves calling
+    for heat, fed with the demand transitions reported by `TRVStatus.update`,
+    so that deciding whether its switch should be on costs the same however
+    many devices there are.
 
-    for sDevice in dStatus.itervalues():
-        if sDevice.rName == "Boiler switch":
-            break
-    else:
+    :IVariables:
+        rName : str
+            Name of the zone, from config.yml.
+        rSwitch : str
+            Serial of the device switching the zone's boiler or zone valve,
+            or None for the device named `BOILER_NAME`.
+        iThreshold : int
+            Number of valves which must call for heat to turn the switch on.
+        fMinOn : float
+            Minimum number of seconds the switch is left on before we turn
+            it off.
+        fMinOff : float
+            Minimum number of seconds the switch is left off before we turn
+            it on.
+        dCalling : dict
+            Maps serial to `TRVStatus` for devices calling for heat.
+        sSwitch : TRVStatus
+            Device which switches the zone, or None if not (yet) seen.
+        bChanged : bool
+            Set when whether the zone wants heat, or its switch's own status,
+            has changed since `call_for_heat` last acted.
+        fChangedTime : float
+            Unixtime of the earliest such change, or None if not known.
+        fSwitchedTime : float
+            Unixtime at which we last commanded the switch, or None.
+        sHold : Timer
+            Pending `call_for_heat` held back by `fMinOn`/`fMinOff`, if any.
+        sDescribe : CommandFuture
+            Latest request for the Link to describe its rooms, made because
+            the room of `sSwitch` was not yet known, or None.
+    """
+    BOILER_NAME = "Boiler switch"
+
+    def __init__(self, rName="heating", rSwitch=None, iThreshold=1,
+                 fMinOn=0.0, fMinOff=0.0):
+        self.rName = rName
+        self.rSwitch = rSwitch
+        self.iThreshold = iThreshold
+        self.fMinOn = fMinOn
+        self.fMinOff = fMinOff
+        self.dCalling = {}
+        self.sSwitch = None
+        self.bChanged = True
+        self.fChangedTime = None
+        self.fSwitchedTime = None
+        self.sHold = None
+        self.sDescribe = None
+
+    def add_switch(self, sDevice):
+        self.sSwitch = sDevice
+        self.bChanged = True
+
+    def update(self, sDevice, tTransition, fNow):
+        """Account for `sDevice` having been updated at `fNow`, which changed
+        its demand if `tTransition` is not None."""
+        if sDevice is self.sSwitch:
+            self.changed(fNow)
+        if tTransition is None:
+            return
+
+        sLog.debug(
+            "Calling for heat: %s: %s",
+            sDevice.rName,
+            sDevice.rDemandReason)
+        sEventLog.record("demand", fNow, {
+            "zone": self.rName,
+            "name": sDevice.rName,
+            "serial": sDevice.serial,
+            "demand": sDevice.rDemand,
+            "reason": sDevice.rDemandReason,
+            })
+        bWanted = self.wants_heat()
+        if sDevice.rDemand == sDevice.DEMAND_CALLING:
+            self.dCalling[sDevice.serial] = sDevice
+        else:
+            self.dCalling.pop(sDevice.serial, None)
+        if self.wants_heat() != bWanted:
+            self.changed(fNow)
+
+    def changed(self, fNow):
+        self.bChanged = True
+        if self.fChangedTime is None:
+            self.fChangedTime = fNow
+
+    def wants_heat(self):
+        return len(self.dCalling) >= self.iThreshold
+
+    def hold_until(self, bHeat):
+        """Return the unixtime before which the switch must not be turned on
+        (if `bHeat`) or off, given when we last switched it."""
+        if self.fSwitchedTime is None:
+            return 0.0
+        if bHeat:
+            return self.fSwitchedTime + self.fMinOff
+        return self.fSwitchedTime + self.fMinOn
+
+class HeatingZones(object):
+    """
+    Every heating zone, indexed by the serials of their devices so that a
+    status update only touches, and only re-evaluates, its own zone.
+
+    :IVariables:
+        dZones : collections.OrderedDict
+            Maps zone name to `HeatDemandTracker`.
+        dAssigned : dict
+            Maps serial to the zone configured for that valve.
+        dSwitches : dict
+            Maps serial to the zone configured for that switch.
+        sDefault : HeatDemandTracker
+            Zone of valves not assigned to another, or None.
+        sNamedSwitch : HeatDemandTracker
+            Zone switched by the device named
+            `HeatDemandTracker.BOILER_NAME`, or None.
+        dMembers : dict
+            Maps serial to the zone of which that device, once seen, is a
+            valve or the switch.
+        dChanged : collections.OrderedDict
+            Maps zone name to `HeatDemandTracker`, for zones which
+            `call_for_heat` should re-evaluate.
+    """
+    def __init__(self, lZones=None):
+        """`lZones` is as returned by `parse_zones`. If None, a single zone
+        takes every valve, as in config files which only name devices. If
+        empty, there are no zones (see `assign_zones`)."""
+        import collections
+        self.dZones = collections.OrderedDict()
+        self.dAssigned = {}
+        self.dSwitches = {}
+        self.sDefault = None
+        self.sNamedSwitch = None
+        self.dMembers = {}
+        self.dChanged = collections.OrderedDict()
+
+        if lZones is None:
+            lZones = [{"lValves": None}]
+        for dZone in lZones:
+            dZone = dict(dZone)
+            lValves = dZone.pop("lValves")
+            dZone.pop("rLink", None)
+            sZone = HeatDemandTracker(**dZone)
+            self.dZones[sZone.rName] = sZone
+            if lValves is None:
+                self.sDefault = sZone
+            else:
+                for rSerial in lValves:
+                    self.dAssigned[rSerial] = sZone
+            if sZone.rSwitch is None:
+                self.sNamedSwitch = sZone
+            else:
+                self.dSwitches[sZone.rSwitch] = sZone
+
+    def add(self, rSerial, sDevice):
+        """Assign `sDevice`, newly seen with serial `rSerial`, to its
+        zone."""
+        sZone = self.dSwitches.get(rSerial)
+        if sZone is None and sDevice.rName == HeatDemandTracker.BOILER_NAME:
+            sZone = self.sNamedSwitch
+        if sZone is not None:
+            sZone.add_switch(sDevice)
+        else:
+            sZone = self.dAssigned.get(rSerial, self.sDefault)
+            if sZone is None:
+                if not self.dZones:
+                    # Only reporting this Link's devices
+                    return
+                sLog.warn(
+                    "Device %s (%s) is not in any heating zone",
+                    sDevice.rName,
+                    rSerial)
+                return
+        self.dMembers[rSerial] = sZone
+        sZone.bChanged = True
+        self.dChanged[sZone.rName] = sZone
+
+    def update(self, sDevice, tTransition, fNow):
+        """As `HeatDemandTracker.update`, for the zone of `sDevice`."""
+        sZone = self.dMembers.get(sDevice.serial)
+        if sZone is None:
+            return
+        sZone.update(sDevice, tTransition, fNow)
+        if sZone.bChanged:
+            self.dChanged[sZone.rName] = sZone
+
+    @property
+    def bChanged(self):
+        return bool(self.dChanged)
+
+    def pop_changed(self):
+        """Yield, and forget, each zone awaiting `call_for_heat`."""
+        while self.dChanged:
+            yield self.dChanged.popitem(last=False)[1]
+
+    def refresh(self, iDevices, fNow):
+        """Re-evaluate the demand of every device in `iDevices`, as devices
+        become stale without sending us anything."""
+        for sDevice in iDevices:
+            tTransition = sDevice.reevaluate(fNow)
+            if tTransition is not None:
+                self.update(sDevice, tTransition, fNow)
+
+def call_for_heat(sLink, sZone):
+    if not sZone.bChanged:
+        return
+    sZone.bChanged = False
+    fChangedTime = sZone.fChangedTime
+    sZone.fChangedTime = None
+
+    sDevice = sZone.sSwitch
+    if sDevice is None:
         sLog.error(
-            "No device named 'Boiler switch' present in configuration "
-            "file, unable to call for (lack of) heat!")
+            "No device %s present in configuration file, unable to call for "
+            "(lack of) heat in zone '%s'!",
+            "named '{}'".format(sZone.BOILER_NAME) if sZone.rSwitch is None
+            else "with serial {}".format(sZone.rSwitch),
+            sZone.rName)
+        return
+
+    bHeat = sZone.wants_heat()
+    if bool(sDevice.output) == bHeat:
+        sLog.debug(
+            "Call for heat: %s: NOOP (heating: %s)",
+            sZone.rName,
+            bool(sDevice.output))
         return
 
-    # pylint: disable=undefined-loop-variable
+    if sDevice.slot is None:
+        # Heard from (e.g. a statusPush) before describing itself, so its
+        # room is unknown. Its description re-evaluates the zone.
+        sZone.bChanged = True
+        sZone.fChangedTime = fChangedTime
+        if sZone.sDescribe is None or sZone.sDescribe.done():
+            sLog.warn(
+                "Call for heat: %s: room of %s not yet known, asking the "
+                "Lightwave Link",
+                sZone.rName,
+                sDevice.rName)
+            sZone.sDescribe = sLink.discover_devices(())
+        return
 
     rCommandTemplate = "!R{}F*tP{}"
     OFF = 50.0
     ON = 60.0
-    if lCalling:
+    if bHeat:
         rCommand = rCommandTemplate.format(sDevice.slot, ON)
     else:
         rCommand = rCommandTemplate.format(sDevice.slot, OFF)
 
-    if bool(sDevice.output) == bool(lCalling):
-        sLog.info("Call for heat: NOOP (heating: %s)", bool(sDevice.output))
+    fNow = sLink.sLoop.time()
+    fHold = sZone.hold_until(bHeat)
+    if fNow < fHold:
+        # Try again once the minimum on/off time has passed
+        sZone.bChanged = True
+        sZone.fChangedTime = fChangedTime
+        if sZone.sHold is None:
+            sLog.info(
+                "Call for heat: %s: holding %s for %.0fs",
+                sZone.rName,
+                "off" if bHeat else "on",
+                fHold - fNow)
+            def release():
+                sZone.sHold = None
+                call_for_heat(sLink, sZone)
+            sZone.sHold = sLink.sLoop.call_at(fHold, release)
         return
 
-    lNames = [x.rName for x in lCalling]
-    sLog.info("Call for heat: %s (command: %s)", lNames, rCommand)
-    sLink.send_command(rCommand)
+    lNames = [x.rName for x in sZone.dCalling.itervalues()]
+    sLog.info(
+        "Call for heat: %s: %s (command: %s)",
+        sZone.rName,
+        lNames,
+        rCommand)
+    sEventLog.record("switch", fNow, {
+        "zone": sZone.rName,
+        "heat": bHeat,
+        "calling": lNames,
+        "command": rCommand,
+        })
+    sZone.fSwitchedTime = fNow
+    sFuture = sLink.send_command(rCommand, iPriority=sLink.PRIORITY_BOILER)
+    if sFuture.fOriginTime is None:
+        sFuture.fOriginTime = fChangedTime
+
+class StaleDeviceScheduler(object):
+    """
+    Requests status updates from devices which have gone quiet, and
+    re-evaluates their demand for heat as they become stale.
+
+    Each device has a deadline by which we expect to have heard from it: its
+    last `time` plus `PUSH_INTERVAL_MISSES` of its observed push intervals,
+    bounded by `MIN_SCAN_INTERVAL_SECONDS` and `STALE_THRESHOLD_SECONDS`.
+    Deadlines are kept in a heap and a single timer wakes us for the
+    earliest, so each status update or refresh costs O(log n). Refreshes
+    falling due together are spread across `MIN_SCAN_INTERVAL_SECONDS`
+    rather than queued for the rate limiter all at once.
 
-def are_calling_for_heat(dStatus):
+    :IVariables:
+        sLink : LightwaveLink
+            Sink of refresh commands.
+        sZones : HeatingZones
+            Informed of devices' demand changing as they become stale.
+        lHeap : list
+            Heap of `(fDue, iSequence, TRVStatus)` entries. Entries
+            superseded by a new deadline remain in the heap, but are skipped
+            because `dDue` no longer refers to them.
+        dDue : dict
+            Maps serial to the live `lHeap` entry for that device.
+        dInterval : dict
+            Maps serial to the smoothed number of seconds between that
+            device's status pushes.
+        dLastPush : dict
+            Maps serial to the `time` of that device's latest status push.
+        siSequence : int generator
+            Source of `iSequence` values.
+        sTimer : Timer
+            Wakes us when the earliest deadline passes, or None.
+        fNextRefresh : float
+            Unixtime before which no further refresh is sent.
+        bStarted : bool
+            Whether `start` has been called. Until then deadlines are
+            recorded, but not acted upon.
+    """
+    PUSH_INTERVAL_MISSES = 3
+    INTERVAL_GAIN = 0.25    # Weight given to the latest push interval
+
+    def __init__(self, sLink, sZones):
+        import itertools
+        self.sLink = sLink
+        self.sZones = sZones
+        self.lHeap = []
+        self.dDue = {}
+        self.dInterval = {}
+        self.dLastPush = {}
+        self.siSequence = itertools.count()
+        self.sTimer = None
+        self.fNextRefresh = 0.0
+        self.bStarted = False
+
+    def __len__(self):
+        return len(self.dDue)
+
+    def start(self):
+        self.bStarted = True
+        self.arm()
+
+    def observe(self, sDevice, bPush):
+        """Account for `sDevice` having been updated, by a status push if
+        `bPush`, and reschedule its deadline."""
+        rSerial = sDevice.serial
+        if bPush and sDevice.time:
+            fPrevious = self.dLastPush.get(rSerial)
+            if fPrevious is not None and sDevice.time > fPrevious:
+                fInterval = sDevice.time - fPrevious
+                fSmoothed = self.dInterval.get(rSerial, fInterval)
+                self.dInterval[rSerial] = (
+                    (1 - self.INTERVAL_GAIN) * fSmoothed
+                    + self.INTERVAL_GAIN * fInterval)
+            self.dLastPush[rSerial] = sDevice.time
+        self.schedule(sDevice, self.deadline(sDevice))
+
+    def deadline(self, sDevice):
+        if not sDevice.time:
+            return 0.0  # Never reported its status: refresh as soon as we can
+        fWindow = STALE_THRESHOLD_SECONDS
+        fInterval = self.dInterval.get(sDevice.serial)
+        if fInterval is not None:
+            fWindow = max(
+                min(fWindow, self.PUSH_INTERVAL_MISSES * fInterval),
+                MIN_SCAN_INTERVAL_SECONDS)
+        return sDevice.time + fWindow
+
+    def schedule(self, sDevice, fDue):
+        import heapq
+        tEntry = (fDue, self.siSequence.next(), sDevice)
+        self.dDue[sDevice.serial] = tEntry
+        heapq.heappush(self.lHeap, tEntry)
+        if len(self.lHeap) > 2 * len(self.dDue) + 16:
+            # Discard superseded entries, lest they accumulate
+            self.lHeap = self.dDue.values()
+            heapq.heapify(self.lHeap)
+        self.arm()
+
+    def peek(self):
+        """Return the live entry with the earliest deadline, or None."""
+        import heapq
+        lHeap = self.lHeap
+        while lHeap and self.dDue.get(lHeap[0][2].serial) is not lHeap[0]:
+            heapq.heappop(lHeap)
+        return lHeap[0] if lHeap else None
+
+    def arm(self):
+        if not self.bStarted:
+            return
+        tEntry = self.peek()
+        if tEntry is None:
+            return
+        fWhen = max(tEntry[0], self.fNextRefresh)
+        if self.sTimer is not None:
+            if self.sTimer.fWhen <= fWhen:
+                return
+            self.sTimer.cancel()
+        self.sTimer = self.sLink.sLoop.call_at(fWhen, self.run)
+
+    def run(self):
+        """Refresh the device with the earliest deadline, if it has passed,
+        then sleep until the next."""
+        import heapq
+        self.sTimer = None
+        fNow = self.sLink.sLoop.time()
+        tEntry = self.peek()
+        if tEntry is None or tEntry[0] > fNow or self.fNextRefresh > fNow:
+            self.arm()
+            return
+
+        heapq.heappop(self.lHeap)
+        sDevice = tEntry[2]
+        tTransition = sDevice.reevaluate(fNow)
+        if tTransition is not None:
+            self.sZones.update(sDevice, tTransition, fNow)
+            for sZone in self.sZones.pop_changed():
+                call_for_heat(self.sLink, sZone)
+
+        if sDevice.slot is not None:
+            sLog.info(
+                "%s status is overdue, requesting update...",
+                sDevice.rName)
+            self.sLink.send_command(
+                "!R{}F*r".format(sDevice.slot),
+                iPriority=self.sLink.PRIORITY_POLL)
+        self.fNextRefresh = fNow + (
+            float(MIN_SCAN_INTERVAL_SECONDS) / len(self.dDue))
+
+        # Try again later if the device remains silent, but re-evaluate its
+        # demand as soon as it becomes stale
+        fRetry = fNow + MIN_SCAN_INTERVAL_SECONDS
+        if sDevice.time:
+            fStale = sDevice.time + STALE_THRESHOLD_SECONDS
+            if fNow < fStale < fRetry:
+                fRetry = fStale
+        self.schedule(sDevice, fRetry)
+
+def serve_http(rName, tAddress, fnGet, bBlock=False):
+    """Serve HTTP GET requests on `tAddress`, each on a thread of its own, so
+    that a slow or idle client holds up neither the event loop nor other
+    clients. `fnGet(rPath, sHeaders)` answers each request, from its thread,
+    with `(iStatus, lHeaders, rBody)`: `lHeaders` is `[(rName, rValue),
+    ...]`, and `rBody` is None for no body, or for an error status, the
+    message of the error page. Requests are logged at debug level, prefixed
+    with `rName`.
+
+    Returns the server, serving from a daemon thread named `rName`, or if
+    `bBlock`, once it stops serving from the calling thread."""
+    import BaseHTTPServer
+    import SocketServer
+    import threading
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        timeout = 5
+
+        def do_GET(self):
+            iStatus, lHeaders, rBody = fnGet(
+                self.path.split("?")[0],
+                self.headers)
+            if iStatus >= 400:
+                self.send_error(iStatus, rBody)
+                return
+            self.send_response(iStatus)
+            for rHeader, rValue in lHeaders:
+                self.send_header(rHeader, rValue)
+            if rBody is not None:
+                self.send_header("Content-Length", str(len(rBody)))
+            self.end_headers()
+            if rBody is not None:
+                self.wfile.write(rBody)
+
+        def log_message(self, rFormat, *lArgs):
+            sLog.debug(rName + ": " + rFormat, *lArgs)
+
+    class ThreadingHTTPServer(
+            SocketServer.ThreadingMixIn,
+            BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    sServer = ThreadingHTTPServer(tAddress, Handler)
+    if bBlock:
+        sServer.serve_forever()
+        return sServer
+    sThread = threading.Thread(target=sServer.serve_forever, name=rName)
+    sThread.daemon = True
+    sThread.start()
+    return sServer
+
+def start_metrics_server(sLoop, iPort,
+                         fRefreshSeconds=METRICS_REFRESH_SECONDS):
+    """Serve prometheus metrics on threads of their own, rather than from the
+    event loop, where a slow or idle client would stall it. The exposition
+    is rendered on the event loop every `fRefreshSeconds`, so collectors
+    never race it, and scrapes are served the latest rendering, as
+    `StateServer` serves snapshots."""
+    lExposition = [prometheus_client.generate_latest(
+        prometheus_client.REGISTRY)]
+
+    def get(_rPath, _sHeaders):
+        return (
+            200,
+            [("Content-Type", prometheus_client.CONTENT_TYPE_LATEST)],
+            lExposition[0])
+
+    def render():
+        lExposition[0] = prometheus_client.generate_latest(
+            prometheus_client.REGISTRY)
+        sLoop.call_later(fRefreshSeconds, render)
+
+    sServer = serve_http("Metrics", ("", iPort), get)
+    sLoop.call_later(fRefreshSeconds, render)
+    return sServer
+
+class MetricsRegion(object):
+    """
+    Memory-mapped file through which the controller hands its rendered
+    metrics to a separate exporter process (see `serve_exporter`), so that
+    scrapes, however frequent or slow, cost the controller nothing.
+
+    The region has a fixed size, and starts with a header packed as
+    `HEADER_FORMAT`: `MAGIC`, a sequence number, the unixtime of the latest
+    write, and the length and CRC-32 of the payload which follows. The one
+    writer makes the sequence number odd while it replaces the payload, then
+    even again (a seqlock). Readers retry until they see the same even
+    number before and after copying the payload, and a payload matching its
+    CRC, which also guards against the writes becoming visible out of order.
+
+    :IVariables:
+        sMap : mmap.mmap
+            The region.
+        iSequence : int
+            Sequence number of the latest write (writer only).
+    """
+    MAGIC = "LWLMET1\n"
+    HEADER_FORMAT = "<8sQdIi"
+    SIZE = 1024*1024    # 1MiB
+    READ_ATTEMPTS = 100
+
+    def __init__(self, rPath, bWrite=False, iSize=SIZE):
+        import mmap
+        import os
+        import struct
+        if bWrite:
+            iFD = os.open(rPath, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                os.ftruncate(iFD, iSize)
+                self.sMap = mmap.mmap(iFD, iSize)
+            finally:
+                os.close(iFD)
+        else:
+            with open(rPath, "rb") as sFH:
+                self.sMap = mmap.mmap(
+                    sFH.fileno(), 0, access=mmap.ACCESS_READ)
+        rMagic, iSequence = struct.unpack_from("<8sQ", self.sMap)
+        # Carry on from a previous writer's sequence, for readers' sake
+        self.iSequence = 0
+        if rMagic == self.MAGIC:
+            self.iSequence = iSequence + iSequence % 2
+
+    def close(self):
+        self.sMap.close()
+
+    def write(self, rPayload, fNow):
+        """Replace the payload with `rPayload`. Returns False if it does not
+        fit."""
+        import struct
+        import zlib
+        iHeader = struct.calcsize(self.HEADER_FORMAT)
+        if iHeader + len(rPayload) > len(self.sMap):
+            return False
+        struct.pack_into("<8sQ", self.sMap, 0, self.MAGIC, self.iSequence + 1)
+        self.sMap[iHeader:iHeader + len(rPayload)] = rPayload
+        struct.pack_into(
+            "<dIi", self.sMap, 16, fNow, len(rPayload), zlib.crc32(rPayload))
+        self.iSequence += 2
+        struct.pack_into("<Q", self.sMap, 8, self.iSequence)
+        return True
+
+    def read(self):
+        """Return `(fTime, rPayload)` of the latest complete write, or None
+        if there is none, or no consistent copy could be taken."""
+        import struct
+        import time
+        import zlib
+        iHeader = struct.calcsize(self.HEADER_FORMAT)
+        for _ in xrange(self.READ_ATTEMPTS):
+            rHeader = self.sMap[:iHeader]
+            rMagic, iSequence, fTime, iLength, iCRC = struct.unpack(
+                self.HEADER_FORMAT, rHeader)
+            if rMagic != self.MAGIC:
+                return None
+            if iSequence % 2 == 0 and iHeader + iLength <= len(self.sMap):
+                rPayload = self.sMap[iHeader:iHeader + iLength]
+                if (self.sMap[:iHeader] == rHeader
+                        and zlib.crc32(rPayload) == iCRC):
+                    return fTime, rPayload
+            time.sleep(0.001)   # Let the writer finish
+        return None
+
+def export_metrics_periodically(sLoop, sRegion):
+    rPayload = prometheus_client.generate_latest(prometheus_client.REGISTRY)
+    if not sRegion.write(rPayload, sLoop.time()):
+        sLog.warn(
+            "Metrics (%s bytes) do not fit the export region, see "
+            "--export-size",
+            len(rPayload))
+    sLoop.call_later(
+        EXPORT_INTERVAL_SECONDS,
+        export_metrics_periodically,
+        sLoop,
+        sRegion)
+
+def serve_exporter(rPath, iPort):
+    """Serve prometheus metrics written to the `MetricsRegion` at `rPath` by
+    a controller run with `--export-region`, until interrupted."""
+    import struct
     import time
 
-    fStaleThreshold = time.time() - STALE_THRESHOLD_SECONDS
-
-    # Special values for current target temperature:
-    #   50.0-60.0: 0-100% valve
-
-    lCalling = []
-    lMessages = []
-    iMaxNameLen = 0
-    for sDevice in dStatus.itervalues():
-        rDecision = ""
-        if sDevice.prod != "valve":
-            rDecision = "n/a (not a valve)"
-            continue
-        elif 50 <= sDevice.output:
-            rDecision = "calling for heat, valve open >= 50%"
-            lCalling.append(sDevice)
-        elif 0 == sDevice.output:
-            rDecision = "ignored, valve closed"
-        elif 0 < sDevice.output < 50:
-            rDecision = "ignored, valve open, but less than 50%"
-        elif sDevice.time < fStaleThreshold:
-            rDecision = "ignored, stale status"
-            continue
-        elif sDevice.cTarg == 50.0:
-            rDecision = "ignored, target OFF (50.0)"
-        elif sDevice.cTarg > 50.0:
-            rDecision = "calling for heat, explicit non-zero valve opening (>50.0)"
-            lCalling.append(sDevice)
-        #elif sDevice.cTarg < 50.0 and sDevice.cTarg > sDevice.cTemp:
-        #    sLog.debug("Calling for heat via ambient temp below target: %s", sDevice)
-        #    lCalling.append(sDevice)
+    def get(_rPath, _sHeaders):
+        tRead = None
+        try:
+            sRegion = MetricsRegion(rPath)
+        except (IOError, OSError, ValueError, struct.error) as sError:
+            sLog.debug("Unable to map %s: %s", rPath, sError)
         else:
-            rDecision = "(default)"
+            try:
+                tRead = sRegion.read()
+            finally:
+                sRegion.close()
+        if tRead is None:
+            return 503, [], "No metrics from the controller yet"
+        fTime, rPayload = tRead
+        rPayload += (
+            "# HELP lwl_export_age_seconds Time since the controller "
+            "last exported metrics\n"
+            "# TYPE lwl_export_age_seconds gauge\n"
+            "lwl_export_age_seconds {!r}\n".format(time.time() - fTime))
+        return (
+            200,
+            [("Content-Type", prometheus_client.CONTENT_TYPE_LATEST)],
+            rPayload)
 
-        iMaxNameLen = max(iMaxNameLen, len(sDevice.rName))
-        lMessages.append( (sDevice.rName, rDecision) )
+    sLog.info("Serving metrics from %s on port %s", rPath, iPort)
+    try:
+        serve_http("Exporter", ("", iPort), get, bBlock=True)
+    except KeyboardInterrupt:
+        pass
 
-    for i, (rName, rDecision) in enumerate(lMessages):
-        lMessages[i] = "  {:>{width}}: {}".format(
-                rName,
-                rDecision,
-                width=iMaxNameLen)
+class StateSnapshot(object):
+    """
+    Immutable view of controller state served by `StateServer`. The event
+    loop builds a new snapshot rather than modifying the current one, so
+    server threads read it without locking.
 
-    rMessage = "\n".join(lMessages)
-    sLog.info("Calling for heat:\n%s" % rMessage)
+    :IVariables:
+        dDevices : dict
+            Maps serial to device record.
+        lDemand : list
+            Record of each heating zone.
+        lLinks : list
+            Record of each Lightwave Link.
+        dBodies : dict
+            Maps request path to `(rBody, rETag)`, filled in by server
+            threads as paths are first requested. Racing threads compute the
+            same value, so this needs no lock either.
+    """
+    def __init__(self, dDevices, lDemand, lLinks):
+        self.dDevices = dDevices
+        self.lDemand = lDemand
+        self.lLinks = lLinks
+        self.dBodies = {}
+
+    def get(self, rPath):
+        """Return the JSON-serialisable resource at `rPath`, or None."""
+        lParts = rPath.strip("/").split("/")
+        if lParts == ["devices"]:
+            return [self.dDevices[x] for x in sorted(self.dDevices)]
+        if len(lParts) == 2 and lParts[0] == "devices":
+            return self.dDevices.get(lParts[1])
+        if lParts == ["demand"]:
+            return self.lDemand
+        if lParts == ["link"]:
+            return self.lLinks
+        return None
+
+    def body(self, rPath):
+        """Return `(rBody, rETag)` for `rPath`, or None if there is no such
+        resource."""
+        import hashlib
+        import json
+        tBody = self.dBodies.get(rPath)
+        if tBody is None:
+            mResource = self.get(rPath)
+            if mResource is None:
+                return None
+            rBody = json.dumps(
+                mResource,
+                indent=1,
+                separators=(",", ": "),
+                sort_keys=True)
+            tBody = (rBody, '"{}"'.format(hashlib.md5(rBody).hexdigest()))
+            self.dBodies[rPath] = tBody
+        return tBody
+
+class StateServer(object):
+    """
+    Read-only HTTP JSON API over controller state: `/devices`,
+    `/devices/{serial}`, `/demand` (each heating zone's decision) and
+    `/link`.
+
+    Requests are served on threads of their own, from a `StateSnapshot`
+    which the event loop replaces (by assigning `sSnapshot`, which is
+    atomic) at most once per loop iteration, after devices change, and
+    every `REFRESH_SECONDS` if devices have since gone stale or Link
+    statistics have changed. Responses carry an ETag, so pollers sending
+    If-None-Match get a 304. Polling thus neither takes locks nor adds work
+    to the event loop.
 
-    return lCalling
+    :IVariables:
+        sLoop : EventLoop
+            Loop on which snapshots are built.
+        lControllers : list
+            `HeatingController` of each Link.
+        dRecords : dict
+            Maps serial to the device record in the latest snapshot.
+        dDirty : dict
+            Maps serial to `(HeatingController, TRVStatus)` for devices
+            changed since the latest snapshot.
+        sSnapshot : StateSnapshot
+            Latest snapshot, read by server threads.
+        sPublish : Timer
+            Pending `publish`, if any.
+        sServer : BaseHTTPServer.HTTPServer
+            Serves requests, on a thread of its own.
+    """
+    REFRESH_SECONDS = 10
+
+    def __init__(self, sLoop, iPort, rBind="127.0.0.1"):
+        self.sLoop = sLoop
+        self.lControllers = []
+        self.dRecords = {}
+        self.dDirty = {}
+        self.sSnapshot = StateSnapshot({}, [], [])
+        self.sPublish = None
+        self.sServer = serve_http("State API", (rBind, iPort), self.get)
+        self.refresh()
+
+    def get(self, rPath, sHeaders):
+        """Answer a request for `rPath`, from a server thread, see
+        `serve_http`."""
+        tBody = self.sSnapshot.body(rPath)
+        if tBody is None:
+            return 404, [], None
+        rBody, rETag = tBody
+        if sHeaders.get("If-None-Match") == rETag:
+            return 304, [("ETag", rETag)], None
+        return 200, [
+            ("Content-Type", "application/json"),
+            ("ETag", rETag),
+            ("Cache-Control", "no-cache"),
+            ], rBody
+
+    def add(self, sController):
+        """Serve the state of `sController`, and follow its changes."""
+        self.lControllers.append(sController)
+        sController.fnChanged = (
+            lambda sDevice: self.changed(sController, sDevice))
+        for sDevice in sController.dStatus.itervalues():
+            self.changed(sController, sDevice)
+
+    def changed(self, sController, sDevice):
+        if sDevice.serial is None:
+            return
+        self.dDirty[sDevice.serial] = (sController, sDevice)
+        if self.sPublish is None:
+            self.sPublish = self.sLoop.call_soon(self.publish)
+
+    def refresh(self):
+        # Devices go stale without sending anything, so without `changed`
+        for sController in self.lControllers:
+            for sDevice in sController.dStatus.itervalues():
+                dRecord = self.dRecords.get(sDevice.serial)
+                if (dRecord is None
+                        or dRecord["demand"] != sDevice.rDemand
+                        or dRecord["reason"] != sDevice.rDemandReason):
+                    self.changed(sController, sDevice)
+        self.publish()
+        self.sLoop.call_later(self.REFRESH_SECONDS, self.refresh)
+
+    def publish(self):
+        if self.sPublish is not None:
+            self.sPublish.cancel()
+            self.sPublish = None
+        bDirty = bool(self.dDirty)
+        for rSerial, (sController, sDevice) in self.dDirty.iteritems():
+            sZone = sController.sZones.dMembers.get(rSerial)
+            self.dRecords[rSerial] = {
+                "serial": rSerial,
+                "name": sDevice.rName,
+                "link": sController.sLink.rAddress,
+                "zone": sZone and sZone.rName,
+                "demand": sDevice.rDemand,
+                "reason": sDevice.rDemandReason,
+                "status": sDevice.as_dict(),
+                }
+        self.dDirty = {}
+
+        lDemand = []
+        lLinks = []
+        for sController in self.lControllers:
+            sLink = sController.sLink
+            for sZone in sController.sZones.dZones.itervalues():
+                sSwitch = sZone.sSwitch
+                lDemand.append({
+                    "zone": sZone.rName,
+                    "link": sLink.rAddress,
+                    "switch": sSwitch and sSwitch.serial or sZone.rSwitch,
+                    "heating": sSwitch and bool(sSwitch.output),
+                    "wants_heat": sZone.wants_heat(),
+                    "calling": sorted(sZone.dCalling),
+                    "threshold": sZone.iThreshold,
+                    "min_on": sZone.fMinOn,
+                    "min_off": sZone.fMinOff,
+                    "switched_at": sZone.fSwitchedTime,
+                    "held": sZone.sHold is not None,
+                    })
+            sLatency = sLink.sLatency
+            lLinks.append({
+                "address": sLink.rAddress,
+                "pending": len(sLink.dPending),
+                "queued": len(sLink.sScheduler),
+                "rate": sLink.sRateLimit.fRate,
+                "retransmissions": sLink.iRetransmissions,
+                "failures": sLink.iFailures,
+                "responses": dict(sLink.dResponseCount),
+                "timeouts": {
+                    x: sLatency.timeout(x) for x in sLatency.dEstimates},
+                })
+
+        if (not bDirty
+                and lDemand == self.sSnapshot.lDemand
+                and lLinks == self.sSnapshot.lLinks):
+            return  # Keep the current snapshot, and its rendered bodies
+        self.sSnapshot = StateSnapshot(dict(self.dRecords), lDemand, lLinks)
+
+class HeatingController(object):
+    """
+    Keeps a `TRVStatus` for every device up to date from messages received
+    by the Lightwave Link, and switches each heating zone's boiler or zone
+    valve accordingly.
 
-def scan_stale_devices(dStatus, sLink):
-    # Generator which _may_ scan stale devices, if it hasn't done so recently
-    import time
+    :IVariables:
+        sLink : LightwaveLink
+            Source of messages and sink of commands.
+        dConfig : dict
+            Maps serial to device name, see `load_config`.
+        dStatus : dict
+            Maps serial to `TRVStatus`.
+        sZones : HeatingZones
+            Which devices are calling for heat, by zone.
+        sStaleScheduler : StaleDeviceScheduler
+            Refreshes devices which have gone quiet.
+        bActive : bool
+            Whether to act on changes in demand. Cleared until `activate`,
+            to avoid hysteria while `LightwaveLink.scan_devices` runs.
+        sHeatCall : Timer
+            Pending `call_for_heat`, if any. Deferred so that a burst of
+            messages only results in one evaluation.
+        fnChanged : callable
+            Called with each `TRVStatus` updated, or None, see
+            `StateServer`.
+    """
+    IGNORED_FNS = (
+        "ack",
+        "getStatus",
+        "home",
+        "hubCall",
+        "off",      # Human pushed button on TRV
+        "on",       # Human pushed button on TRV
+        "rfReinit",
+        "setTarget",
+        "setTime",
+        )
 
-    iNextScanTime = 0
+    def __init__(self, sLink, dConfig, lZones=None):
+        self.sLink = sLink
+        self.dConfig = dConfig
+        self.dStatus = {}
+        self.sZones = HeatingZones(lZones)
+        self.sStaleScheduler = StaleDeviceScheduler(sLink, self.sZones)
+        self.bActive = False
+        self.sHeatCall = None
+        self.fnChanged = None
+
+        sRouter = sLink.sRouter
+        for rFn in LightwaveLink.STATUS_FNS:
+            sRouter.register(self.on_status, rFn=rFn)
+        for rFn in self.IGNORED_FNS:
+            sRouter.ignore(rFn=rFn)
+        sRouter.ignore(rType="log")
+
+    def get_device(self, rSerial):
+        if rSerial not in self.dStatus:
+            if rSerial not in self.dConfig:
+                sLog.warn(
+                    "Device with serial %s not present in config file",
+                    rSerial)
+            rName = self.dConfig.get(rSerial, rSerial)
+            self.dStatus[rSerial] = TRVStatus(rName)
+            self.sZones.add(rSerial, self.dStatus[rSerial])
+        return self.dStatus[rSerial]
+
+    def on_status(self, dResponse):
+        sDevice = self.get_device(dResponse["serial"])
+        fNow = self.sLink.sLoop.time()
+        tTransition = sDevice.update(dResponse, fNow)
+        self.sZones.update(sDevice, tTransition, fNow)
+        self.sStaleScheduler.observe(
+            sDevice,
+            dResponse.get("fn") == "statusPush")
+        sLog.debug("%s", sDevice)
+        sEventLog.record("status", fNow, {
+            "name": sDevice.rName,
+            "status": sDevice.as_dict(),
+            })
+
+        if self.bActive and self.sZones.bChanged and not self.sHeatCall:
+            self.sHeatCall = self.sLink.sLoop.call_soon(self.evaluate)
+        if self.fnChanged is not None:
+            self.fnChanged(sDevice)
+
+    def restore(self, dSnapshot):
+        """Recreate device state from `dSnapshot`, see `load_snapshot`.
+        Devices not heard from within `SNAPSHOT_TTL_SECONDS` (e.g. removed)
+        are dropped, and those not heard from within
+        `STALE_THRESHOLD_SECONDS` are restored stale, whatever their valve
+        opening was. Returns the rooms of the devices restored."""
+        fNow = self.sLink.sLoop.time()
+        fTaken = dSnapshot.get("time", fNow)
+        lRooms = []
+        iExpired = 0
+        for dStatus in dSnapshot["devices"]:
+            if "serial" not in dStatus:
+                continue
+            dStatus = dict(dStatus)
+            fSeen = dStatus.pop("seen", None) or fTaken
+            if fSeen < fNow - SNAPSHOT_TTL_SECONDS:
+                iExpired += 1
+                continue
+            if fSeen < fNow - STALE_THRESHOLD_SECONDS:
+                dStatus.pop("output", None)
+            sDevice = self.get_device(dStatus["serial"])
+            tTransition = sDevice.update(dStatus, fNow)
+            sDevice.fSeen = fSeen
+            self.sZones.update(sDevice, tTransition, fNow)
+            self.sStaleScheduler.observe(sDevice, False)
+            if self.fnChanged is not None:
+                self.fnChanged(sDevice)
+            if sDevice.slot is not None:
+                lRooms.append(sDevice.slot)
+        sLog.info(
+            "Restored %s devices from snapshot taken at %s, dropped %s not "
+            "heard from for %ss",
+            len(self.dStatus),
+            dSnapshot.get("time"),
+            iExpired,
+            SNAPSHOT_TTL_SECONDS)
+        return lRooms
 
-    while True:
-        iNow = time.time()
-        if iNow < iNextScanTime:
-            # Not yet time to scan, wait until next opportunity
-            sLog.debug(
-                "Stale scan skipped, MIN_SCAN_INTERVAL_SECONDS not yet lapsed")
-            yield
-        else:
-            iNextScanTime = iNow + MIN_SCAN_INTERVAL_SECONDS
-            sLog.debug("Stale scan started")
+    def evaluate(self):
+        self.sHeatCall = None
+        for sZone in self.sZones.pop_changed():
+            call_for_heat(self.sLink, sZone)
 
-        for sDevice in dStatus.values():
-            if not sDevice.time or (iNow - sDevice.time >STALE_THRESHOLD_SECONDS):
-                sLog.info(
-                    "%s status is stale, requesting update...",
-                    sDevice.rName)
-                sLink.send_command("!R{}F*r".format(sDevice.slot))
+    def activate(self):
+        self.bActive = True
+        self.sLink.sLoop.call_soon(self.evaluate)
+        self.sStaleScheduler.start()
 
-        yield
+def replay(rPath, fSpeed, dConfig, lZones=None):
+    """Feed datagrams captured with `--capture` through the same pipeline as
+    live traffic, with commands recorded rather than sent. `fSpeed` is
+    relative to real time, or 0 to replay as fast as possible."""
+    import time
 
-def main():
-    dConfig = load_config()
+    siRecords = DatagramLog.read(rPath)
+    try:
+        fFirst, _, rDatagram = next(siRecords)
+    except StopIteration:
+        sLog.warn("%s contains no datagrams", rPath)
+        return
 
-    prometheus_client.start_http_server(9191)
+    if fSpeed:
+        sLoop = EventLoop()
+        fOffset = sLoop.time() - fFirst / fSpeed
+    else:
+        sLoop = ReplayLoop(fFirst)
+    sLink = ReplayLink(sLoop)
+    sController = HeatingController(sLink, dConfig, lZones)
+    sController.activate()
 
-    sLink = LightwaveLink()
-    sLink.test_connectivity()
-    sLink.scan_devices()
+    fStarted = time.time()
+    lCount = [0]
 
-    dStatus = {}    # rSerial: TRVStatus
-    siStaleScanner = scan_stale_devices(dStatus, sLink)
+    def feed(rDatagram):
+        sLink.handle_datagram(rDatagram)
+        lCount[0] += 1
 
-    while True:
-        try:
-            # Avoid entering an unblockable system call, as that would prevent
-            # signals like SIGINT (KeyboardInterrupt) being delivered
-            dResponse = sLink.sResponses.get(True, 3600)
-        except sLink.sResponses.Empty:
-            continue
-
-        if dResponse.get("fn") in (
-                "read", "statusPush", "statusOn", "statusOff"):
-            rSerial = dResponse["serial"]
-            if rSerial not in dStatus:
-                if rSerial not in dConfig:
-                    sLog.warn(
-                        "Device with serial %s not present in config file",
-                        rSerial)
-                rName = dConfig.get(rSerial, rSerial)
-                dStatus[rSerial] = TRVStatus(rName)
-            dStatus[rSerial].update(dResponse)
-            sLog.info(str(dStatus[rSerial]))
-
-            # Try to avoid hysteria following sLink.scan_devices()
-            if sLink.sResponses.empty():
-                call_for_heat(sLink, dStatus)
-        elif dResponse.get("fn") in (
-                "ack",
-                "getStatus",
-                "home",
-                "hubCall",
-                "off",      # Human pushed button on TRV
-                "on",       # Human pushed button on TRV
-                "rfReinit",
-                "setTarget",
-                "setTime",
-            ):
-            pass
-        elif dResponse.get("type") == "log":
-            pass
-        else:
-            sLog.warn("Unhandled response:\n%s", dResponse)
+    if fSpeed:
+        def feed_next(rDatagram):
+            feed(rDatagram)
+            try:
+                fTime, _, rNext = next(siRecords)
+            except StopIteration:
+                sLoop.stop()
+                return
+            sLoop.call_at(fOffset + fTime / fSpeed, feed_next, rNext)
+        sLoop.call_soon(feed_next, rDatagram)
+        sLoop.run_forever()
+    else:
+        sLoop.dispatch(feed, (rDatagram,))
+        for fTime, _, rDatagram in siRecords:
+            sLoop.advance(fTime)
+            sLoop.dispatch(feed, (rDatagram,))
+        sLoop.advance(sLoop.time())
+
+    fElapsed = time.time() - fStarted
+    sLog.info(
+        "Replayed %s datagrams in %.3fs (%.0f/s), %s commands sent",
+        lCount[0],
+        fElapsed,
+        lCount[0] / max(fElapsed, 1e-9),
+        len(sLink.lSent))
+
+def parse_args(lArgs=None):
+    import argparse
+    sParser = argparse.ArgumentParser(
+        description="LightwaveRF call-for-heat controller")
+    sParser.add_argument(
+        "--link-address",
+        metavar="IP",
+        action="append",
+        help="IPv4 address of the Lightwave Link (default: that in the "
+             "--state snapshot, else {}). May be repeated to control "
+             "several Links, started side by side, each switching the zones "
+             "of config.yml which name it with 'link'".format(
+                 LightwaveLink.DEFAULT_ADDRESS))
+    sParser.add_argument(
+        "--state",
+        metavar="PATH",
+        default="data/state.json",
+        help="Snapshot device state to PATH periodically and on shutdown, "
+             "and restore it on start-up to skip the initial device scan. "
+             "An empty string disables snapshots (default: %(default)s)")
+    sParser.add_argument(
+        "--api-port",
+        metavar="PORT",
+        type=int,
+        default=9192,
+        help="Serve device, demand and Link state as JSON on PORT, or 0 to "
+             "disable (default: %(default)s)")
+    sParser.add_argument(
+        "--api-bind", "--state-bind",
+        metavar="ADDRESS",
+        default="127.0.0.1",
+        help="Serve the JSON API on ADDRESS only, or on every interface if "
+             "an empty string (default: %(default)s)")
+    sParser.add_argument(
+        "--command-burst",
+        metavar="N",
+        type=int,
+        default=LightwaveLink.COMMAND_BURST,
+        help="Number of commands which may be sent to the Lightwave Link "
+             "back-to-back (default: %(default)s)")
+    sParser.add_argument(
+        "--max-command-rate",
+        metavar="PER_SECOND",
+        type=float,
+        default=LightwaveLink.MAX_COMMAND_RATE,
+        help="Upper bound on the rate of commands to the Lightwave Link, "
+             "which is otherwise learnt from its responses (default: "
+             "%(default)s)")
+    sParser.add_argument(
+        "--metrics-ttl",
+        metavar="SECONDS",
+        type=float,
+        default=SERIES_TTL_SECONDS,
+        help="Stop exporting metrics for devices, and kinds of response, "
+             "not heard from for this long, or 0 to export them "
+             "indefinitely (default: %(default)s)")
+    sParser.add_argument(
+        "--export-region",
+        metavar="PATH",
+        help="Instead of serving metrics on port 9191, write them every "
+             "{}s to the memory-mapped file PATH (e.g. under /dev/shm), "
+             "for a separate process run with --exporter "
+             "PATH".format(EXPORT_INTERVAL_SECONDS))
+    sParser.add_argument(
+        "--export-size",
+        metavar="BYTES",
+        type=int,
+        default=MetricsRegion.SIZE,
+        help="Size of the --export-region file (default: %(default)s)")
+    sParser.add_argument(
+        "--exporter",
+        metavar="PATH",
+        help="Instead of talking to a Lightwave Link, serve metrics on port "
+             "9191 from PATH, as written by a controller run with "
+             "--export-region PATH")
+    sParser.add_argument(
+        "--receive-buffer",
+        metavar="BYTES",
+        type=int,
+        help="Kernel receive buffer size for datagrams from the Lightwave "
+             "Link (default: system default). Bounded by "
+             "net.core.rmem_max")
+    sParser.add_argument(
+        "--ingest-limit",
+        metavar="N",
+        type=int,
+        default=LightwaveLink.INGEST_QUEUE_SIZE,
+        help="Maximum number of received messages awaiting dispatch "
+             "(default: %(default)s)")
+    sParser.add_argument(
+        "--ingest-overflow",
+        choices=IngestQueue.OVERFLOW_POLICIES,
+        default=IngestQueue.DROP_OLDEST,
+        help="Which message to discard when the ingest queue is full "
+             "(default: %(default)s)")
+    sParser.add_argument(
+        "--event-log",
+        metavar="PATH",
+        default="data/events.jsonl",
+        help="Log device status, demand and switching to PATH, in the "
+             "background. An empty string disables the event log "
+             "(default: %(default)s)")
+    sParser.add_argument(
+        "--event-log-size",
+        metavar="BYTES",
+        type=int,
+        default=EventLog.MAX_BYTES,
+        help="Size at which the event log is rotated (default: "
+             "%(default)s)")
+    sParser.add_argument(
+        "--event-log-backups",
+        metavar="N",
+        type=int,
+        default=EventLog.BACKUPS,
+        help="Number of rotated event logs kept (default: %(default)s)")
+    sParser.add_argument(
+        "--view-events",
+        metavar="PATH",
+        help="Instead of talking to a Lightwave Link, print the event log "
+             "at PATH (and its rotated predecessors) in readable form")
+    sParser.add_argument(
+        "--capture",
+        metavar="PATH",
+        help="Append every datagram received from the Lightwave Link to "
+             "PATH, for later use with --replay")
+    sParser.add_argument(
+        "--replay",
+        metavar="PATH",
+        help="Instead of talking to a Lightwave Link, feed the datagrams "
+             "captured in PATH through the controller")
+    sParser.add_argument(
+        "--replay-speed",
+        metavar="FACTOR",
+        type=float,
+        default=0.0,
+        help="Replay speed relative to real time, or 0 (the default) to "
+             "replay as fast as possible")
+    return sParser.parse_args(lArgs)
+
+def main():
+    sArgs = parse_args()
+    if sArgs.view_events:
+        for dRecord in EventLog.read(sArgs.view_events):
+            print EventLog.render(dRecord)
+        return
+    if sArgs.exporter:
+        serve_exporter(sArgs.exporter, 9191)
+        return
 
-        # Request status updates from devices we've not seen for a while.
-        # Self-limits how often it performs scans.
-        siStaleScanner.next()
+    dConfig, lZones = load_config()
 
-        sLog.debug("End of loop")
+    if sArgs.replay:
+        replay(sArgs.replay, sArgs.replay_speed, dConfig, lZones)
+        return
+
+    import os
+    import signal
+
+    lAddresses = sArgs.link_address or [None]
+    dLinkZones = assign_zones(lZones, lAddresses)
+    sLoop = EventLoop()
+    if sArgs.export_region:
+        sLoop.call_soon(
+            export_metrics_periodically,
+            sLoop,
+            MetricsRegion(sArgs.export_region, True, sArgs.export_size))
+    else:
+        start_metrics_server(sLoop, 9191)
+    sStateServer = None
+    if sArgs.api_port:
+        sStateServer = StateServer(sLoop, sArgs.api_port, sArgs.api_bind)
+    sMultiplexer = None
+    if len(lAddresses) > 1:
+        sMultiplexer = LinkMultiplexer(sLoop, sArgs.receive_buffer)
+    for rPath in (sArgs.state, sArgs.event_log):
+        rDirectory = os.path.dirname(rPath)
+        if rDirectory and not os.path.isdir(rDirectory):
+            os.makedirs(rDirectory)
+    if sArgs.event_log:
+        sEventLog.open(
+            sArgs.event_log,
+            sArgs.event_log_size,
+            sArgs.event_log_backups)
+    sCapture = None
+    if sArgs.capture:
+        sCapture = DatagramLog(sArgs.capture)
+
+    # `docker stop` sends SIGTERM. Start-up blocks on the loop without it
+    # running, so unwind that instead, still saving snapshots on the way out
+    def terminate(iSignal, _):
+        if not sLoop.bRunning:
+            raise SystemExit(128 + iSignal)
+        sLoop.stop()
+    signal.signal(signal.SIGTERM, terminate)
+
+    sCollector = None
+    lSnapshots = []     # (rPath, HeatingController)
+    lStarting = []      # (HeatingController, dSnapshot, rState)
+    try:
+        for rAddress in lAddresses:
+            lLinkZones = dLinkZones[rAddress]
+            rState = sArgs.state
+            if rState and sMultiplexer is not None:
+                # One snapshot per Link, e.g. state-192.168.1.2.json
+                rRoot, rExtension = os.path.splitext(rState)
+                rState = "{}-{}{}".format(rRoot, rAddress, rExtension)
+            dSnapshot = None
+            if rState:
+                dSnapshot = load_snapshot(rState)
+            rAddress = (
+                rAddress
+                or (dSnapshot and dSnapshot.get("address"))
+                or LightwaveLink.DEFAULT_ADDRESS)
+
+            if sMultiplexer is None:
+                sLink = LightwaveLink(sLoop, rAddress, sArgs.receive_buffer)
+            else:
+                sLink = sMultiplexer.add(rAddress)
+            sLink.sIngest = IngestQueue(
+                sArgs.ingest_limit,
+                sArgs.ingest_overflow)
+            sLink.sRateLimit = TokenBucket(
+                LightwaveLink.COMMAND_RATE,
+                sArgs.command_burst,
+                LightwaveLink.MIN_COMMAND_RATE,
+                sArgs.max_command_rate)
+            if dSnapshot and dSnapshot.get("rate"):
+                sLink.sRateLimit.set_rate(dSnapshot["rate"])
+            sLink.sCapture = sCapture
+
+            sController = HeatingController(sLink, dConfig, lLinkZones)
+            if sCollector is None:
+                sCollector = LightwaveCollector(
+                    sController.dStatus,
+                    sLink,
+                    sArgs.metrics_ttl)
+                prometheus_client.REGISTRY.register(sCollector)
+            else:
+                sCollector.add(sController.dStatus, sLink)
+            if sStateServer is not None:
+                sStateServer.add(sController)
+            lStarting.append((sController, dSnapshot, rState))
+
+        # Start the Links side by side: each step is sent to every Link
+        # before waiting for any of them to respond
+        lHubCalls = [x[0].sLink.hub_call() for x in lStarting]
+        for (sController, _, _), sHubCall in zip(lStarting, lHubCalls):
+            sController.sLink.test_connectivity(sHubCall)
+        lSummaries = [
+            None if x[1] else x[0].sLink.request_summary()
+            for x in lStarting]
+        lScans = []
+        for (sController, dSnapshot, rState), sSummary in zip(
+                lStarting,
+                lSummaries):
+            sLink = sController.sLink
+            if dSnapshot:
+                iKnownRooms = sController.restore(dSnapshot)
+            if rState:
+                # From here on, even a partial scan is worth saving
+                lSnapshots.append((rState, sController))
+            if dSnapshot:
+                # Act on the restored state straight away, and catch up with
+                # any devices added since in the background. Stale devices
+                # are refreshed by `StaleDeviceScheduler`.
+                sLink.discover_devices(iKnownRooms)
+            else:
+                lScans.append((sLink, sLink.query_devices(sSummary)))
+        for sLink, lQueries in lScans:
+            sLink.scan_devices(lQueries)
+        if len(lStarting) > 1:
+            check_zones([x[0] for x in lStarting])
+
+        for sController, _, rState in lStarting:
+            sLink = sController.sLink
+            sController.activate()
+            if rState:
+                sLoop.call_later(
+                    SNAPSHOT_INTERVAL_SECONDS,
+                    save_snapshot_periodically,
+                    rState,
+                    sController.dStatus,
+                    sLink)
+
+        sLoop.run_forever()
+    finally:
+        for rState, sController in lSnapshots:
+            save_snapshot(rState, sController.dStatus, sController.sLink)
+        sEventLog.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,441 @@
+#!/usr/bin/python2.7
+# encoding: utf8
+"""
+Unit tests for lightwave_link.py. Everything runs on a `ReplayLoop`, whose
+clock only moves when told to, so timeouts, backoff and rate limiting are
+deterministic::
+
+    python -m unittest discover -s tests
+"""
+
+# pylint: disable=invalid-name,missing-docstring
+
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+import lightwave_link
+
+lightwave_link.sLog.setLevel(logging.CRITICAL)
+
+BASE_TIME = 1545130654.0
+
+
+class ReplyingLink(lightwave_link.ReplayLink):
+    """`ReplayLink` which, like a live Link, correlates plain-text replies
+    and "Transmit fail" errors with the commands it sent."""
+    resolve_reply = lightwave_link.LightwaveLink.resolve_reply
+    resolve_transmit_fail = lightwave_link.LightwaveLink.resolve_transmit_fail
+
+
+class LinkTestCase(unittest.TestCase):
+    cLink = ReplyingLink
+
+    def setUp(self):
+        self.sLoop = lightwave_link.ReplayLoop(BASE_TIME)
+        self.sLink = self.cLink(self.sLoop)
+        self.iLinkTrans = 1000     # The Link's own JSON message counter
+
+    def advance(self, fSeconds):
+        self.sLoop.advance(self.sLoop.time() + fSeconds)
+
+    def sent(self):
+        """Commands transmitted so far, as `(iTrans, rPayload)`."""
+        lSent = []
+        for _, rCommand in self.sLink.lSent:
+            rTrans, _, rPayload = rCommand.partition(",")
+            lSent.append((int(rTrans), rPayload))
+        return lSent
+
+    def receive(self, rDatagram):
+        self.sLink.handle_datagram(rDatagram)
+        self.sLoop.advance(self.sLoop.time())  # Dispatch ingested messages
+
+    def receive_json(self, dMessage):
+        self.iLinkTrans += 1
+        dMessage = dict(dMessage, trans=self.iLinkTrans, mac="20:3B:85")
+        self.receive("*!" + json.dumps(dMessage))
+
+    def transmit_fail(self, iTrans):
+        """Reply to command `iTrans` as the Link does when it cannot reach
+        the device: a plain-text error and a JSON copy."""
+        self.receive('{},ERR,6,"Transmit fail"'.format(iTrans))
+        self.receive_json({
+            "pkt": "error",
+            "fn": "error",
+            "payload": "Transmit fail",
+            })
+
+
+class RetransmitTest(LinkTestCase):
+
+    def test_repeated_transmit_fail(self):
+        sFuture = self.sLink.send_command("!R1F*tP60.0")
+        self.advance(0)
+        self.assertEqual(self.sent(), [(100, "!R1F*tP60.0")])
+
+        self.transmit_fail(100)
+        self.advance(3)
+        self.assertEqual(len(self.sent()), 2)
+        iRetry = self.sent()[-1][0]
+        self.assertNotEqual(iRetry, 100)
+
+        # Sent while the retry is in flight, and innocent of its failure
+        sOther = self.sLink.send_command("!R2F*r")
+        self.advance(3)
+        self.assertEqual(self.sent()[-1][1], "!R2F*r")
+
+        self.transmit_fail(iRetry)
+        self.assertEqual(self.sLink.iRetransmissions, 2)
+        self.assertFalse(sFuture.bInFlight)
+        self.assertTrue(sOther.bInFlight)
+
+        self.advance(10)
+        iThird = self.sent()[-1][0]
+        self.assertEqual(self.sent()[-1][1], "!R1F*tP60.0")
+        self.receive("{},OK".format(iThird))
+        self.assertTrue(sFuture.done())
+        self.assertEqual(sFuture.dResponse["fn"], "ack")
+        self.assertEqual(self.sLink.dRenumbered, {})
+
+    def test_late_reply_to_earlier_transmission(self):
+        sFuture = self.sLink.send_command("!R1F*tP60.0")
+        self.advance(0)
+        self.sLink.fail(sFuture, "timeout")
+        self.advance(3)
+        iRetry = self.sent()[-1][0]
+        self.assertNotEqual(iRetry, 100)
+
+        # A late failure of the first transmission is not the retry's
+        self.receive('100,ERR,6,"Transmit fail"')
+        self.assertTrue(sFuture.bInFlight)
+        # ... but a late acknowledgement answers the command
+        self.receive("100,OK")
+        self.assertTrue(sFuture.done())
+        self.assertEqual(self.sLink.dPending, {})
+
+    def test_retransmit_after_timeout(self):
+        sFuture = self.sLink.send_command("!R1F*r")
+        self.advance(0)
+        self.advance(self.sLink.COMMAND_TIMEOUT_SECONDS + 5)
+        self.assertEqual([x[1] for x in self.sent()], ["!R1F*r"] * 2)
+        self.assertEqual(self.sLink.iRetransmissions, 1)
+        self.receive("{},OK".format(self.sent()[-1][0]))
+        self.assertEqual(sFuture.dResponse["fn"], "ack")
+        self.assertEqual(self.sLink.iFailures, 0)
+
+    def test_give_up(self):
+        sFuture = self.sLink.send_command("!R1F*r", iRetries=2)
+        self.advance(300)
+        self.assertTrue(sFuture.done())
+        self.assertEqual(sFuture.dResponse, {})
+        self.assertEqual([x[1] for x in self.sent()], ["!R1F*r"] * 3)
+        self.assertEqual(self.sLink.iRetransmissions, 2)
+        self.assertEqual(self.sLink.iFailures, 1)
+        self.assertEqual(self.sLink.dPending, {})
+        self.assertEqual(self.sLink.dRenumbered, {})
+
+
+class CoalesceTest(LinkTestCase):
+
+    def exhaust_burst(self):
+        for iRoom in xrange(self.sLink.COMMAND_BURST):
+            self.sLink.send_command("!R{}F*r".format(10 + iRoom))
+        self.advance(0)
+
+    def test_set_target_supersedes_waiting(self):
+        self.exhaust_burst()
+        sFirst = self.sLink.send_command("!R1F*tP55.0")
+        sSecond = self.sLink.send_command("!R1F*tP60.0")
+        self.assertIs(sFirst, sSecond)
+        self.assertEqual(self.sLink.sScheduler.iCoalesced, 1)
+        self.advance(10)
+        lPayloads = [x[1] for x in self.sent()]
+        self.assertEqual(lPayloads.count("!R1F*tP60.0"), 1)
+        self.assertNotIn("!R1F*tP55.0", lPayloads)
+
+    def test_rooms_not_coalesced(self):
+        self.exhaust_burst()
+        sFirst = self.sLink.send_command("!R1F*tP60.0")
+        sSecond = self.sLink.send_command("!R2F*tP60.0")
+        self.assertIsNot(sFirst, sSecond)
+        self.assertEqual(self.sLink.sScheduler.iCoalesced, 0)
+
+    def test_retry_yields_to_newer_setting(self):
+        sOld = self.sLink.send_command("!R1F*tP55.0")
+        self.advance(0)
+        iOld = self.sent()[-1][0]
+        self.transmit_fail(iOld)
+        sNew = self.sLink.send_command("!R1F*tP60.0")
+        self.assertIsNot(sOld, sNew)
+        self.advance(10)
+        self.assertEqual(
+            [x[1] for x in self.sent()],
+            ["!R1F*tP55.0", "!R1F*tP60.0"])
+
+        self.receive("{},OK".format(self.sent()[-1][0]))
+        self.assertTrue(sNew.done())
+        self.assertTrue(sOld.done())
+        self.assertEqual(sOld.dResponse, sNew.dResponse)
+
+
+class IngestQueueTest(unittest.TestCase):
+
+    def test_coalesce_replaces_and_moves_to_back(self):
+        sQueue = lightwave_link.IngestQueue(10)
+        sQueue.put({"fn": "statusPush", "cTemp": 18.0, "output": 0}, "a")
+        sQueue.put({"fn": "other"})
+        sQueue.put({"fn": "statusPush", "cTemp": 19.0}, "a")
+        self.assertEqual(len(sQueue), 2)
+        self.assertEqual(sQueue.iCoalesced, 1)
+        self.assertEqual(sQueue.pop(), ({"fn": "other"}, None))
+        self.assertEqual(
+            sQueue.pop(),
+            ({"fn": "statusPush", "cTemp": 19.0}, None))
+
+    def test_overflow(self):
+        sQueue = lightwave_link.IngestQueue(2)
+        for i in xrange(3):
+            self.assertTrue(sQueue.put({"i": i}))
+        self.assertEqual([sQueue.pop()[0]["i"] for _ in xrange(2)], [1, 2])
+        sQueue = lightwave_link.IngestQueue(
+            2,
+            lightwave_link.IngestQueue.DROP_NEWEST)
+        for i in xrange(3):
+            sQueue.put({"i": i})
+        self.assertEqual([sQueue.pop()[0]["i"] for _ in xrange(2)], [0, 1])
+        self.assertEqual(sQueue.iDropped, 1)
+
+
+class IngestTest(LinkTestCase):
+    cLink = lightwave_link.ReplayLink
+
+    def test_push_and_read_dispatched_apart(self):
+        lDispatched = []
+        for rFn in ("statusPush", "read"):
+            self.sLink.sRouter.register(lDispatched.append, rFn=rFn)
+        self.sLink.sIngest = lightwave_link.IngestQueue(10)
+        self.sLink.ingest({"fn": "statusPush", "serial": "A", "output": 0})
+        self.sLink.ingest({"fn": "read", "serial": "A", "slot": 1})
+        self.sLink.ingest({"fn": "statusPush", "serial": "A", "output": 60})
+        self.advance(0)
+        self.assertEqual(
+            [(x["fn"], x.get("output")) for x in lDispatched],
+            [("read", None), ("statusPush", 60)])
+
+    def test_ingest_wait_and_dispatch_timed(self):
+        sClock = self.sLoop.sClock
+
+        def handle(_):
+            sClock.fNow += 0.02     # Slow handler
+
+        self.sLink.sRouter.register(handle, rFn="statusPush")
+        self.sLink.ingest({"fn": "statusPush", "serial": "A", "output": 0})
+        sClock.fNow += 0.2          # Held up by other work before the drain
+        self.advance(0)
+        self.assertEqual(sum(self.sLink.sIngestWait.lCounts), 1)
+        self.assertAlmostEqual(self.sLink.sIngestWait.fSum, 0.2)
+        self.assertEqual(sum(self.sLink.sDispatch.lCounts), 1)
+        self.assertAlmostEqual(self.sLink.sDispatch.fSum, 0.02)
+
+
+class ControllerTestCase(LinkTestCase):
+    cLink = lightwave_link.ReplayLink
+
+    def setUp(self):
+        LinkTestCase.setUp(self)
+        self.sController = lightwave_link.HeatingController(
+            self.sLink,
+            {"9993FE": lightwave_link.HeatDemandTracker.BOILER_NAME,
+             "DCC302": "Lounge"})
+        self.sController.activate()
+
+    def status(self, rSerial, rProd, iOutput):
+        self.receive_json({
+            "pkt": "868R",
+            "fn": "statusPush",
+            "time": int(self.sLoop.time()),
+            "prod": rProd,
+            "serial": rSerial,
+            "type": "temp",
+            "cTemp": 18.0,
+            "cTarg": 21.0,
+            "output": iOutput,
+            })
+
+    def read(self, rSerial, rProd, iSlot):
+        self.receive_json({
+            "pkt": "room",
+            "fn": "read",
+            "slot": iSlot,
+            "serial": rSerial,
+            "prod": rProd,
+            })
+
+
+class CallForHeatTest(ControllerTestCase):
+
+    def test_switch_room_unknown(self):
+        self.read("DCC302", "valve", 1)
+        self.status("9993FE", "electric", 0)
+        self.status("DCC302", "valve", 80)
+        self.advance(5)
+        lPayloads = [x[1] for x in self.sent()]
+        self.assertNotIn("None", " ".join(lPayloads))
+        self.assertIn("@R", lPayloads)
+
+        self.read("9993FE", "electric", 4)
+        self.advance(5)
+        self.assertIn("!R4F*tP60.0", [x[1] for x in self.sent()])
+
+
+class SnapshotTest(ControllerTestCase):
+
+    def setUp(self):
+        ControllerTestCase.setUp(self)
+        self.rDirectory = tempfile.mkdtemp()
+        self.rPath = os.path.join(self.rDirectory, "state.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.rDirectory)
+
+    def restart(self, fSeconds):
+        """Save a snapshot, and restore it into a new controller `fSeconds`
+        later."""
+        lightwave_link.save_snapshot(
+            self.rPath,
+            self.sController.dStatus,
+            self.sLink)
+        dSnapshot = lightwave_link.load_snapshot(self.rPath)
+        self.sLoop = lightwave_link.ReplayLoop(self.sLoop.time() + fSeconds)
+        self.sLink = self.cLink(self.sLoop)
+        self.sController = lightwave_link.HeatingController(
+            self.sLink,
+            {"DCC302": "Lounge"})
+        return self.sController.restore(dSnapshot)
+
+    def calling(self):
+        return [
+            sSerial
+            for sZone in self.sController.sZones.dZones.itervalues()
+            for sSerial in sZone.dCalling]
+
+    def test_round_trip(self):
+        self.read("DCC302", "valve", 1)
+        self.status("DCC302", "valve", 80)
+        self.assertEqual(self.restart(60), [1])
+        sDevice = self.sController.dStatus["DCC302"]
+        self.assertEqual(sDevice.output, 80)
+        self.assertEqual(sDevice.fSeen, BASE_TIME)
+        self.assertEqual(self.calling(), ["DCC302"])
+
+    def test_unheard_device_restored_stale(self):
+        self.read("DCC302", "valve", 1)
+        self.status("DCC302", "valve", 80)
+        self.restart(lightwave_link.STALE_THRESHOLD_SECONDS + 60)
+        sDevice = self.sController.dStatus["DCC302"]
+        self.assertEqual(sDevice.rDemand, sDevice.DEMAND_STALE)
+        self.assertEqual(sDevice.fSeen, BASE_TIME)
+        self.assertEqual(self.calling(), [])
+
+    def test_other_version_ignored(self):
+        self.assertIsNone(lightwave_link.load_snapshot(self.rPath))
+        with open(self.rPath, "w") as sFH:
+            json.dump({"version": 0, "devices": []}, sFH)
+        self.assertIsNone(lightwave_link.load_snapshot(self.rPath))
+
+    def test_removed_device_dropped(self):
+        self.read("DCC302", "valve", 1)
+        self.status("DCC302", "valve", 80)
+        fTTL = lightwave_link.SNAPSHOT_TTL_SECONDS
+
+        # Dropped when restoring ...
+        self.assertEqual(self.restart(fTTL + 60), [])
+        self.assertEqual(self.sController.dStatus, {})
+
+        # ... and when saving
+        self.status("DCC302", "valve", 80)
+        self.advance(fTTL / 2)
+        self.status("9993FE", "electric", 0)
+        self.advance(fTTL / 2 + 60)
+        self.restart(0)
+        self.assertEqual(
+            [x["serial"]
+             for x in lightwave_link.load_snapshot(self.rPath)["devices"]],
+            ["9993FE"])
+
+class StateServerTest(ControllerTestCase):
+
+    def setUp(self):
+        ControllerTestCase.setUp(self)
+        self.sServer = lightwave_link.StateServer(self.sLoop, 0)
+        self.sServer.add(self.sController)
+
+    def tearDown(self):
+        self.sServer.sServer.shutdown()
+        self.sServer.sServer.server_close()
+
+    def test_bound_to_localhost(self):
+        self.assertEqual(self.sServer.sServer.server_address[0], "127.0.0.1")
+
+    def test_refresh_republishes_changes_only(self):
+        self.read("DCC302", "valve", 1)
+        self.status("DCC302", "valve", 80)
+        self.advance(0)
+        sSnapshot = self.sServer.sSnapshot
+        self.assertEqual(sSnapshot.dDevices["DCC302"]["demand"], "calling")
+        self.assertIsNotNone(sSnapshot.body("/devices"))
+
+        self.advance(self.sServer.REFRESH_SECONDS)
+        self.assertIs(self.sServer.sSnapshot, sSnapshot)
+
+        # Gone stale without a word
+        sDevice = self.sController.dStatus["DCC302"]
+        sDevice.output = None
+        sDevice.reevaluate(
+            self.sLoop.time() + lightwave_link.STALE_THRESHOLD_SECONDS)
+        self.advance(self.sServer.REFRESH_SECONDS)
+        self.assertIsNot(self.sServer.sSnapshot, sSnapshot)
+        self.assertEqual(
+            self.sServer.sSnapshot.dDevices["DCC302"]["demand"],
+            "stale")
+
+
+class CollectorTest(LinkTestCase):
+
+    def labels(self, sCollector, rName):
+        for sFamily in sCollector.collect():
+            if sFamily.name == rName:
+                return [sorted(x.labels) for x in sFamily.samples]
+        return None
+
+    def test_link_label_only_with_several_links(self):
+        sFuture = self.sLink.send_command("!R1F*r")
+        self.advance(0)
+        self.receive("100,OK")
+        self.assertTrue(sFuture.done())
+
+        sCollector = lightwave_link.LightwaveCollector({}, self.sLink)
+        self.assertEqual(self.labels(sCollector, "lwl_responses"), [["fn"]])
+        self.assertEqual(self.labels(sCollector, "lwl_command_rate"), [[]])
+
+        sOther = self.cLink(self.sLoop)
+        sOther.rAddress = "192.168.1.2"
+        sCollector.add({}, sOther)
+        self.assertEqual(
+            self.labels(sCollector, "lwl_responses"),
+            [["fn", "link"]])
+        self.assertEqual(
+            self.labels(sCollector, "lwl_command_rate"),
+            [["link"], ["link"]])
+
+
+if __name__ == "__main__":
+    unittest.main()
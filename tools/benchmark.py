@@ -0,0 +1,326 @@
+#!/usr/bin/python2.7
+# encoding: utf8
+"""
+Micro- and macro-benchmarks for the controller's receive and control
+pipeline, using synthetic traffic modelled on the sample messages in
+lightwave_link.py's docstrings.
+
+Results are written as JSON (one object per benchmark, with the best of
+several repeats) so that runs can be compared to catch regressions::
+
+    tools/benchmark.py --output bench_output.txt
+    tools/benchmark.py --filter call_for_heat --devices 80
+"""
+
+# pylint: disable=invalid-name,trailing-whitespace,missing-docstring
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+import lightwave_link
+
+DEVICE_COUNTS = (10, 80, 1000)
+BASE_TIME = 1545130654
+
+
+def make_serial(iDevice):
+    return "B{:05X}".format(iDevice)
+
+def make_status(iDevice, iSequence):
+    """statusPush for device `iDevice`, varying with `iSequence` so that
+    successive messages are distinct and some valves open and close."""
+    return {
+        "trans": 1000 + iSequence,
+        "mac": "20:3B:85",
+        "time": BASE_TIME + iSequence,
+        "pkt": "868R",
+        "fn": "statusPush",
+        "prod": "valve",
+        "serial": make_serial(iDevice),
+        "type": "temp",
+        "batt": 2.69,
+        "ver": 58,
+        "state": "man",
+        "cTemp": 22.0,
+        "cTarg": 21.0,
+        "output": 60 if (iDevice + iSequence) % 7 == 0 else 0,
+        "nTarg": 50.0,
+        "nSlot": "18:00",
+        "prof": 2,
+        }
+
+def make_read(iDevice, rProd="valve"):
+    return {
+        "trans": 357,
+        "mac": "20:3B:85",
+        "time": BASE_TIME,
+        "pkt": "room",
+        "fn": "read",
+        "slot": iDevice,
+        "serial": make_serial(iDevice),
+        "prod": rProd,
+        }
+
+def make_summary():
+    dSummary = {
+        "trans": 1473,
+        "mac": "20:3B:85",
+        "time": BASE_TIME,
+        "pkt": "room",
+        "fn": "summary",
+        }
+    for i in xrange(10):
+        dSummary["stat{}".format(i)] = 0
+    dSummary["stat0"] = 127
+    dSummary["stat1"] = 1
+    return dSummary
+
+def encode(dMessage):
+    import json
+    return "*!" + json.dumps(dMessage, separators=(",", ":"))
+
+def make_datagrams(iDevices, iMessages):
+    """Stream of `iMessages` status datagrams spread over `iDevices`, each
+    followed by its (broadcast) duplicate, as received from a real Link."""
+    lDatagrams = []
+    for iSequence in xrange(iMessages):
+        rDatagram = encode(make_status(iSequence % iDevices, iSequence))
+        lDatagrams.append(rDatagram)
+        lDatagrams.append(rDatagram)
+    return lDatagrams
+
+def make_fleet(iDevices, sLoop):
+    """`HeatingController` populated with `iDevices` valves and a boiler."""
+    sLink = lightwave_link.ReplayLink(sLoop)
+    dConfig = {make_serial(0): lightwave_link.HeatDemandTracker.BOILER_NAME}
+    sController = lightwave_link.HeatingController(sLink, dConfig)
+    sController.on_status(make_read(0, "electric"))
+    for iDevice in xrange(1, iDevices + 1):
+        sController.on_status(make_read(iDevice))
+        sController.on_status(make_status(iDevice, 0))
+    return sController
+
+# =============================================================================
+class Benchmarks(object):
+    """
+    Each `bench_*` method returns a list of `(rName, dParams, fnRun, iOps)`
+    cases, where `fnRun()` performs `iOps` operations.
+    """
+    def __init__(self, iMessages, lDeviceCounts):
+        self.iMessages = iMessages
+        self.lDeviceCounts = lDeviceCounts
+
+    def bench_dedupe(self):
+        lDatagrams = make_datagrams(10, self.iMessages)
+        fNow = [0.0]
+        def run():
+            sFilter = lightwave_link.DuplicateFilter(
+                lightwave_link.LightwaveLink.DUPLICATE_WINDOW_SECONDS,
+                lightwave_link.LightwaveLink.DUPLICATE_CACHE_SIZE,
+                lambda: fNow[0])
+            for rDatagram in lDatagrams:
+                fNow[0] += 0.01
+                sFilter.is_duplicate(rDatagram)
+        return [("dedupe", {}, run, len(lDatagrams))]
+
+    def bench_decode(self):
+        import json
+        sRouter = lightwave_link.MessageRouter()
+
+        def make_runs(lJSON):
+            def run_decode():
+                for rJSON in lJSON:
+                    json.loads(rJSON)
+            def run_peek():
+                for rJSON in lJSON:
+                    sRouter.peek(rJSON)
+            return run_decode, run_peek
+
+        lCases = []
+        for rFn, dMessage in (
+                ("statusPush", make_status(1, 0)),
+                ("read", make_read(1)),
+                ("summary", make_summary()),
+                ):
+            lJSON = [encode(dMessage)[2:]] * self.iMessages
+            run_decode, run_peek = make_runs(lJSON)
+            lCases.extend([
+                ("json_decode", {"fn": rFn}, run_decode, len(lJSON)),
+                ("router_peek", {"fn": rFn}, run_peek, len(lJSON)),
+                ])
+        return lCases
+
+    def bench_handle_datagram(self):
+        lDatagrams = make_datagrams(10, self.iMessages)
+        def run():
+            sLoop = lightwave_link.ReplayLoop(BASE_TIME)
+            sLink = lightwave_link.ReplayLink(sLoop)
+            sLink.sRouter.register(lambda dMessage: None, rFn="statusPush")
+            for rDatagram in lDatagrams:
+                sLink.handle_datagram(rDatagram)
+                sLoop.advance(BASE_TIME)    # Dispatch, see LightwaveLink.drain
+        return [("handle_datagram", {}, run, len(lDatagrams))]
+
+    def bench_trvstatus(self):
+        lStatus = [make_status(1, i) for i in xrange(self.iMessages)]
+        sDevice = lightwave_link.TRVStatus("Lounge")
+        sDevice.update(make_read(1), BASE_TIME)
+        def run_update():
+            for dStatus in lStatus:
+                sDevice.update(dStatus, BASE_TIME)
+        iRenders = max(self.iMessages // 10, 1)
+        def run_str():
+            for _ in xrange(iRenders):
+                str(sDevice)
+        return [
+            ("trvstatus_update", {}, run_update, len(lStatus)),
+            ("trvstatus_str", {}, run_str, iRenders),
+            ]
+
+    def bench_call_for_heat(self):
+        def make_runs(sController, lStatus):
+            sZones = sController.sZones
+            lDevices = sController.dStatus.values()
+            def run_message():
+                for dStatus in lStatus:
+                    sController.on_status(dStatus)
+                    sController.evaluate()
+            def run_refresh():
+                sZones.refresh(lDevices, BASE_TIME)
+            def run_collect():
+                sCollector = lightwave_link.LightwaveCollector(
+                    sController.dStatus, sController.sLink)
+                for sFamily in sCollector.collect():
+                    del sFamily
+            return run_message, run_refresh, run_collect
+
+        lCases = []
+        for iDevices in self.lDeviceCounts:
+            lStatus = [
+                make_status(1 + (i % iDevices), i)
+                for i in xrange(self.iMessages)
+                ]
+            run_message, run_refresh, run_collect = make_runs(
+                make_fleet(iDevices, lightwave_link.ReplayLoop()),
+                lStatus)
+            lCases.extend([
+                ("call_for_heat_per_message", {"devices": iDevices},
+                 run_message, len(lStatus)),
+                ("demand_refresh_all", {"devices": iDevices},
+                 run_refresh, 1),
+                ("metrics_collect", {"devices": iDevices},
+                 run_collect, 1),
+                ])
+        return lCases
+
+    def bench_end_to_end(self):
+        def make_run(iDevices, lDatagrams):
+            def run():
+                sLoop = lightwave_link.ReplayLoop(BASE_TIME)
+                sController = make_fleet(iDevices, sLoop)
+                sController.activate()
+                sLink = sController.sLink
+                fNow = BASE_TIME
+                for rDatagram in lDatagrams:
+                    fNow += 0.01
+                    sLoop.advance(fNow)
+                    sLink.handle_datagram(rDatagram)
+                sLoop.advance(fNow)
+            return run
+
+        lCases = []
+        for iDevices in self.lDeviceCounts:
+            lDatagrams = make_datagrams(iDevices, self.iMessages)
+            run = make_run(iDevices, lDatagrams)
+            lCases.append(
+                ("end_to_end", {"devices": iDevices}, run, len(lDatagrams)))
+        return lCases
+
+    def cases(self):
+        for rName in sorted(dir(self)):
+            if rName.startswith("bench_"):
+                for tCase in getattr(self, rName)():
+                    yield tCase
+
+def measure(fnRun, iRepeat):
+    """Return the best of `iRepeat` timings of `fnRun`, in seconds."""
+    import time
+    fBest = None
+    for _ in xrange(iRepeat):
+        fStart = time.time()
+        fnRun()
+        fElapsed = time.time() - fStart
+        if fBest is None or fElapsed < fBest:
+            fBest = fElapsed
+    return fBest
+
+def parse_args(lArgs=None):
+    import argparse
+    sParser = argparse.ArgumentParser(
+        description="Benchmark the controller's receive/control pipeline")
+    sParser.add_argument(
+        "--messages", type=int, default=2000,
+        help="Messages per benchmark run (default: %(default)s)")
+    sParser.add_argument(
+        "--devices", type=int, action="append",
+        help="Fleet size for fleet-dependent benchmarks; may be repeated "
+             "(default: {})".format(", ".join(map(str, DEVICE_COUNTS))))
+    sParser.add_argument(
+        "--repeat", type=int, default=5,
+        help="Runs per benchmark, of which the fastest is reported "
+             "(default: %(default)s)")
+    sParser.add_argument(
+        "--filter", default="",
+        help="Only run benchmarks whose name contains this string")
+    sParser.add_argument(
+        "--output", metavar="PATH",
+        help="Write results to PATH as well as stdout")
+    sParser.add_argument(
+        "--log", action="store_true",
+        help="Keep the controller's INFO logging (costly) enabled")
+    return sParser.parse_args(lArgs)
+
+def main():
+    import json
+    import logging
+    import platform
+
+    sArgs = parse_args()
+    if not sArgs.log:
+        lightwave_link.sLog.setLevel(logging.WARNING)
+
+    sBenchmarks = Benchmarks(
+        sArgs.messages,
+        sArgs.devices or list(DEVICE_COUNTS))
+    lResults = []
+    for rName, dParams, fnRun, iOps in sBenchmarks.cases():
+        if sArgs.filter not in rName:
+            continue
+        fSeconds = measure(fnRun, sArgs.repeat)
+        dResult = {
+            "name": rName,
+            "params": dParams,
+            "ops": iOps,
+            "seconds": fSeconds,
+            "us_per_op": 1e6 * fSeconds / iOps,
+            "ops_per_second": iOps / max(fSeconds, 1e-9),
+            }
+        lResults.append(dResult)
+        sys.stderr.write("{name:<28} {params!s:<18} {us_per_op:>10.2f} us/op "
+                         "{ops_per_second:>12.0f} ops/s\n".format(**dResult))
+
+    rReport = json.dumps({
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": lResults,
+        }, indent=2, sort_keys=True)
+    print rReport
+    if sArgs.output:
+        with open(sArgs.output, "w") as sFH:
+            sFH.write(rReport + "\n")
+
+if __name__ == "__main__":
+    main()
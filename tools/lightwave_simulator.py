@@ -0,0 +1,597 @@
+#!/usr/bin/python2.7
+# encoding: utf8
+"""
+Stand-in for a Lightwave Link, for load and latency testing the controller
+without the physical hardware or more valves than we own.
+
+Listens for commands on UDP port 9760 and responds on port 9761, both
+unicast and broadcast (or unicast twice, if broadcast is disabled), like the
+real Link. Simulates a boiler switch plus up to 80 rooms of TRVs which push
+status periodically. Example, with the controller on the same host::
+
+    tools/lightwave_simulator.py --trvs 40 --loss 0.05 --latency 0.2 &
+    ./lightwave_link.py --link-address 127.0.0.1
+
+Alternatively `--soak DAYS` runs the controller against the simulator in
+this process, in virtual time, so that days of operation take seconds::
+
+    tools/lightwave_simulator.py --soak 7 --trvs 10 --loss 0.05
+"""
+
+# pylint: disable=invalid-name,trailing-whitespace,missing-docstring
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+from lightwave_link import (
+    EventLoop,
+    HeatDemandTracker,
+    HeatingController,
+    LightwaveLink,
+    ReplayLoop,
+    sLog,
+    )
+
+MAX_ROOMS = 80
+
+
+# =============================================================================
+class SimulatedDevice(object):
+    """
+    A TRV or electric switch paired with the simulated Link.
+
+    :IVariables:
+        iRoom : int
+            Room number (1-80), a.k.a. slot.
+        rSerial : str
+            6 character serial.
+        rProd : str
+            "valve" for TRVs, "electric" for the boiler switch.
+        fBatt : float
+            Battery voltage.
+        fTemp : float
+            Current temperature, in °C.
+        fTarget : float
+            Current target. 0.0-40.0 is °C, 50.0-60.0 is 0-100% valve.
+        iOutput : int
+            Valve opening (or switch state), 0-100.
+    """
+    def __init__(self, iRoom, rSerial, rProd, sRandom):
+        self.iRoom = iRoom
+        self.rSerial = rSerial
+        self.rProd = rProd
+        self.fBatt = round(sRandom.uniform(2.6, 3.1), 2)
+        self.fTemp = round(sRandom.uniform(15.0, 22.0), 1)
+        self.fTarget = sRandom.choice((18.0, 20.0, 21.0, 50.0))
+        self.iOutput = 0
+        self.update_output()
+
+    def update_output(self):
+        if self.fTarget >= 50.0:
+            self.iOutput = int(round((self.fTarget - 50.0) * 10))
+        elif self.rProd != "valve":
+            self.iOutput = 0
+        elif self.fTemp < self.fTarget:
+            self.iOutput = 100
+        else:
+            self.iOutput = 0
+
+    def tick(self, bBoilerOn):
+        """Advance the temperature model by one push interval."""
+        if self.rProd != "valve":
+            return
+        if bBoilerOn and self.iOutput:
+            self.fTemp = min(self.fTemp + 0.2, 30.0)
+        else:
+            self.fTemp = max(self.fTemp - 0.1, 5.0)
+        self.fBatt = max(self.fBatt - 0.0001, 2.0)
+        self.update_output()
+
+    def status(self):
+        return {
+            "fn": "statusPush",
+            "pkt": "868R",
+            "prod": self.rProd,
+            "serial": self.rSerial,
+            "type": "temp",
+            "batt": self.fBatt,
+            "cTemp": round(self.fTemp, 1),
+            "cTarg": self.fTarget,
+            "nSlot": "18:00",
+            "nTarg": 50.0,
+            "output": self.iOutput,
+            "prof": 2,
+            "state": "man",
+            "ver": 58,
+            }
+
+# =============================================================================
+class LinkSimulator(object):
+    """
+    :IVariables:
+        sLoop : EventLoop
+            Drives receiving, delayed responses and periodic status pushes.
+        sSock : socket.socket
+            Bound to the command port, with broadcast enabled. None if
+            `fnDeliver` is used instead.
+        fnDeliver : callable
+            Called with `(rDatagram, rHost)` to deliver each response
+            in-process, rather than sending it with `sSock`.
+        dDevices : dict
+            Maps room number to `SimulatedDevice`.
+        sBoiler : SimulatedDevice
+            The boiler switch, or None.
+        sRegistered : set
+            IP addresses of hosts allowed to issue commands.
+        sClients : set
+            IP addresses of registered hosts which have sent us a command,
+            and so receive status pushes by unicast.
+        iTrans : int
+            The Link's own transaction counter, used in JSON messages.
+        dStats : collections.Counter
+            Number of commands received, datagrams sent, dropped, etc.
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, sArgs, sLoop=None, fnDeliver=None):
+        import collections
+        import random
+        import socket
+
+        self.sArgs = sArgs
+        self.sRandom = random.Random(sArgs.seed)
+        self.sLoop = sLoop or EventLoop()
+        self.fnDeliver = fnDeliver
+        self.dDevices = {}
+        self.sBoiler = None
+        self.sRegistered = set()
+        self.sClients = set()
+        self.iTrans = 0
+        self.dStats = collections.Counter()
+        self.fRadioFree = 0.0     # Unixtime the RF transmitter is next idle
+
+        iRoom = 1
+        if sArgs.boiler_serial:
+            self.sBoiler = SimulatedDevice(
+                iRoom, sArgs.boiler_serial, "electric", self.sRandom)
+            self.sBoiler.fTarget = 50.0
+            self.sBoiler.update_output()
+            self.dDevices[iRoom] = self.sBoiler
+            iRoom += 1
+        for _ in xrange(sArgs.trvs):
+            if iRoom > MAX_ROOMS:
+                sLog.warn("Only %s rooms available", MAX_ROOMS)
+                break
+            self.dDevices[iRoom] = SimulatedDevice(
+                iRoom, "F0{:04X}".format(iRoom), "valve", self.sRandom)
+            iRoom += 1
+
+        self.sSock = None
+        if fnDeliver is None:
+            self.sSock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sSock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.sSock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            self.sSock.bind(
+                (sArgs.bind, LightwaveLink.LIGHTWAVE_LINK_COMMAND_PORT))
+            self.sSock.setblocking(False)
+            self.sLoop.add_reader(self.sSock.fileno(), self.on_readable)
+
+        for sDevice in self.dDevices.itervalues():
+            self.sLoop.call_later(
+                self.sRandom.uniform(0, sArgs.push_interval),
+                self.push_status,
+                sDevice)
+        if sArgs.stats_interval:
+            self.sLoop.call_later(sArgs.stats_interval, self.log_stats)
+
+    def run(self):
+        sLog.info(
+            "Simulating Lightwave Link with %s devices on port %s",
+            len(self.dDevices),
+            LightwaveLink.LIGHTWAVE_LINK_COMMAND_PORT)
+        try:
+            self.sLoop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        self.log_stats()
+
+    def log_stats(self):
+        sLog.info("Stats: %s", dict(self.dStats))
+        if self.sArgs.stats_interval:
+            self.sLoop.call_later(self.sArgs.stats_interval, self.log_stats)
+
+    # -------------------------------------------------------------------------
+    # Transmission
+
+    def next_trans(self):
+        self.iTrans += 1
+        return self.iTrans
+
+    def send(self, rDatagram, lHosts):
+        """Send `rDatagram` to each of `lHosts`, and to the broadcast
+        address (or each host again, if broadcast is disabled), after the
+        simulated latency and subject to simulated loss."""
+        fDelay = max(
+            0.0,
+            self.sArgs.latency
+            + self.sRandom.uniform(-self.sArgs.jitter, self.sArgs.jitter))
+        lDestinations = list(lHosts)
+        if self.sArgs.broadcast_address:
+            lDestinations.append(self.sArgs.broadcast_address)
+        else:
+            lDestinations.extend(lHosts)
+        for rHost in lDestinations:
+            self.sLoop.call_later(fDelay, self.transmit, rDatagram, rHost)
+
+    def transmit(self, rDatagram, rHost):
+        import socket
+        if self.sRandom.random() < self.sArgs.loss:
+            self.dStats["dropped"] += 1
+            return
+        if self.fnDeliver is not None:
+            self.dStats["sent"] += 1
+            self.fnDeliver(rDatagram, rHost)
+            return
+        try:
+            self.sSock.sendto(
+                rDatagram,
+                (rHost, LightwaveLink.LIGHTWAVE_LINK_RESPONSE_PORT))
+            self.dStats["sent"] += 1
+        except socket.error as sError:
+            sLog.debug("sendto(%s) failed: %s", rHost, sError)
+            self.dStats["send_errors"] += 1
+
+    def send_json(self, dMessage, lHosts):
+        import json
+        dFull = {
+            "trans": self.next_trans(),
+            "mac": self.sArgs.mac,
+            "time": int(self.sLoop.time()),
+            }
+        dFull.update(dMessage)
+        self.send("*!" + json.dumps(dFull, separators=(",", ":")), lHosts)
+
+    def send_text(self, iTrans, rReply, lHosts):
+        self.send("{},{}".format(iTrans, rReply), lHosts)
+
+    # -------------------------------------------------------------------------
+    # Reception
+
+    def on_readable(self):
+        import errno
+        import socket
+        while True:
+            try:
+                rDatagram, tAddress = self.sSock.recvfrom(1024)
+            except socket.error as sError:
+                if sError.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            self.sLoop.dispatch(self.handle_command, (rDatagram, tAddress[0]))
+
+    def handle_command(self, rDatagram, rHost):
+        import re
+        self.dStats["received"] += 1
+        rTrans, _, rPayload = rDatagram.strip().partition(",")
+        try:
+            iTrans = int(rTrans)
+        except ValueError:
+            sLog.warn("Ignoring command without transaction number: %r",
+                rDatagram)
+            return
+        sLog.debug("Command from %s: %s", rHost, rDatagram)
+
+        if rPayload == "!F*p":
+            self.handle_pairing(iTrans, rHost)
+            return
+
+        if rHost not in self.sRegistered and self.sArgs.unregistered:
+            self.send_text(
+                iTrans,
+                'ERR,2,"Not yet registered. See LightwaveLink"',
+                [rHost])
+            self.send_json({
+                "pkt": "error",
+                "fn": "nonRegistered",
+                "payload": "Not yet registered. See LightwaveLink",
+                }, [rHost])
+            return
+        self.sRegistered.add(rHost)
+        self.sClients.add(rHost)
+
+        sMatch = None
+        for rPattern, fnHandler in (
+                (r"^@H$", self.handle_hub_call),
+                (r"^@R$", self.handle_summary),
+                (r"^@\?R(\d+)$", self.handle_read),
+                (r"^!R(\d+)F\*r$", self.handle_refresh),
+                (r"^!R(\d+)F\*tP([\d.]+)$", self.handle_set_target),
+                ):
+            sMatch = re.match(rPattern, rPayload)
+            if sMatch:
+                self.dStats[fnHandler.__name__] += 1
+                fnHandler(iTrans, rHost, *sMatch.groups())
+                return
+        self.dStats["unknown"] += 1
+        self.send_text(iTrans, 'ERR,1,"Unknown command"', [rHost])
+
+    def handle_pairing(self, iTrans, rHost):
+        if rHost in self.sRegistered or not self.sArgs.unregistered:
+            self.sRegistered.add(rHost)
+            self.send_text(iTrans, '?V="N2.94D"', [rHost])
+            return
+        self.send_text(
+            iTrans,
+            'ERR,2,"Not yet registered. See LightwaveLink"',
+            [rHost])
+        self.send_json({
+            "pkt": "error",
+            "fn": "nonRegistered",
+            "payload": "Not yet registered. See LightwaveLink",
+            }, [rHost])
+        if self.sArgs.pair_delay >= 0:
+            self.sLoop.call_later(self.sArgs.pair_delay, self.pair, rHost)
+
+    def pair(self, rHost):
+        if rHost in self.sRegistered:
+            return
+        sLog.info("Simulating button push: pairing %s", rHost)
+        self.sRegistered.add(rHost)
+        self.send_json({
+            "type": "link",
+            "prod": "lwl",
+            "pairType": "local",
+            "msg": "success",
+            "class": "",
+            "serial": "",
+            }, [rHost])
+
+    def handle_hub_call(self, iTrans, rHost):
+        del iTrans
+        self.send_json({
+            "pkt": "system",
+            "fn": "hubCall",
+            "type": "hub",
+            "prod": "lwl",
+            "fw": "N2.94D",
+            "uptime": 23376,
+            "timeZone": 0,
+            "lat": 52.48,
+            "long": -1.89,
+            "tmrs": 0,
+            "evns": 0,
+            "run": 0,
+            "macs": len(self.sRegistered),
+            "ip": "127.0.0.1",
+            "devs": len(self.dDevices),
+            }, [rHost])
+
+    def handle_summary(self, iTrans, rHost):
+        del iTrans
+        dMessage = {"pkt": "room", "fn": "summary"}
+        for i in xrange(10):
+            iBits = 0
+            for iBit in xrange(8):
+                if (i * 8) + iBit + 1 in self.dDevices:
+                    iBits |= 1 << iBit
+            dMessage["stat{}".format(i)] = iBits
+        self.send_json(dMessage, [rHost])
+
+    def handle_read(self, iTrans, rHost, rRoom):
+        sDevice = self.dDevices.get(int(rRoom))
+        if sDevice is None:
+            self.send_text(iTrans, 'ERR,3,"No such room"', [rHost])
+            return
+        self.send_json({
+            "pkt": "room",
+            "fn": "read",
+            "slot": sDevice.iRoom,
+            "serial": sDevice.rSerial,
+            "prod": sDevice.rProd,
+            }, [rHost])
+
+    def transmit_fails(self, iTrans, rHost):
+        """Simulate the Link failing to reach a device over RF, at random
+        or because its transmitter is still busy with the previous
+        command."""
+        fNow = self.sLoop.time()
+        bBusy = fNow < self.fRadioFree
+        if not bBusy and self.sRandom.random() >= self.sArgs.transmit_fail:
+            if self.sArgs.rf_rate:
+                self.fRadioFree = fNow + 1.0 / self.sArgs.rf_rate
+            return False
+        self.dStats["transmit_busy" if bBusy else "transmit_fail"] += 1
+        self.send_text(iTrans, 'ERR,6,"Transmit fail"', [rHost])
+        self.send_json({
+            "pkt": "error",
+            "fn": "error",
+            "payload": "Transmit fail",
+            }, [rHost])
+        return True
+
+    def handle_refresh(self, iTrans, rHost, rRoom):
+        sDevice = self.dDevices.get(int(rRoom))
+        if sDevice is None:
+            self.send_text(iTrans, 'ERR,3,"No such room"', [rHost])
+            return
+        if self.transmit_fails(iTrans, rHost):
+            return
+        self.send_text(iTrans, "OK", [rHost])
+        self.send_json(sDevice.status(), self.sClients)
+
+    def handle_set_target(self, iTrans, rHost, rRoom, rTarget):
+        sDevice = self.dDevices.get(int(rRoom))
+        if sDevice is None:
+            self.send_text(iTrans, 'ERR,3,"No such room"', [rHost])
+            return
+        if self.transmit_fails(iTrans, rHost):
+            return
+        self.send_text(iTrans, "OK", [rHost])
+        sDevice.fTarget = float(rTarget)
+        sDevice.update_output()
+        self.send_json(sDevice.status(), self.sClients)
+
+    # -------------------------------------------------------------------------
+    # Unsolicited traffic
+
+    def push_status(self, sDevice):
+        bBoilerOn = self.sBoiler is None or bool(self.sBoiler.iOutput)
+        sDevice.tick(bBoilerOn)
+        if self.sClients or self.sArgs.broadcast_address:
+            self.dStats["pushes"] += 1
+            self.send_json(sDevice.status(), self.sClients)
+        self.sLoop.call_later(
+            self.sArgs.push_interval,
+            self.push_status,
+            sDevice)
+
+# =============================================================================
+class SoakLink(LightwaveLink):
+    """
+    `LightwaveLink` connected directly to an in-process `LinkSimulator`,
+    rather than by UDP, so that both can run on a virtual clock.
+    """
+    HOST = "127.0.0.1"
+
+    def __init__(self, sLoop):
+        self.sSimulator = None
+        LightwaveLink.__init__(self, sLoop, self.HOST)
+
+    def create_socket(self):
+        return None
+
+    def send_datagram(self, rCommand, tDestinationAddress):
+        self.sLoop.call_soon(
+            self.sSimulator.handle_command,
+            rCommand,
+            self.HOST)
+
+    def deliver(self, rDatagram, rHost):
+        self.handle_batch(
+            [(rDatagram, (rHost, self.LIGHTWAVE_LINK_COMMAND_PORT))])
+
+def soak(sArgs):
+    """Run the controller against the simulator for `sArgs.soak` days of
+    virtual time, and report what happened."""
+    import logging
+    import time
+
+    sLoop = ReplayLoop(time.time())
+    sLink = SoakLink(sLoop)
+    sSimulator = LinkSimulator(sArgs, sLoop, sLink.deliver)
+    sLink.sSimulator = sSimulator
+    dConfig = {}
+    for iRoom, sDevice in sSimulator.dDevices.iteritems():
+        if sDevice is sSimulator.sBoiler:
+            dConfig[sDevice.rSerial] = HeatDemandTracker.BOILER_NAME
+        else:
+            dConfig[sDevice.rSerial] = "Room {}".format(iRoom)
+    sController = HeatingController(sLink, dConfig)
+
+    iLevel = sLog.level
+    if not sArgs.log:
+        sLog.setLevel(logging.WARNING)
+    fStarted = time.time()
+    fEnd = sLoop.time() + sArgs.soak * 24 * 60 * 60
+    sLink.test_connectivity()
+    sLink.scan_devices()
+    sController.activate()
+    sLoop.run_until(lambda: sLoop.time() >= fEnd)
+    fElapsed = time.time() - fStarted
+    sLog.setLevel(iLevel)
+
+    sLog.info(
+        "Simulated %s days in %.1fs: %s devices, %s calling for heat",
+        sArgs.soak,
+        fElapsed,
+        len(sController.dStatus),
+        sum(len(x.dCalling) for x in sController.sZones.dZones.itervalues()))
+    sLog.info("Simulator stats: %s", dict(sSimulator.dStats))
+    sLog.info(
+        "Controller: %s responses, %s retransmissions, %s failures",
+        sum(sLink.dResponseCount.values()),
+        sLink.iRetransmissions,
+        sLink.iFailures)
+
+def parse_args(lArgs=None):
+    import argparse
+    sParser = argparse.ArgumentParser(
+        description="Simulated Lightwave Link for load and latency testing")
+    sParser.add_argument(
+        "--bind", default="0.0.0.0",
+        help="Address to receive commands on (default: %(default)s)")
+    sParser.add_argument(
+        "--broadcast-address", default="255.255.255.255",
+        help="Where to send the broadcast copy of each response. An empty "
+             "string sends a second unicast copy instead "
+             "(default: %(default)s)")
+    sParser.add_argument(
+        "--mac", default="20:3B:85",
+        help="MAC address given in JSON messages, which should differ "
+             "between simulated Links (default: %(default)s)")
+    sParser.add_argument(
+        "--trvs", type=int, default=10,
+        help="Number of simulated TRVs (default: %(default)s)")
+    sParser.add_argument(
+        "--boiler-serial", default="9993FE",
+        help="Serial of the simulated boiler switch, or an empty string for "
+             "none (default: %(default)s)")
+    sParser.add_argument(
+        "--push-interval", type=float, default=120.0,
+        help="Seconds between status pushes from each device "
+             "(default: %(default)s)")
+    sParser.add_argument(
+        "--latency", type=float, default=0.05,
+        help="Seconds before each response is sent (default: %(default)s)")
+    sParser.add_argument(
+        "--jitter", type=float, default=0.0,
+        help="Maximum random variation of --latency (default: %(default)s)")
+    sParser.add_argument(
+        "--loss", type=float, default=0.0,
+        help="Probability each datagram sent is dropped "
+             "(default: %(default)s)")
+    sParser.add_argument(
+        "--transmit-fail", type=float, default=0.0,
+        help="Probability a device command fails with \"Transmit fail\" "
+             "(default: %(default)s)")
+    sParser.add_argument(
+        "--rf-rate", type=float, default=0.0,
+        help="Device commands per second the Link can transmit; commands "
+             "arriving faster fail with \"Transmit fail\" (default: "
+             "unlimited)")
+    sParser.add_argument(
+        "--unregistered", action="store_true",
+        help="Require hosts to pair with !F*p before issuing commands")
+    sParser.add_argument(
+        "--pair-delay", type=float, default=5.0,
+        help="Seconds after a pairing request until the button is "
+             "\"pushed\", or negative for never (default: %(default)s)")
+    sParser.add_argument(
+        "--stats-interval", type=float, default=60.0,
+        help="Seconds between statistics log lines, or 0 for none "
+             "(default: %(default)s)")
+    sParser.add_argument(
+        "--seed", type=int, default=None,
+        help="Random seed, for repeatable runs")
+    sParser.add_argument(
+        "--soak", type=float, metavar="DAYS",
+        help="Instead of listening for a controller, run one in-process "
+             "for DAYS of virtual time")
+    sParser.add_argument(
+        "--log", action="store_true",
+        help="With --soak, keep the controller's INFO logging (costly) "
+             "enabled")
+    return sParser.parse_args(lArgs)
+
+def main():
+    sArgs = parse_args()
+    if sArgs.soak:
+        soak(sArgs)
+        return
+    LinkSimulator(sArgs).run()
+
+if __name__ == "__main__":
+    main()